@@ -8,22 +8,36 @@ License     : BSD-3-Clause
 Maintainer  : matthew.wakefield@unimelb.edu.au 
 Portability : POSIX
 """
+import importlib
+import queue
 import struct
+import threading
+from array import array
+from itertools import accumulate, chain, islice
 from pathlib import Path
-from typing import BinaryIO, Generator, Tuple, Dict
-from pylazybam.bgzf import BgzfWriter
+from typing import (Any, BinaryIO, Callable, Generator, Tuple, Dict,
+                    Iterable, Iterator, List, Optional, Union)
+from pylazybam.bgzf import (BgzfReader, BgzfWriter, _bgzf_magic,
+                            _inflate_bgzf_block, _iter_raw_bgzf_blocks)
+from pylazybam.index import BaiIndex, IndexBuilder
 from pylazybam.decoders import *
 from pylazybam.tags import *
 
+# NumPy is optional, and only used to build AlignmentBatch columns
+try:
+    _numpy: Any = importlib.import_module("numpy")
+except ImportError: # pragma: no cover
+    _numpy = None
+
 # Parsing functions
 
-def get_ref_index(alignment: bytes) -> int:
+def get_ref_index(alignment: Union[bytes, memoryview]) -> int:
     """
     Extract the reference index from a BAM alignment
 
     Parameters
     ----------
-    alignment : bytes
+    alignment : bytes or memoryview
         A byte string of a bam alignment entry in raw binary format
 
     Returns
@@ -39,13 +53,13 @@ def get_ref_index(alignment: bytes) -> int:
     return struct.unpack("<i", alignment[4:8])[0]
 
 
-def get_pos(alignment: bytes) -> int:
+def get_pos(alignment: Union[bytes, memoryview]) -> int:
     """
     Extract the one based position of this read
 
     Parameters
     ----------
-    alignment : bytes
+    alignment : bytes or memoryview
         A byte string of a bam alignment entry in raw binary format
 
     Returns
@@ -57,13 +71,13 @@ def get_pos(alignment: bytes) -> int:
     return struct.unpack("<i", alignment[8:12])[0]
 
 
-def get_len_read_name(alignment: bytes) -> int:
+def get_len_read_name(alignment: Union[bytes, memoryview]) -> int:
     """
     Extract the length of the read name from a BAM alignment
 
     Parameters
     ----------
-    alignment : bytes
+    alignment : bytes or memoryview
         A byte string of a bam alignment entry in raw binary format
 
     Returns
@@ -74,13 +88,13 @@ def get_len_read_name(alignment: bytes) -> int:
     return struct.unpack("<B", alignment[12:13])[0]
 
 
-def get_mapq(alignment: bytes) -> int:
+def get_mapq(alignment: Union[bytes, memoryview]) -> int:
     """
     Extract the read mapping quality score from a BAM alignment
 
     Parameters
     ----------
-    alignment : bytes
+    alignment : bytes or memoryview
         A byte string of a bam alignment entry in raw binary format
 
     Returns
@@ -91,13 +105,13 @@ def get_mapq(alignment: bytes) -> int:
     return struct.unpack("<B", alignment[13:14])[0]
 
 
-def get_bin(alignment: bytes) -> int:
+def get_bin(alignment: Union[bytes, memoryview]) -> int:
     """
     Extract the BAI index bin from a BAM alignment
 
     Parameters
     ----------
-    alignment : bytes
+    alignment : bytes or memoryview
         A byte string of a bam alignment entry in raw binary format
 
     Returns
@@ -108,13 +122,13 @@ def get_bin(alignment: bytes) -> int:
     return struct.unpack("<H", alignment[14:16])[0]
 
 
-def get_number_cigar_operations(alignment: bytes) -> int:
+def get_number_cigar_operations(alignment: Union[bytes, memoryview]) -> int:
     """
     Extract the number of cigar operations from a BAM alignment
 
     Parameters
     ----------
-    alignment : bytes
+    alignment : bytes or memoryview
         A byte string of a bam alignment entry in raw binary format
 
     Returns
@@ -126,13 +140,13 @@ def get_number_cigar_operations(alignment: bytes) -> int:
     return struct.unpack("<H", alignment[16:18])[0]
 
 
-def get_flag(alignment: bytes) -> int:
+def get_flag(alignment: Union[bytes, memoryview]) -> int:
     """
     Extract the alignment flag from a BAM alignment
 
     Parameters
     ----------
-    alignment : bytes
+    alignment : bytes or memoryview
         A byte string of a bam alignment entry in raw binary format
 
     Returns
@@ -150,8 +164,12 @@ def get_flag(alignment: bytes) -> int:
     "aligned": 0x2,
     "unmapped": 0x4,
     "pair_unmapped": 0x8,
+    "reverse_strand": 0x10,
+    "pair_reverse_strand": 0x20,
     "forward": 0x40,
     "reverse": 0x80,
+    "read1": 0x40,
+    "read2": 0x80,
     "secondary": 0x100,
     "qc_fail": 0x200,
     "duplicate": 0x400,
@@ -163,13 +181,13 @@ def get_flag(alignment: bytes) -> int:
     return struct.unpack("<H", alignment[18:20])[0]
 
 
-def get_len_sequence(alignment: bytes) -> int:
+def get_len_sequence(alignment: Union[bytes, memoryview]) -> int:
     """
     Extract the sequence length from a BAM alignment
 
     Parameters
     ----------
-    alignment : bytes
+    alignment : bytes or memoryview
         A byte string of a bam alignment entry in raw binary format
 
     Returns
@@ -185,13 +203,13 @@ def get_len_sequence(alignment: bytes) -> int:
     return struct.unpack("<i", alignment[20:24])[0]
 
 
-def get_pair_ref_index(alignment: bytes) -> int:
+def get_pair_ref_index(alignment: Union[bytes, memoryview]) -> int:
     """Extract the index identifying the reference sequence of this query
     sequences pair from a BAM alignment
 
     Parameters
     ----------
-    alignment : bytes
+    alignment : bytes or memoryview
         A byte string of a bam alignment entry in raw binary format
 
     Returns
@@ -208,12 +226,12 @@ def get_pair_ref_index(alignment: bytes) -> int:
     return struct.unpack("<i", alignment[24:28])[0]
 
 
-def get_pair_pos(alignment: bytes) -> int:
+def get_pair_pos(alignment: Union[bytes, memoryview]) -> int:
     """Extract the one based position of this reads pair from a BAM alignment
 
     Parameters
     ----------
-    alignment : bytes
+    alignment : bytes or memoryview
         A byte string of a bam alignment entry in raw binary format
 
     Returns
@@ -225,12 +243,12 @@ def get_pair_pos(alignment: bytes) -> int:
     return struct.unpack("<i", alignment[28:32])[0]
 
 
-def get_template_len(alignment: bytes) -> int:
+def get_template_len(alignment: Union[bytes, memoryview]) -> int:
     """Extract the template length from a BAM alignment bytestring
 
     Parameters
     ----------
-    alignment : bytes
+    alignment : bytes or memoryview
         A byte string of a bam alignment entry in raw binary format
 
     Returns
@@ -261,7 +279,7 @@ def get_read_name(alignment: bytes,
         The read name in ASCII SAM format
 
     """
-    return alignment[36 : 35 + read_name_length].decode("utf-8")
+    return str(alignment[36 : 35 + read_name_length], "utf-8")
 
 
 def get_raw_read_name(alignment: bytes,
@@ -426,6 +444,37 @@ def get_raw_base_qual(alignment: bytes,
     end = start + len_sequence
     return alignment[start:end]
 
+def get_reference_end(alignment: Union[bytes, memoryview]) -> int:
+    """Calculate the end of the alignment on the reference from the cigar
+
+    Parameters
+    ----------
+    alignment : bytes or memoryview
+        A byte string of a bam alignment entry in raw binary format
+
+    Returns
+    -------
+    int
+        The zero based, exclusive, end position of the alignment on the
+        reference. Unmapped reads and reads without a cigar string are
+        treated as covering one base.
+
+    Notes
+    -----
+    The M, D, N, = and X cigar operations consume reference bases
+    """
+    pos = get_pos(alignment)
+    number_cigar_operations = get_number_cigar_operations(alignment)
+    if not number_cigar_operations or get_flag(alignment) & 0x4:
+        return pos + 1
+    start = 36 + get_len_read_name(alignment)
+    raw_cigar = alignment[start:start + 4 * number_cigar_operations]
+    span = 0
+    for (operation,) in struct.iter_unpack("<I", raw_cigar):
+        if 0x18d >> (operation & 0xf) & 1: # bits set for M, D, N, = and X
+            span += operation >> 4
+    return pos + (span or 1)
+
 class _FileBase:
     def __init__(self):
         pass
@@ -563,18 +612,246 @@ class _FileBase:
                                                   raw_header=self.raw_header)
         self.update_header_length()
 
+def _peek_magic(handle: BinaryIO) -> bytes:
+    """Return the first four bytes of a file without consuming them"""
+    if hasattr(handle, 'peek'):
+        return handle.peek(4)[:4]
+    elif handle.seekable():
+        start = handle.tell()
+        magic = handle.read(4)
+        handle.seek(start)
+        return magic
+    else: #pragma: no cover
+        return b''
+
+
+class AlignmentBatch:
+    """A batch of raw alignments with the fixed length fields as columns
+
+    The 36 byte fixed length section at the start of each BAM alignment is
+    decoded for the whole batch into typed columns, so that counting,
+    histograms and masks can be computed over the columns rather than by
+    calling the get_ functions on each alignment.
+
+    Parameters
+    ----------
+        alignments : Iterable[bytes or memoryview]
+            The raw BAM alignments in the batch
+
+    Attributes
+    ----------
+        buffer : bytes
+            The raw alignments of the batch packed end to end
+
+        offsets : array
+            The start of each alignment in buffer, followed by the length
+            of buffer. Alignment i is buffer[offsets[i]:offsets[i+1]]
+
+        ref_index, pos, len_sequence, pair_ref_index, pair_pos,
+        template_len : numpy.ndarray or array
+            Signed 32 bit integer (int32 or 'i') columns
+
+        len_read_name, mapq : numpy.ndarray or array
+            Unsigned 8 bit integer (uint8 or 'B') columns
+
+        bin, number_cigar_operations, flag : numpy.ndarray or array
+            Unsigned 16 bit integer (uint16 or 'H') columns
+
+    Notes
+    -----
+    If NumPy is installed the fixed length sections are gathered from the
+    buffer in one indexing operation and viewed with a structured dtype, so
+    the columns are NumPy arrays built without a Python loop.
+
+    Without NumPy the columns are array.array objects built by unpacking
+    each alignment in turn. This is no faster than calling the get_
+    functions on each alignment, but the columns still support the buffer
+    protocol, eg numpy.frombuffer(batch.pos, dtype=numpy.int32)
+
+    The column values are the same as the corresponding pylazybam.bam.get_
+    function, eg batch.flag[i] == get_flag(batch[i])
+    """
+    _core = struct.Struct("<iiiBBHHHiiii")
+    _columns = (("ref_index", "i"),
+                ("pos", "i"),
+                ("len_read_name", "B"),
+                ("mapq", "B"),
+                ("bin", "H"),
+                ("number_cigar_operations", "H"),
+                ("flag", "H"),
+                ("len_sequence", "i"),
+                ("pair_ref_index", "i"),
+                ("pair_pos", "i"),
+                ("template_len", "i"),
+                )
+    # the NumPy equivalents of the array typecodes of the columns
+    _dtypes = {"i": "<i4", "B": "u1", "H": "<u2"}
+
+    ref_index: Any
+    pos: Any
+    len_read_name: Any
+    mapq: Any
+    bin: Any
+    number_cigar_operations: Any
+    flag: Any
+    len_sequence: Any
+    pair_ref_index: Any
+    pair_pos: Any
+    template_len: Any
+
+    def __init__(self, alignments: Iterable[Union[bytes, memoryview]]):
+        alignments = list(alignments)
+        self.buffer: bytes = b"".join(alignments)
+        self.offsets = array("q", accumulate(chain((0,),
+                                                   map(len, alignments))))
+        if _numpy is not None:
+            self._numpy_columns()
+        else:
+            self._array_columns()
+
+    def _numpy_columns(self) -> None:
+        """Set the columns from a structured NumPy view (PRIVATE)"""
+        core_dtype = _numpy.dtype([("block_size", "<i4")]
+                                  + [(name, self._dtypes[typecode])
+                                     for name, typecode in self._columns])
+        starts = _numpy.frombuffer(self.offsets, dtype=_numpy.int64)[:-1]
+        raw = _numpy.frombuffer(self.buffer, dtype=_numpy.uint8)
+        # one row of the 36 fixed length bytes for each alignment
+        core = raw[starts[:, None] + _numpy.arange(36)].view(core_dtype)
+        core = core.reshape(len(starts))
+        for name, typecode in self._columns:
+            setattr(self, name, _numpy.ascontiguousarray(core[name]))
+
+    def _array_columns(self) -> None:
+        """Set the columns by unpacking each alignment (PRIVATE)"""
+        unpack_from = self._core.unpack_from
+        buffer = self.buffer
+        rows = [unpack_from(buffer, start) for start in self.offsets[:-1]]
+        columns: Iterator[tuple]
+        if rows:
+            columns = zip(*rows)
+        else:
+            columns = iter([()] * (len(self._columns) + 1))
+        next(columns) # block size is given by offsets
+        for (name, typecode), column in zip(self._columns, columns):
+            setattr(self, name, array(typecode, column))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> bytes:
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        buffer = self.buffer
+        offsets = self.offsets
+        for i in range(len(offsets) - 1):
+            yield buffer[offsets[i]:offsets[i + 1]]
+
+    def get_tags(self,
+                 tags: Iterable[bytes],
+                 defaults: Iterable,
+                 typecodes: Union[str, Iterable[Optional[str]]] = "i",
+                 ) -> Tuple:
+        """Extract tags from every alignment in the batch as columns
+
+        Each alignment's tags are walked once for all the requested tags
+        (see pylazybam.tags.get_tags).
+
+        Parameters
+        ----------
+            tags : Iterable[bytes]
+                the two byte tags to be returned eg [b'AS', b'XS', b'NM']
+
+            defaults : Iterable
+                the value used for each tag when it is absent, in the same
+                order as tags eg [MIN32INT, MIN32INT, -1]
+
+            typecodes : str or Iterable[Optional[str]]
+                the array.array typecode of each column, or a single typecode
+                for all columns (default 'i'). NumPy accepts the same
+                typecodes as dtypes. A typecode of None returns the column
+                as a list, for string and array valued tags.
+
+        Returns
+        -------
+            Tuple
+                a column for each tag, with one value per alignment
+
+        Notes
+        -----
+        As for the fixed length columns, typed columns are NumPy arrays if
+        NumPy is installed and array.array objects otherwise.
+        """
+        tags = tuple(tags)
+        defaults = tuple(defaults)
+        if isinstance(typecodes, str):
+            typecodes = (typecodes,) * len(tags)
+        else:
+            typecodes = tuple(typecodes)
+        if not len(tags) == len(defaults) == len(typecodes):
+            raise ValueError("Give a default and typecode for each tag")
+        buffer = self.buffer
+        offsets = self.offsets
+        starts = (offsets[i] + 36 + len_read_name + 4 * n_cigar
+                  + (len_sequence + 1) // 2 + len_sequence
+                  for i, len_read_name, n_cigar, len_sequence
+                  in zip(range(len(self)), self.len_read_name.tolist(),
+                         self.number_cigar_operations.tolist(),
+                         self.len_sequence.tolist()))
+        rows = [get_tags(buffer[start:offsets[i + 1]], tags, defaults)
+                for i, start in enumerate(starts)]
+        columns: Iterator[tuple]
+        if rows:
+            columns = zip(*rows)
+        else:
+            columns = iter([()] * len(tags))
+        if _numpy is not None:
+            return tuple(list(column) if typecode is None
+                         else _numpy.array(column, dtype=typecode)
+                         for typecode, column in zip(typecodes, columns))
+        return tuple(list(column) if typecode is None
+                     else array(typecode, column)
+                     for typecode, column in zip(typecodes, columns))
+
+
 class FileReader(_FileBase):
     """A Pure Python Lazy Bam Parser Class
 
     Parameters
     ----------
-        ubam : BinaryIO
-            An binary (bytes) file or stream containing a valid uncompressed
-            bam file conforming to the specification.
+        ubam : str, Path or BinaryIO
+            A path to, or a binary (bytes) file or stream containing, a valid
+            bam file conforming to the specification. BGZF compressed input
+            (a standard bam file) is detected from the magic bytes and
+            decompressed with pylazybam.bgzf.BgzfReader. Uncompressed input,
+            such as a stream from gzip.open, is read directly.
+
+        threads : int
+            The number of threads used to decompress BGZF blocks (default 1)
+
+        chunk_size : int
+            The number of decompressed bytes read from the file at a time
+            when iterating over alignments (default 4MB)
+
+        zero_copy : bool
+            Yield alignments as memoryview slices of the shared chunk buffer
+            rather than as bytes copies (default False). All pylazybam
+            functions accept memoryview alignments and slicing one does not
+            copy the data.
+
+        use_mmap : bool
+            Memory map BGZF compressed input and parse blocks directly from
+            the mapping (default False). Requires a local file.
+
+        max_cache : int
+            The number of decompressed BGZF blocks cached by the
+            BgzfReader (default 100). Reading straight through a file
+            needs only 1.
 
     Yields
     ------
-        align : bytes
+        align : bytes or memoryview
             A byte string of a bam alignment entry in raw binary format
 
     Attributes
@@ -582,9 +859,15 @@ class FileReader(_FileBase):
         header : str
             The ASCII representation of the header
 
+        index : BaiIndex
+            The BAI index used by fetch, or None if not yet loaded
+
         index_to_ref : Dict[int:str]
             A dictionary mapping bam reference numeric identifiers to names
 
+        name : str
+            The path of the bam file if known, otherwise None
+
         raw_header : bytes
             The raw bytestring representing the bam header
 
@@ -612,17 +895,10 @@ class FileReader(_FileBase):
 
     Example
     -------
-        This class requires an uncompressed bam file as input.
-        For this example we will use gzip to decompress the test file included
-        as a resource in the package
+        A bam filereader object can be created from the path to a bam file
+        and headers inspected
 
-        >>> import gzip
-        >>> from pkg_resources import resource_stream
-        >>> ubam = gzip.open('/tests/data/paired_end_testdata_human.bam'))
-
-        A bam filereader object can then be created and headers inspected
-
-        >>> mybam = bam.FileReader(ubam)
+        >>> mybam = bam.FileReader('tests/data/paired_end_testdata_human.bam')
         >>> print(mybam.header)
 
         The filereader object is an iterator and yields alignments in raw format
@@ -637,14 +913,38 @@ class FileReader(_FileBase):
 
     """
 
-    def __init__(self, ubam: BinaryIO):
-        self._ubam = ubam
+    def __init__(self,
+                 ubam: Union[str, Path, BinaryIO],
+                 threads: int = 1,
+                 chunk_size: int = 4 * 1024 * 1024,
+                 zero_copy: bool = False,
+                 use_mmap: bool = False,
+                 max_cache: int = 100,
+                 ):
+        self.chunk_size = chunk_size
+        self.zero_copy = zero_copy
+        if isinstance(ubam, (str, Path)):
+            self.name: Optional[str] = str(ubam)
+            ubam = open(ubam, 'rb')
+        else:
+            self.name = getattr(ubam, 'name', None)
+        self.index: Optional[BaiIndex] = None
+        if _peek_magic(ubam) == _bgzf_magic:
+            self._bgzf: Optional[BgzfReader] = BgzfReader(mode="rb",
+                                                          fileobj=ubam,
+                                                          threads=threads,
+                                                          use_mmap=use_mmap,
+                                                          max_cache=max_cache)
+            self._ubam: Union[BgzfReader, BinaryIO] = self._bgzf
+        else:
+            self._bgzf = None
+            self._ubam = ubam
         self.magic = self._ubam.read(4)
         if self.magic != b"BAM\x01":
             raise ValueError(
-                (f"Incorrect start to uncompressed bam: {self.magic} "
-                "not b'BAM\x01'. Check the file has been decompressed "
-                "before being passed to this class")
+                (f"Incorrect start to uncompressed bam: {self.magic!r} "
+                "not b'BAM\x01'. Check the file is a BGZF compressed "
+                "or uncompressed bam file")
             )
         self.raw_header, self.header = self._read_header()
         self.raw_refs, self.refs = self._read_refs()
@@ -659,7 +959,8 @@ class FileReader(_FileBase):
             self._start_of_alignments = self._ubam.tell()
         else: #pragma: no cover
             self._start_of_alignments = None
-        self.alignments: Generator[bytes, None, None] = self._get_alignments()
+        self.alignments: Generator[Union[bytes, memoryview],
+                                   None, None] = self._get_alignments()
 
     def __enter__(self):
         """Return self for use in WITH statement."""
@@ -708,17 +1009,40 @@ class FileReader(_FileBase):
                              )
         return (ref_buffer, refs)
 
-    def _get_alignments(self) -> Generator[bytes, None, None]:
-        """utility function to create an alignment generator"""
-        while self._ubam:
-            raw_blocksize = self._ubam.read(4)
-            if not raw_blocksize:
+    def _get_alignments(self) -> Generator[Union[bytes, memoryview],
+                                           None, None]:
+        """utility function to create an alignment generator
+
+        Reads chunk_size bytes at a time and yields each complete record
+        in the chunk. Only a record straddling the end of a chunk is
+        carried over and joined to the start of the next chunk.
+        In zero_copy mode the records are memoryview slices of the chunk,
+        which stays alive for as long as any of its records are referenced.
+        """
+        read = self._ubam.read
+        unpack_from = struct.Struct("<i").unpack_from
+        chunk_size = self.chunk_size
+        zero_copy = self.zero_copy
+        buffer = b""
+        while True:
+            data = read(chunk_size)
+            if not data:
+                if buffer:
+                    raise ValueError(f"Truncated alignment of {len(buffer)} "
+                                     f"bytes at the end of the file")
                 break
-            block_size = struct.unpack("<i", raw_blocksize)[0]
-            alignment = raw_blocksize + self._ubam.read(
-                block_size
-            )  # add back size so alignment record intact
-            yield alignment
+            buffer = buffer + data if buffer else data
+            records = memoryview(buffer) if zero_copy else buffer
+            end = len(buffer)
+            pos = 0
+            while pos + 4 <= end:
+                # the block size does not include the 4 byte size field
+                next_pos = pos + 4 + unpack_from(buffer, pos)[0]
+                if next_pos > end:
+                    break
+                yield records[pos:next_pos]
+                pos = next_pos
+            buffer = buffer[pos:]
 
     def __iter__(self):
         return self
@@ -726,39 +1050,322 @@ class FileReader(_FileBase):
     def __next__(self):
         return next(self.alignments)
 
+    def iter_batches(self, n: int = 10000
+                     ) -> Generator[AlignmentBatch, None, None]:
+        """Yield the remaining alignments in batches with columnar fields
+
+        Parameters
+        ----------
+        n : int
+            The maximum number of alignments in each batch (default 10000)
+
+        Yields
+        ------
+        AlignmentBatch
+            Up to n alignments with the fixed length fields as arrays
+
+        Notes
+        -----
+        Batches are taken from the same alignment iterator as next(), so
+        iteration by alignment and by batch can be mixed.
+        """
+        while True:
+            batch = AlignmentBatch(islice(self.alignments, n))
+            if not len(batch):
+                return
+            yield batch
+
+    def _check_name_grouped(self) -> None:
+        """Raise a ValueError unless the header declares name grouping"""
+        if not (self.sort_order == "queryname"
+                or re.search(b'^@HD\t[^\n]*GO:query', self.raw_header[4:])):
+            raise ValueError(
+                f"Alignments are not sorted or grouped by read name "
+                f"(SO:{self.sort_order}). Use check_sort=False if the "
+                f"file is known to be grouped by read name"
+            )
+
+    def iter_name_groups(self, check_sort: bool = True
+                         ) -> Generator[List[Union[bytes, memoryview]],
+                                        None, None]:
+        """Yield the remaining alignments in groups sharing a read name
+
+        Parameters
+        ----------
+        check_sort : bool
+            Raise a ValueError unless the header declares the file sorted
+            by read name (SO:queryname) or grouped by read name
+            (GO:query). Set to False for files that are grouped by name
+            without declaring it, such as aligner output (default True)
+
+        Yields
+        ------
+        List[bytes or memoryview]
+            The consecutive alignments with the same read name, eg the
+            two reads of a pair and their secondary alignments
+
+        Raises
+        ------
+        ValueError
+            If check_sort is True and the file is not declared to be
+            sorted or grouped by read name
+
+        Notes
+        -----
+        The read name of each alignment is compared in place with the name
+        of the first alignment in the group, without slicing a new name
+        from every alignment. Groups are taken from the same alignment
+        iterator as next().
+        """
+        if check_sort:
+            self._check_name_grouped()
+        group: List[Union[bytes, memoryview]] = []
+        name = b""
+        name_end = 0
+        for alignment in self.alignments:
+            # the name is NUL terminated, so a matching prefix is the
+            # whole name
+            if isinstance(alignment, bytes):
+                same_name = alignment.startswith(name, 36)
+            else:
+                same_name = alignment[36:name_end] == name
+            if same_name and group:
+                group.append(alignment)
+                continue
+            if group:
+                yield group
+            group = [alignment]
+            name_end = 36 + alignment[12]
+            name = bytes(alignment[36:name_end])
+        if group:
+            yield group
+
+    def load_index(self, index: Union[str, Path, BinaryIO, None] = None):
+        """Load a BAI index for region queries with fetch
+
+        Parameters
+        ----------
+        index : str, Path or BinaryIO
+            A path to, or binary file object containing, a BAI index
+            Default : the path of the bam file with .bai appended
+        """
+        if index is None:
+            if not self.name:
+                raise ValueError('An index must be provided when the bam '
+                                 'file was not opened from a path')
+            index = self.name + '.bai'
+        self.index = BaiIndex(index)
+
+    def fetch(self,
+              ref: Union[str, int],
+              start: int = 0,
+              end: Optional[int] = None,
+              ) -> Generator[bytes, None, None]:
+        """Yield the alignments overlapping a region of a sorted bam file
+
+        Parameters
+        ----------
+        ref : str or int
+            The reference name, or the zero based rank of the reference
+            in the BAM header
+
+        start : int
+            The zero based start of the region (default 0)
+
+        end : int
+            The zero based, exclusive, end of the region
+            Default : the end of the reference
+
+        Yields
+        ------
+        align : bytes
+            A byte string of a bam alignment entry in raw binary format
+
+        Notes
+        -----
+        Requires a BGZF compressed, coordinate sorted bam file and an index.
+        If load_index has not been called the index is loaded from the
+        default location.
+
+        Fetching moves the file position, so call reset_alignments before
+        iterating over the whole file again.
+        """
+        if self._bgzf is None:
+            raise NotImplementedError('fetch requires BGZF compressed input')
+        if self.index is None:
+            self.load_index()
+        index = self.index
+        assert index is not None
+        ref_index = self.ref_to_index[ref] if isinstance(ref, str) else ref
+        if end is None:
+            end = self.refs[self.index_to_ref[ref_index]]
+        bgzf = self._bgzf
+        for chunk_start, chunk_end in index.query(ref_index, start, end):
+            bgzf.seek(chunk_start)
+            while bgzf.tell() < chunk_end:
+                raw_blocksize = bgzf.read(4)
+                if len(raw_blocksize) < 4:
+                    break
+                block_size = struct.unpack("<i", raw_blocksize)[0]
+                alignment = raw_blocksize + bgzf.read(block_size)
+                if (get_ref_index(alignment) != ref_index
+                        or get_pos(alignment) >= end):
+                    return
+                if get_reference_end(alignment) > start:
+                    yield alignment
+
+    def iter_blocks(self) -> Generator[Tuple[Optional[bytes],
+                                             List[Union[bytes, memoryview]]],
+                                       None, None]:
+        """Yield the alignments with the compressed BGZF block holding them
+
+        Yields
+        ------
+        Tuple[bytes or None, List[bytes or memoryview]]
+            The raw compressed BGZF block and the alignments in it, for
+            blocks that start and end on an alignment boundary. For other
+            blocks the raw block is None, and the alignments are those that
+            end in the block.
+
+        Raises
+        ------
+        NotImplementedError
+            If the input is not BGZF compressed
+
+        Notes
+        -----
+        A raw block can be passed to FileWriter.copy_block with its
+        alignments to write them without decompressing and recompressing
+        the block. Files written by htslib (eg samtools) start a new block
+        rather than split an alignment across blocks, so almost every block
+        can be copied.
+
+        Iteration starts from the first alignment independently of next(),
+        and moves the file position, so call reset_alignments before
+        iterating over the file again.
+        """
+        if self._bgzf is None:
+            raise NotImplementedError('iter_blocks requires BGZF compressed '
+                                      'input')
+        unpack_from = struct.Struct("<i").unpack_from
+        zero_copy = self.zero_copy
+        block_start = self._start_of_alignments >> 16
+        within = self._start_of_alignments & 0xffff
+        # the remainder of an alignment split across blocks
+        buffer = b""
+        for raw, data in self._bgzf.raw_blocks(block_start):
+            if within:
+                # the end of the header shares the first block
+                data = data[within:]
+                raw = None
+                within = 0
+            if not data:
+                continue
+            aligned = not buffer
+            buffer = buffer + data if buffer else data
+            records = memoryview(buffer) if zero_copy else buffer
+            end = len(buffer)
+            pos = 0
+            alignments = []
+            while pos + 4 <= end:
+                next_pos = pos + 4 + unpack_from(buffer, pos)[0]
+                if next_pos > end:
+                    break
+                alignments.append(records[pos:next_pos])
+                pos = next_pos
+            buffer = buffer[pos:]
+            yield (raw if aligned and not buffer else None), alignments
+        if buffer:
+            raise ValueError(f"Truncated alignment of {len(buffer)} "
+                             f"bytes at the end of the file")
+
     def reset_alignments(self):
         """Reset the file pointer to the beginning of the alignment block"""
         if self._start_of_alignments:
             self._ubam.seek(self._start_of_alignments)
+            self.alignments = self._get_alignments()
         else: #pragma: no cover
             raise NotImplementedError('Seek is not implemented for this file')
 
 
 class FileWriter(_FileBase):
+    """A BGZF compressed BAM file writer
+
+    Parameters
+    ----------
+        file : str, Path or BinaryIO
+            A path to the output file or a writable binary file object
+
+        raw_header : bytes
+            The raw bytestring representing the bam header
+
+        raw_refs : bytes
+            The raw bytestring representing the reference sequences
+
+        mode : str
+            The mode used to open the file if a path is given (default 'wb')
+
+        compresslevel : int
+            The zlib compression level for BGZF blocks (default 6)
+
+        threads : int
+            The number of threads used to compress BGZF blocks (default 1)
+            Output is byte identical to single threaded output.
+
+        index : bool or str
+            Build an index of the alignments as they are written and save
+            it when the file is closed. True or 'bai' for a BAI index, or
+            'csi' for a CSI index (required for references over 512Mbp).
+            Alignments must be written one per call to write, in coordinate
+            order. (default False)
+
+        index_path : str or Path
+            The path to save the index to
+            Default : the output path with .bai or .csi appended
+    """
     def __init__(self,
                  file,
                  raw_header = None,
                  raw_refs = None,
                  mode = 'wb',
                  compresslevel = 6,
+                 threads = 1,
+                 index = False,
+                 index_path = None,
                  ):
         if not hasattr(file, 'write'):
             self.bgzf_file = BgzfWriter(filename=Path(file),
                                         mode=mode,
                                         fileobj=None,
                                         compresslevel=compresslevel,
+                                        threads=threads,
+                                        track_blocks=bool(index),
                                         )
             self.name = str(Path(file)) #safe for Path or str
         else:
             self.bgzf_file = BgzfWriter(filename=None,
                                         fileobj=file,
                                         compresslevel=compresslevel,
+                                        threads=threads,
+                                        track_blocks=bool(index),
                                         )
-            self.name = file.name
+            self.name = getattr(file, "name", None)
         self.header_written = False
         self.magic = b"BAM\x01"
         self.raw_header = raw_header
         self.raw_refs = raw_refs
+        if index is True:
+            index = 'bai'
+        if index and index not in ('bai', 'csi'):
+            raise ValueError(f"index must be 'bai' or 'csi' not {index}")
+        if index and index_path is None:
+            if not self.name:
+                raise ValueError('An index_path must be provided when the '
+                                 'file object has no name')
+            index_path = f"{self.name}.{index}"
+        self.index_format = index or None
+        self.index_path = index_path
+        self._index_builder: Optional[IndexBuilder] = None
 
     def write(self, data):
         """
@@ -767,16 +1374,94 @@ class FileWriter(_FileBase):
 
         Parameters
         ----------
-        data : bytes
+        data : bytes or memoryview
             The data to be written to the BAM file
         """
-        return self.bgzf_file.write(data)
+        if self._index_builder is None:
+            return self.bgzf_file.write(data)
+        offset_beg = self.bgzf_file.block_tell()
+        self.bgzf_file.write(data)
+        self._index_builder.push(get_ref_index(data),
+                                 get_pos(data),
+                                 get_reference_end(data),
+                                 not get_flag(data) & 0x4,
+                                 offset_beg,
+                                 self.bgzf_file.block_tell())
+
+    def copy_block(self,
+                   raw_block: bytes,
+                   alignments: Iterable[Union[bytes, memoryview]]) -> None:
+        """
+        Write alignments by copying the compressed BGZF block holding them
+
+        Parameters
+        ----------
+        raw_block : bytes
+            A complete BGZF block whose decompressed data is exactly the
+            alignments, eg from FileReader.iter_blocks
+
+        alignments : Iterable[bytes or memoryview]
+            The alignments in the block, used when building an index
+
+        Notes
+        -----
+        Any buffered data is written as a block of its own first, and the
+        raw block is then written unchanged without being recompressed.
+        """
+        bgzf_file = self.bgzf_file
+        bgzf_file.write_compressed_block(raw_block)
+        if self._index_builder is None:
+            return
+        # offsets of the alignments within the block just written
+        offset = bgzf_file.block_tell() - (1 << 16)
+        for alignment in alignments:
+            offset_end = offset + len(alignment)
+            self._index_builder.push(get_ref_index(alignment),
+                                     get_pos(alignment),
+                                     get_reference_end(alignment),
+                                     not get_flag(alignment) & 0x4,
+                                     offset,
+                                     offset_end)
+            offset = offset_end
 
     def close(self, *args, **kwargs):
         """
         Flush and write any data to the BAM file before finalizing and closing
+
+        If an index is being built it is written to index_path
         """
-        return self.bgzf_file.close(*args,**kwargs)
+        result = self.bgzf_file.close(*args,**kwargs)
+        if self._index_builder is not None:
+            with open(self.index_path, 'wb') as index_file:
+                if self.index_format == 'csi':
+                    self._index_builder.write_csi(
+                        index_file,
+                        resolve=self.bgzf_file.block_to_virtual_offset)
+                else:
+                    self._index_builder.write_bai(
+                        index_file,
+                        resolve=self.bgzf_file.block_to_virtual_offset)
+            self._index_builder = None
+        return result
+
+    def _start_index(self):
+        """Create the index builder for the references in self.raw_refs"""
+        n_ref = struct.unpack_from("<i", self.raw_refs)[0]
+        max_length = 0
+        pos = 4
+        for i in range(n_ref):
+            pos += 4 + struct.unpack_from("<i", self.raw_refs, pos)[0]
+            max_length = max(max_length,
+                             struct.unpack_from("<i", self.raw_refs, pos)[0])
+            pos += 4
+        depth = 5
+        if self.index_format == 'csi':
+            while max_length > 1 << (14 + 3 * depth):
+                depth += 1
+        elif max_length > 1 << 29:
+            raise ValueError('References longer than 512Mbp require a csi '
+                             'index')
+        self._index_builder = IndexBuilder(n_ref, min_shift=14, depth=depth)
 
     def write_header(self,
                      raw_header = None,
@@ -811,6 +1496,8 @@ class FileWriter(_FileBase):
         self.update_header_length()
         self.write(self.magic + self.raw_header + self.raw_refs)
         self.header_written = True
+        if self.index_format:
+            self._start_index()
 
     def __enter__(self):
         """Return self for use in WITH statement."""
@@ -828,3 +1515,386 @@ class FileWriter(_FileBase):
         """Return the seek state of the file"""
         return False
 
+
+
+# Iterating over several files
+
+def queryname_key(name: bytes) -> Tuple:
+    """Sort key for read names in samtools queryname order
+
+    Runs of digits are compared by their numeric value and other
+    characters by their byte value, so b'read:9' sorts before b'read:10'
+    as in files sorted with samtools sort -n.
+
+    Parameters
+    ----------
+    name : bytes
+        A read name, eg from pylazybam.bam.get_raw_read_name()
+
+    Returns
+    -------
+    Tuple
+        A key that orders names in the same way as samtools
+
+    Notes
+    -----
+    The key has an element for each run of digits and for each other
+    byte. Where a digit meets another byte samtools compares the digit
+    character with the byte, and as the byte is not a digit any digit
+    orders the same way, so runs of digits are given the byte value of '0'.
+    """
+    return tuple((0x30, int(run)) if 0x2f < run[0] < 0x3a else (run[0], 0)
+                 for run in re.findall(rb"[0-9]+|[^0-9]", name))
+
+
+def _read_ahead_groups(reader: "FileReader",
+                       check_sort: bool,
+                       groups: "queue.Queue",
+                       stop: threading.Event) -> None:
+    """Put (name, group) tuples from a reader into a queue (PRIVATE)
+
+    Runs on a reader thread for zip_name_groups. Ends with a None, or the
+    exception raised by the reader.
+    """
+    item: object = None
+    try:
+        for group in reader.iter_name_groups(check_sort=check_sort):
+            name = bytes(group[0][36:35 + group[0][12]])
+            while not stop.is_set():
+                try:
+                    groups.put((name, group), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            else:
+                return
+    except Exception as error:
+        item = error
+    while not stop.is_set():
+        try:
+            groups.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def zip_name_groups(readers: Iterable["FileReader"],
+                    key=None,
+                    check_sort: bool = True,
+                    read_ahead: int = 256,
+                    ) -> Generator[Tuple[List[Union[bytes, memoryview]], ...],
+                                   None, None]:
+    """Iterate over several name sorted BAM files in step by read name
+
+    Parameters
+    ----------
+    readers : Iterable[FileReader]
+        Readers of files sorted by read name in the same order, eg the same
+        reads aligned to two genomes
+
+    key : Callable[[bytes], Any]
+        A sort key for the read names (without the trailing NUL) giving the
+        order the files are sorted in. Use pylazybam.bam.queryname_key for
+        files sorted by samtools sort -n (default: None, byte order as used
+        by Picard SortSam)
+
+    check_sort : bool
+        Require each header to declare the file sorted or grouped by read
+        name, and check the read names are in key order (default True)
+
+    read_ahead : int
+        The number of name groups read ahead from each file (default 256)
+
+    Yields
+    ------
+    Tuple[List[bytes or memoryview], ...]
+        For each read name, a tuple with the alignments from each reader
+        with that name. The list is empty for readers without the read.
+
+    Raises
+    ------
+    ValueError
+        If check_sort is True and a header does not declare the file name
+        sorted or grouped, or the read names are not in the order of key
+
+    Notes
+    -----
+    Each reader is read on its own thread with up to read_ahead name groups
+    queued, so reading and BGZF decompression of the files overlaps with
+    processing of the yielded groups. The readers should not be used
+    elsewhere until the iteration is finished.
+
+    Files that are grouped but not sorted by read name, and contain the same
+    reads in the same order (eg from aligning one FASTQ to several genomes),
+    can also be iterated with check_sort=False as long as no reads are
+    missing from any file.
+    """
+    readers = list(readers)
+    stop = threading.Event()
+    queues: List["queue.Queue"] = [queue.Queue(maxsize=read_ahead)
+                                   for reader in readers]
+    threads = [threading.Thread(target=_read_ahead_groups,
+                                args=(reader, check_sort, groups, stop),
+                                daemon=True)
+               for reader, groups in zip(readers, queues)]
+    for thread in threads:
+        thread.start()
+
+    def next_group(i: int) -> Optional[Tuple[bytes, list]]:
+        item = queues[i].get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    try:
+        heads = [next_group(i) for i in range(len(readers))]
+        keys: List[Any]
+        if key is None:
+            keys = [head[0] if head else None for head in heads]
+        else:
+            keys = [key(head[0]) if head else None for head in heads]
+        while True:
+            present = [k for k in keys if k is not None]
+            if not present:
+                return
+            lowest = min(present)
+            groups: List[List[Union[bytes, memoryview]]] = []
+            for i, k in enumerate(keys):
+                head = heads[i]
+                if head is None or k != lowest:
+                    groups.append([])
+                    continue
+                groups.append(head[1])
+                head = heads[i] = next_group(i)
+                if head is None:
+                    keys[i] = None
+                    continue
+                keys[i] = head[0] if key is None else key(head[0])
+                if check_sort and keys[i] < k:
+                    raise ValueError(
+                        f"Read {head[0]!r} is out of order in file {i}. "
+                        f"Files must be sorted by read name in the order "
+                        f"of key"
+                    )
+            yield tuple(groups)
+    finally:
+        stop.set()
+
+
+# Copying between files
+
+def copy_alignments(reader: FileReader,
+                    writer: FileWriter,
+                    keep: Optional[Callable[[Union[bytes, memoryview]],
+                                            bool]] = None,
+                    ) -> int:
+    """Write the alignments of a file, copying unchanged blocks verbatim
+
+    Parameters
+    ----------
+    reader : FileReader
+        The file to read the alignments from
+
+    writer : FileWriter
+        The file to write the alignments to. The header must already have
+        been written
+
+    keep : Callable[[bytes], bool]
+        A function returning True for the alignments to write
+        (default: None, write every alignment)
+
+    Returns
+    -------
+    int
+        The number of alignments written
+
+    Notes
+    -----
+    For BGZF compressed input, when every alignment in a block is kept and
+    the block starts and ends on alignment boundaries the compressed block
+    is copied to the output without decompressing and recompressing it
+    (see FileReader.iter_blocks). Filters keeping most alignments of
+    files written by htslib are then limited by I/O rather than by
+    compression. Other blocks are written alignment by alignment.
+
+    BGZF compressed input is read from the first alignment, and for
+    uncompressed input the remaining alignments of reader are written.
+    """
+    written = 0
+    if reader._bgzf is None:
+        for alignment in reader:
+            if keep is None or keep(alignment):
+                writer.write(alignment)
+                written += 1
+        return written
+    for raw, alignments in reader.iter_blocks():
+        if keep is not None:
+            kept = [alignment for alignment in alignments if keep(alignment)]
+        else:
+            kept = alignments
+        if raw is not None and len(kept) == len(alignments):
+            writer.copy_block(raw, kept)
+        else:
+            for alignment in kept:
+                writer.write(alignment)
+        written += len(kept)
+    return written
+
+
+def reheader(in_path: Union[str, Path],
+             out_path: Union[str, Path],
+             raw_header: bytes,
+             raw_refs: Optional[bytes] = None,
+             compresslevel: int = 6,
+             ) -> None:
+    """Copy a BAM file with a new header without recompressing alignments
+
+    Parameters
+    ----------
+    in_path : str or Path
+        The path to a BGZF compressed BAM file
+
+    out_path : str or Path
+        The path to write the new BAM file to
+
+    raw_header : bytes
+        The new raw header, with the length of the SAM text header
+        followed by the text as in FileReader.raw_header. The length is
+        corrected if the text has been edited.
+
+    raw_refs : bytes
+        The new raw reference sequences, which must have the same
+        references in the same order (default: None, those of in_path)
+
+    compresslevel : int
+        The compression level of the new header block (default 6)
+
+    Raises
+    ------
+    NotImplementedError
+        If the input is not BGZF compressed
+
+    ValueError
+        If in_path and out_path are the same file
+
+    Notes
+    -----
+    Only the header is compressed. The BGZF blocks holding alignments are
+    copied byte for byte, except for the block shared by the end of the
+    header and the first alignments, whose alignments are recompressed with
+    the new header.
+
+    The virtual offsets of the alignments change, so the output needs a new
+    index if the input was indexed.
+
+    Example
+    -------
+        Add a @PG line to the header of a file
+
+        >>> with bam.FileReader('in.bam') as mybam:
+        >>>     raw_header = mybam.get_updated_header('myscript', 'myscript',
+        >>>                                           '1.0')
+        >>> bam.reheader('in.bam', 'out.bam', raw_header)
+    """
+    if Path(in_path).resolve() == Path(out_path).resolve():
+        raise ValueError("reheader can not write to the input file")
+    with FileReader(in_path) as reader:
+        if reader._bgzf is None:
+            raise NotImplementedError('reheader requires BGZF compressed '
+                                      'input')
+        start = reader._start_of_alignments
+        if raw_refs is None:
+            raw_refs = reader.raw_refs
+    with FileWriter(out_path, raw_header=raw_header, raw_refs=raw_refs,
+                    compresslevel=compresslevel) as writer:
+        writer.write_header()
+        _copy_alignment_blocks(in_path, start, writer)
+
+
+def _copy_alignment_blocks(path: Union[str, Path],
+                           start: int,
+                           writer: FileWriter) -> None:
+    """Copy the BGZF blocks of alignments from start to a writer (PRIVATE)
+
+    Only a block shared by the end of the header and the first alignments
+    is decompressed, and its alignments are written through the writer
+    buffer. Empty blocks, eg the EOF marker, are not copied.
+    """
+    with open(path, 'rb') as handle:
+        blocks = _iter_raw_bgzf_blocks(handle, start >> 16)
+        if start & 0xffff:
+            for raw, deflated, expected_crc, expected_size in blocks:
+                writer.write(_inflate_bgzf_block(deflated, expected_crc,
+                                                 expected_size)
+                             [start & 0xffff:])
+                break
+        for raw, deflated, expected_crc, expected_size in blocks:
+            if expected_size:
+                writer.copy_block(raw, ())
+
+
+def concat(output: Union[str, Path],
+           inputs: Iterable[Union[str, Path]],
+           check_header: bool = True,
+           compresslevel: int = 6,
+           ) -> None:
+    """Concatenate BAM files without recompressing their alignments
+
+    Parameters
+    ----------
+    output : str or Path
+        The path to write the concatenated BAM file to
+
+    inputs : Iterable[str or Path]
+        The paths of BGZF compressed BAM files with the same references,
+        eg the parts of a file processed in parallel. The alignments are
+        written in the order of the inputs.
+
+    check_header : bool
+        Require the SAM text headers of the inputs to be identical
+        (default True). If False the header of the first input is used.
+
+    compresslevel : int
+        The compression level of the header block (default 6)
+
+    Raises
+    ------
+    NotImplementedError
+        If an input is not BGZF compressed
+
+    ValueError
+        If there are no inputs, the references of the inputs differ, or
+        check_header is True and the headers differ
+
+    Notes
+    -----
+    The header is written once, and the header blocks and EOF marker of
+    each input are dropped. The blocks holding alignments are copied byte
+    for byte, except for a block shared by the end of a header and the
+    first alignments of an input, whose alignments are recompressed.
+    """
+    inputs = list(inputs)
+    if not inputs:
+        raise ValueError("concat requires at least one input")
+    starts: List[int] = []
+    for path in inputs:
+        if Path(path).resolve() == Path(output).resolve():
+            raise ValueError("concat can not write to an input file")
+        with FileReader(path) as reader:
+            if reader._bgzf is None:
+                raise NotImplementedError('concat requires BGZF compressed '
+                                          'input')
+            if not starts:
+                raw_header, raw_refs = reader.raw_header, reader.raw_refs
+            elif reader.raw_refs != raw_refs:
+                raise ValueError(f"The references of {path} differ from "
+                                 f"those of {inputs[0]}")
+            elif check_header and reader.raw_header != raw_header:
+                raise ValueError(f"The header of {path} differs from "
+                                 f"that of {inputs[0]}")
+            starts.append(reader._start_of_alignments)
+    with FileWriter(output, raw_header=raw_header, raw_refs=raw_refs,
+                    compresslevel=compresslevel) as writer:
+        writer.write_header()
+        for path, start in zip(inputs, starts):
+            _copy_alignment_blocks(path, start, writer)
@@ -227,8 +227,14 @@ import zlib
 import struct
 
 import codecs
+import mmap
 
+from array import array
 from builtins import open as _open
+from collections import deque, OrderedDict
+from itertools import islice
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
 
 def _as_string(s):
     """Turn byte string or unicode string into a unicode string (PRIVATE)."""
@@ -241,9 +247,10 @@ def _as_string(s):
 def _as_bytes(s):
     """Turn byte string or unicode string into a bytes string (PRIVATE).
 
-    The Python 2 version returns a (byte) string.
+    The Python 2 version returns a (byte) string. Other bytes-like objects,
+    such as bytearray or memoryview, are returned unchanged.
     """
-    if isinstance(s, bytes):
+    if not isinstance(s, str):
         return s
     # Assume it is a unicode string
     # Note ISO-8859-1 aka Latin-1 preserves first 256 chars
@@ -255,6 +262,8 @@ _bgzf_magic = b"\x1f\x8b\x08\x04"
 _bgzf_header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00"
 _bgzf_eof = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
 _bytes_BC = b"BC"
+_uint16 = struct.Struct("<H")
+_uint32 = struct.Struct("<I")
 
 
 def open(filename, mode="rb"):
@@ -419,11 +428,14 @@ def BgzfBlocks(handle):
         data_start += data_len
 
 
-def _load_bgzf_block(handle, text_mode=False):
-    """Load the next BGZF block of compressed data (PRIVATE).
+def _read_bgzf_block(handle):
+    """Read the next BGZF block without decompressing it (PRIVATE).
 
-    Returns a tuple (block size and data), or at end of file
-    will raise StopIteration.
+    Returns a tuple (block size, deflate payload, expected crc, expected
+    uncompressed size), or at end of file will raise StopIteration.
+
+    The payload can be inflated later, possibly on another thread, with
+    _inflate_bgzf_block.
     """
     magic = handle.read(4)
     if not magic:
@@ -452,26 +464,192 @@ def _load_bgzf_block(handle, text_mode=False):
     assert block_size is not None, "Missing BC, this isn't a BGZF file!"
     # Now comes the compressed data, CRC, and length of uncompressed data.
     deflate_size = block_size - 1 - extra_len - 19
-    d = zlib.decompressobj(-15)  # Negative window size means no headers
-    data = d.decompress(handle.read(deflate_size)) + d.flush()
+    deflated = handle.read(deflate_size)
     expected_crc = handle.read(4)
     expected_size = struct.unpack("<I", handle.read(4))[0]
+    return block_size, deflated, expected_crc, expected_size
+
+
+def _parse_bgzf_block(buffer, offset=0):
+    """Parse the BGZF block at offset in a buffer without copying (PRIVATE).
+
+    The buffer is typically a memoryview of a memory mapped file. Returns
+    the same tuple as _read_bgzf_block, but with the deflate payload as a
+    memoryview slice of the buffer. At the end of the buffer will raise
+    StopIteration.
+    """
+    if offset >= len(buffer):
+        raise StopIteration
+    magic = bytes(buffer[offset:offset + 4])
+    if magic != _bgzf_magic:
+        raise ValueError(r"A BGZF (e.g. a BAM file) block should start with "
+                         r"%r, not %r; offset %r"
+                         % (_bgzf_magic, magic, offset))
+    extra_len = _uint16.unpack_from(buffer, offset + 10)[0]
+    extra_end = offset + 12 + extra_len
+    block_size = None
+    position = offset + 12
+    while position < extra_end:
+        subfield_len = _uint16.unpack_from(buffer, position + 2)[0]
+        if buffer[position:position + 2] == _bytes_BC:
+            assert subfield_len == 2, "Wrong BC payload length"
+            assert block_size is None, "Two BC subfields?"
+            block_size = _uint16.unpack_from(buffer, position + 4)[0] + 1
+        position += subfield_len + 4
+    assert position == extra_end, (position - offset - 12, extra_len)
+    assert block_size is not None, "Missing BC, this isn't a BGZF file!"
+    block_end = offset + block_size
+    if block_end > len(buffer):
+        raise ValueError("Truncated BGZF block at offset %i" % offset)
+    deflated = buffer[extra_end:block_end - 8]
+    expected_crc = bytes(buffer[block_end - 8:block_end - 4])
+    expected_size = _uint32.unpack_from(buffer, block_end - 4)[0]
+    return block_size, deflated, expected_crc, expected_size
+
+
+def _iter_raw_bgzf_blocks(handle, start_offset=0, view=None):
+    """Yield complete BGZF blocks without decompressing them (PRIVATE).
+
+    Yields tuples (raw block, deflate payload, expected crc, expected
+    uncompressed size) from the block at start_offset to the end of the
+    file, with the raw block as bytes. The blocks are parsed from view
+    (e.g. a memory map of the file) if given, or otherwise read from
+    handle in large chunks rather than field by field.
+    """
+    if view is not None:
+        buffer = view
+        offset = start_offset
+        eof = True
+    else:
+        handle.seek(start_offset)
+        buffer = b""
+        offset = 0
+        eof = False
+    while True:
+        # a block is at most 65536 bytes, so this much buffered data
+        # always holds the next complete block
+        if not eof and len(buffer) - offset < 65536:
+            data = handle.read(1 << 20)
+            eof = not data
+            buffer = buffer[offset:] + data
+            offset = 0
+        try:
+            block_size, deflated, expected_crc, expected_size = \
+                _parse_bgzf_block(buffer, offset)
+        except StopIteration:
+            return
+        yield (bytes(buffer[offset:offset + block_size]), deflated,
+               expected_crc, expected_size)
+        offset += block_size
+
+
+def _inflate_bgzf_block(deflated, expected_crc, expected_size):
+    """Decompress and check the payload of a BGZF block (PRIVATE).
+
+    zlib releases the GIL while inflating, so this is safe and useful
+    to run on a thread pool.
+    """
+    data = zlib.decompress(deflated, -15)  # Negative window means no headers
     assert expected_size == len(data), \
         "Decompressed to %i, not %i" % (len(data), expected_size)
-    # Should cope with a mix of Python platforms...
-    crc = zlib.crc32(data)
-    if crc < 0:
-        crc = struct.pack("<i", crc)
-    else:
-        crc = struct.pack("<I", crc)
+    crc = struct.pack("<I", zlib.crc32(data) & 0xffffffff)
     assert expected_crc == crc, \
         "CRC is %s, not %s" % (crc, expected_crc)
+    return data
+
+
+def _load_bgzf_block(handle, text_mode=False):
+    """Load the next BGZF block of compressed data (PRIVATE).
+
+    Returns a tuple (block size and data), or at end of file
+    will raise StopIteration.
+    """
+    block_size, deflated, expected_crc, expected_size = \
+        _read_bgzf_block(handle)
+    data = _inflate_bgzf_block(deflated, expected_crc, expected_size)
     if text_mode:
         return block_size, _as_string(data)
     else:
         return block_size, data
 
 
+class BgzfBlockCache(object):
+    """Least recently used cache of decompressed BGZF blocks.
+
+    The cache holds at most max_blocks blocks and, if max_bytes is given,
+    at most max_bytes of decompressed data. When either limit is reached
+    the least recently used blocks are evicted. The hits and misses
+    attributes count lookups with get().
+
+    A cache can be shared between several BgzfReader objects reading the
+    same file, including readers used on different threads.
+
+    >>> cache = BgzfBlockCache(max_blocks=2)
+    >>> cache.put(0, b"first", 10)
+    >>> cache.put(10, b"second", 10)
+    >>> cache.get(0)
+    (b'first', 10)
+    >>> cache.put(20, b"third", 10)
+    >>> cache.get(10) is None
+    True
+    >>> (len(cache), cache.hits, cache.misses)
+    (2, 1, 1)
+    """
+
+    def __init__(self, max_blocks=100, max_bytes=None):
+        """Initialize the class."""
+        if max_blocks < 1:
+            raise ValueError("Use max_blocks with a minimum of 1")
+        self.max_blocks = max_blocks
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._blocks = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, start_offset):
+        """Return the cached (data, raw block length) tuple or None."""
+        with self._lock:
+            block = self._blocks.get(start_offset)
+            if block is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._blocks.move_to_end(start_offset)
+            return block
+
+    def put(self, start_offset, data, block_raw_length):
+        """Add a decompressed block, evicting least recently used blocks."""
+        with self._lock:
+            old = self._blocks.pop(start_offset, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self._blocks[start_offset] = (data, block_raw_length)
+            self.size += len(data)
+            while len(self._blocks) > self.max_blocks or \
+                    (self.max_bytes is not None and self.size > self.max_bytes
+                     and len(self._blocks) > 1):
+                evicted = self._blocks.popitem(last=False)[1]
+                self.size -= len(evicted[0])
+
+    def clear(self):
+        """Remove all blocks and reset the hit and miss counts."""
+        with self._lock:
+            self._blocks.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        """Return the number of cached blocks."""
+        return len(self._blocks)
+
+    def __contains__(self, start_offset):
+        """Return True if the block starting at start_offset is cached."""
+        return start_offset in self._blocks
+
+
 class BgzfReader(object):
     r"""BGZF reader, acts like a read only handle but seek/tell differ.
 
@@ -539,21 +717,61 @@ class BgzfReader(object):
     block can be up to 64kb, the default cache could take up to 6MB of
     RAM. The cache is not important for reading through the file in one
     pass, but is important for improving performance of random access.
+    The least recently used block is evicted when the cache is full.
+
+    Alternatively a BgzfBlockCache can be passed as the cache argument,
+    to limit the cache by size in bytes, to inspect the hit and miss
+    counts, or to share one cache between several readers of the same
+    file (for example a reader for region queries and one for mate
+    lookups). Blocks are cached by their raw start offset, so a cache
+    must only be shared between readers of the same file in the same
+    mode.
+
+    The threads argument enables a read ahead mode for large sequential
+    reads. Compressed blocks are read from the handle ahead of the current
+    position and inflated on a pool of worker threads (zlib releases the
+    GIL while decompressing), while blocks are still returned in file
+    order and tell() and seek() use the same virtual offsets as the
+    single threaded reader. The default of 1 decompresses each block on
+    the calling thread as it is needed.
+
+    >>> handle = BgzfReader("SamBam/ex1.bam", "rb", threads=4)
+    >>> assert 0 == handle.tell()
+    >>> magic = handle.read(4)
+    >>> data = handle.read(65536)
+    >>> assert 1195311108 == handle.tell()
+    >>> handle.close()
+
+    For local files the use_mmap argument memory maps the file, and block
+    headers are parsed directly from the mapping with the compressed data
+    passed to zlib without copying. This avoids the several small reads
+    needed to parse each block header, and makes seeking to a new block
+    only a change of offset. The handle must be a real file with a file
+    descriptor, and can be combined with the threads argument.
+
+    >>> handle = BgzfReader("SamBam/ex1.bam", "rb", use_mmap=True)
+    >>> magic = handle.read(4)
+    >>> data = handle.read(65536)
+    >>> assert 1195311108 == handle.tell()
+    >>> handle.close()
     """
 
-    def __init__(self, filename=None, mode="r", fileobj=None, max_cache=100):
+    def __init__(self, filename=None, mode="r", fileobj=None, max_cache=100,
+                 threads=1, cache=None, use_mmap=False):
         """Initialize the class."""
         # TODO - Assuming we can seek, check for 28 bytes EOF empty block
         # and if missing warn about possible truncation (as in samtools)?
         if max_cache < 1:
             raise ValueError("Use max_cache with a minimum of 1")
+        if threads < 1:
+            raise ValueError("Use threads with a minimum of 1")
         # Must open the BGZF file in binary mode, but we may want to
         # treat the contents as either text or binary (unicode or
         # bytes under Python 3)
         if fileobj:
             assert filename is None
             handle = fileobj
-            assert "b" in handle.mode.lower()
+            assert "b" in getattr(handle, "mode", "b").lower()
         else:
             if "w" in mode.lower() or "a" in mode.lower():
                 raise ValueError("Must use read mode (default), not write or append mode")
@@ -564,10 +782,31 @@ class BgzfReader(object):
         else:
             self._newline = b"\n"
         self._handle = handle
+        if use_mmap:
+            # Raises ValueError (or io.UnsupportedOperation) for streams
+            # without a file descriptor and for empty files
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+        else:
+            self._map = None
+            self._view = None
         self.max_cache = max_cache
-        self._buffers = {}
+        if cache is None:
+            cache = BgzfBlockCache(max_blocks=max_cache)
+        self.cache = cache
         self._block_start_offset = None
         self._block_raw_length = None
+        self.threads = threads
+        if threads > 1:
+            self._executor = ThreadPoolExecutor(max_workers=threads)
+            # Blocks submitted for decompression, in file order, as
+            # (start offset, block size, future) tuples.
+            self._pending = deque()
+            self._read_ahead_depth = 4 * threads
+            self._read_ahead_offset = None
+            self._read_ahead_eof = False
+        else:
+            self._executor = None
         self._load_block(handle.tell())
 
     def _load_block(self, start_offset=None):
@@ -579,34 +818,138 @@ class BgzfReader(object):
         if start_offset == self._block_start_offset:
             self._within_block_offset = 0
             return
-        elif start_offset in self._buffers:
+        cached = self.cache.get(start_offset)
+        if cached is not None:
             # Already in cache
-            self._buffer, self._block_raw_length = self._buffers[start_offset]
+            self._buffer, self._block_raw_length = cached
             self._within_block_offset = 0
             self._block_start_offset = start_offset
             return
-        # Must hit the disk... first check cache limits,
-        while len(self._buffers) >= self.max_cache:
-            # TODO - Implemente LRU cache removal?
-            self._buffers.popitem()
-        # Now load the block
+        # Must hit the disk... now load the block
+        if self._executor is not None:
+            self._block_start_offset = start_offset
+            block_size, self._buffer = self._load_threaded_block(start_offset)
+        else:
+            self._block_start_offset = start_offset
+            try:
+                block_size, self._buffer = self._read_block(start_offset)
+            except StopIteration:
+                # EOF
+                block_size = 0
+                if self._text:
+                    self._buffer = ""
+                else:
+                    self._buffer = b""
+        self._within_block_offset = 0
+        self._block_raw_length = block_size
+        # Finally save the block in our cache,
+        self.cache.put(self._block_start_offset, self._buffer, block_size)
+
+    def _read_block(self, start_offset):
+        """Read and decompress the block at start_offset (PRIVATE).
+
+        Returns a tuple (block size, data), or at end of file will raise
+        StopIteration.
+        """
+        if self._view is not None:
+            block_size, deflated, expected_crc, expected_size = \
+                _parse_bgzf_block(self._view, start_offset)
+            data = _inflate_bgzf_block(deflated, expected_crc, expected_size)
+            if self._text:
+                data = _as_string(data)
+            return block_size, data
         handle = self._handle
-        if start_offset is not None:
+        if handle.tell() != start_offset:
             handle.seek(start_offset)
-        self._block_start_offset = handle.tell()
-        try:
-            block_size, self._buffer = _load_bgzf_block(handle, self._text)
-        except StopIteration:
+        return _load_bgzf_block(handle, self._text)
+
+    def _load_threaded_block(self, start_offset):
+        """Return (block size, data) from the read ahead queue (PRIVATE).
+
+        Blocks queued before start_offset are discarded, and if start_offset
+        is not queued at all (i.e. after a seek) the read ahead is restarted
+        from start_offset.
+        """
+        pending = self._pending
+        if not any(entry[0] == start_offset for entry in pending):
+            for offset, block_size, future in pending:
+                future.cancel()
+            pending.clear()
+            self._read_ahead_offset = start_offset
+            self._read_ahead_eof = False
+        while pending and pending[0][0] != start_offset:
+            pending.popleft()[2].cancel()
+        self._fill_read_ahead()
+        if not pending:
             # EOF
-            block_size = 0
             if self._text:
-                self._buffer = ""
+                return 0, ""
             else:
-                self._buffer = b""
-        self._within_block_offset = 0
-        self._block_raw_length = block_size
-        # Finally save the block in our cache,
-        self._buffers[self._block_start_offset] = self._buffer, block_size
+                return 0, b""
+        offset, block_size, future = pending.popleft()
+        self._fill_read_ahead()
+        data = future.result()
+        if self._text:
+            data = _as_string(data)
+        return block_size, data
+
+    def _fill_read_ahead(self):
+        """Submit raw blocks for decompression up to the depth (PRIVATE)."""
+        handle = self._handle
+        pending = self._pending
+        while not self._read_ahead_eof and \
+                len(pending) < self._read_ahead_depth:
+            offset = self._read_ahead_offset
+            try:
+                if self._view is not None:
+                    block_size, deflated, expected_crc, expected_size = \
+                        _parse_bgzf_block(self._view, offset)
+                else:
+                    if handle.tell() != offset:
+                        handle.seek(offset)
+                    block_size, deflated, expected_crc, expected_size = \
+                        _read_bgzf_block(handle)
+            except StopIteration:
+                self._read_ahead_eof = True
+                break
+            future = self._executor.submit(_inflate_bgzf_block,
+                                           deflated,
+                                           expected_crc,
+                                           expected_size)
+            pending.append((offset, block_size, future))
+            self._read_ahead_offset = offset + block_size
+
+    def raw_blocks(self, start_offset):
+        """Yield each block from start_offset with its decompressed data.
+
+        Yields (raw block, data) tuples, where raw block is the complete
+        compressed BGZF block as bytes, so it can be copied to another
+        BGZF file unchanged. Reading starts at the raw start_offset of a
+        block and continues to the end of the file, independently of the
+        position used by read(). With threads the blocks are decompressed
+        ahead on the thread pool.
+        """
+        blocks = _iter_raw_bgzf_blocks(self._handle, start_offset,
+                                       self._view)
+        pending = deque()
+        depth = self._read_ahead_depth if self._executor is not None else 1
+        while True:
+            for raw, deflated, expected_crc, expected_size in \
+                    islice(blocks, depth - len(pending)):
+                if self._executor is None:
+                    pending.append((raw, _inflate_bgzf_block(deflated,
+                                                             expected_crc,
+                                                             expected_size)))
+                else:
+                    pending.append((raw, self._executor.submit(
+                        _inflate_bgzf_block, deflated, expected_crc,
+                        expected_size)))
+            if not pending:
+                return
+            raw, data = pending.popleft()
+            if self._executor is not None:
+                data = data.result()
+            yield raw, data
 
     def tell(self):
         """Return a 64-bit unsigned BGZF virtual offset."""
@@ -665,18 +1008,24 @@ class BgzfReader(object):
             return data
         else:
             data = self._buffer[self._within_block_offset:]
+            pieces = [data]
             size -= len(data)
-            self._load_block()  # will reset offsets
-            # TODO - Test with corner case of an empty block followed by
-            # a non-empty block
-            if not self._buffer:
-                return data  # EOF
-            elif size:
-                # TODO - Avoid recursion
-                return data + self.read(size)
-            else:
-                # Only needed the end of the last block
-                return data
+            while True:
+                self._load_block()  # will reset offsets
+                if not self._buffer:
+                    if self._block_raw_length:
+                        # Empty block (e.g. an EOF marker) before more data
+                        continue
+                    break  # EOF
+                elif size <= len(self._buffer):
+                    # This may only need the end of the last block
+                    pieces.append(self._buffer[:size])
+                    self._within_block_offset = size
+                    break
+                else:
+                    pieces.append(self._buffer)
+                    size -= len(self._buffer)
+            return data[:0].join(pieces)
 
     def readline(self):
         """Read a single line for the BGZF file."""
@@ -723,10 +1072,26 @@ class BgzfReader(object):
 
     def close(self):
         """Close BGZF file."""
+        if self._executor is not None:
+            for offset, block_size, future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._map is not None:
+            self._view.release()
+            self._view = None
+            try:
+                self._map.close()
+            except BufferError:
+                # A payload slice is still referenced; the mapping is
+                # closed when it is garbage collected
+                pass
+            self._map = None
         self._handle.close()
         self._buffer = None
         self._block_start_offset = None
-        self._buffers = None
+        self.cache = None
 
     def seekable(self):
         """Return True indicating the BGZF supports random access."""
@@ -749,11 +1114,66 @@ class BgzfReader(object):
         self.close()
 
 
+def _compress_bgzf_block(block, compresslevel=6):
+    """Compress data into a single complete BGZF block (PRIVATE).
+
+    zlib releases the GIL while compressing, so this is safe and useful
+    to run on a thread pool.
+    """
+    assert len(block) <= 65536
+    # Giving a negative window bits means no gzip/zlib headers,
+    # -15 used in samtools
+    c = zlib.compressobj(compresslevel,
+                         zlib.DEFLATED,
+                         -15,
+                         zlib.DEF_MEM_LEVEL,
+                         0)
+    compressed = c.compress(block) + c.flush()
+    del c
+    assert len(compressed) < 65536, \
+        "TODO - Didn't compress enough, try less data in this block"
+    bsize = struct.pack("<H", len(compressed) + 25)  # includes -1
+    crc = struct.pack("<I", zlib.crc32(block) & 0xffffffff)
+    uncompressed_length = struct.pack("<I", len(block))
+    # Fixed 16 bytes,
+    # gzip magic bytes (4) mod time (4),
+    # gzip flag (1), os (1), extra length which is six (2),
+    # sub field which is BC (2), sub field length of two (2),
+    # Variable data,
+    # 2 bytes: block length as BC sub field (2)
+    # X bytes: the data
+    # 8 bytes: crc (4), uncompressed data length (4)
+    return _bgzf_header + bsize + compressed + crc + uncompressed_length
+
+
 class BgzfWriter(object):
-    """Define a BGZFWriter object."""
+    """Define a BGZFWriter object.
+
+    The threads argument enables parallel compression. Each full block is
+    queued to a pool of deflate workers and the compressed blocks are
+    written to the handle in order, so the output is identical to the
+    single threaded output at the same compresslevel. At most max_queue
+    blocks (default four per thread) are held in memory awaiting
+    compression or writing before write() blocks to drain the queue.
+
+    Calling tell() or flush() waits for all queued blocks to be written,
+    as the virtual offset depends on the compressed size of every
+    preceding block.
+
+    With track_blocks=True the raw start offset of every block is kept so
+    that block_tell() can be used in place of tell() without waiting for
+    the queue. block_tell() returns a block offset, which has the same
+    form as a virtual offset but with the block number in place of the
+    raw file offset, and so orders the same way. After the blocks have
+    been written block offsets are converted to virtual offsets with
+    block_to_virtual_offset().
+    """
 
-    def __init__(self, filename=None, mode="w", fileobj=None, compresslevel=6):
+    def __init__(self, filename=None, mode="w", fileobj=None, compresslevel=6,
+                 threads=1, max_queue=None, track_blocks=False):
         """Initilize the class."""
+        if threads < 1:
+            raise ValueError("Use threads with a minimum of 1")
         if fileobj:
             assert filename is None
             handle = fileobj
@@ -766,44 +1186,70 @@ class BgzfWriter(object):
                 handle = _open(filename, "wb")
         self._text = "b" not in mode.lower()
         self._handle = handle
-        self._buffer = b""
+        self._buffer = bytearray()
         self.compresslevel = compresslevel
+        self.threads = threads
+        if threads > 1:
+            self._executor = ThreadPoolExecutor(max_workers=threads)
+            self._pending = deque()
+            if max_queue is None:
+                max_queue = 4 * threads
+            if max_queue < 1:
+                raise ValueError("Use max_queue with a minimum of 1")
+            self.max_queue = max_queue
+        else:
+            self._executor = None
+        self._blocks = 0
+        if track_blocks:
+            self._block_starts = array("Q")
+        else:
+            self._block_starts = None
+
+    def _write_raw_block(self, data):
+        """Write an already compressed BGZF block to the handle (PRIVATE)."""
+        if self._block_starts is not None:
+            self._block_starts.append(self._handle.tell())
+        self._handle.write(data)
 
     def _write_block(self, block):
         """Write provided data to file as a single BGZF compressed block (PRIVATE)."""
         # print("Saving %i bytes" % len(block))
-        start_offset = self._handle.tell()
-        assert len(block) <= 65536
-        # Giving a negative window bits means no gzip/zlib headers,
-        # -15 used in samtools
-        c = zlib.compressobj(self.compresslevel,
-                             zlib.DEFLATED,
-                             -15,
-                             zlib.DEF_MEM_LEVEL,
-                             0)
-        compressed = c.compress(block) + c.flush()
-        del c
-        assert len(compressed) < 65536, \
-            "TODO - Didn't compress enough, try less data in this block"
-        crc = zlib.crc32(block)
-        # Should cope with a mix of Python platforms...
-        if crc < 0:
-            crc = struct.pack("<i", crc)
-        else:
-            crc = struct.pack("<I", crc)
-        bsize = struct.pack("<H", len(compressed) + 25)  # includes -1
-        crc = struct.pack("<I", zlib.crc32(block) & 0xffffffff)
-        uncompressed_length = struct.pack("<I", len(block))
-        # Fixed 16 bytes,
-        # gzip magic bytes (4) mod time (4),
-        # gzip flag (1), os (1), extra length which is six (2),
-        # sub field which is BC (2), sub field length of two (2),
-        # Variable data,
-        # 2 bytes: block length as BC sub field (2)
-        # X bytes: the data
-        # 8 bytes: crc (4), uncompressed data length (4)
-        data = _bgzf_header + bsize + compressed + crc + uncompressed_length
-        self._handle.write(data)
+        self._blocks += 1
+        if self._executor is None:
+            self._write_raw_block(_compress_bgzf_block(block,
+                                                       self.compresslevel))
+            return
+        while len(self._pending) >= self.max_queue:
+            self._write_raw_block(self._pending.popleft().result())
+        self._pending.append(self._executor.submit(_compress_bgzf_block,
+                                                   block,
+                                                   self.compresslevel))
+
+    def write_compressed_block(self, block):
+        """Write an already compressed BGZF block unchanged.
+
+        Any buffered data is first written as a block of its own, so the
+        compressed block starts at a block boundary of the output. The block
+        is queued behind any blocks still being compressed.
+        """
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._blocks += 1
+        if self._executor is None:
+            self._write_raw_block(block)
+            return
+        while len(self._pending) >= self.max_queue:
+            self._write_raw_block(self._pending.popleft().result())
+        future = Future()
+        future.set_result(bytes(block))
+        self._pending.append(future)
+
+    def _drain(self):
+        """Wait for and write all queued compressed blocks (PRIVATE)."""
+        if self._executor is not None:
+            while self._pending:
+                self._write_raw_block(self._pending.popleft().result())
 
     def write(self, data):
         """Write method for the class."""
@@ -820,15 +1266,16 @@ class BgzfWriter(object):
             self._buffer += data
             while len(self._buffer) >= 65536:
                 self._write_block(self._buffer[:65536])
-                self._buffer = self._buffer[65536:]
+                del self._buffer[:65536]
 
     def flush(self):
         """Flush data explicitally."""
         while len(self._buffer) >= 65536:
             self._write_block(self._buffer[:65535])
-            self._buffer = self._buffer[65535:]
+            del self._buffer[:65535]
         self._write_block(self._buffer)
-        self._buffer = b""
+        self._buffer = bytearray()
+        self._drain()
         self._handle.flush()
 
     def close(self):
@@ -841,14 +1288,39 @@ class BgzfWriter(object):
         """
         if self._buffer:
             self.flush()
-        self._handle.write(_bgzf_eof)
+        self._drain()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._blocks += 1
+        self._write_raw_block(_bgzf_eof)
         self._handle.flush()
         self._handle.close()
 
     def tell(self):
         """Return a BGZF 64-bit virtual offset."""
+        self._drain()
         return make_virtual_offset(self._handle.tell(), len(self._buffer))
 
+    def block_tell(self):
+        """Return the current block offset without waiting for the queue.
+
+        Requires track_blocks=True. See block_to_virtual_offset.
+        """
+        if self._block_starts is None:
+            raise ValueError("Block offsets require track_blocks=True")
+        return (self._blocks << 16) | len(self._buffer)
+
+    def block_to_virtual_offset(self, block_offset):
+        """Convert a block offset from block_tell() to a virtual offset.
+
+        The block must already have been written to the handle, which is
+        always true after flush() or close().
+        """
+        block_number = block_offset >> 16
+        return (self._block_starts[block_number] << 16) | \
+            (block_offset & 0xffff)
+
     def seekable(self):
         """Return True indicating the BGZF supports random access."""
         # Not seekable, but we do support tell...
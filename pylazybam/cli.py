@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Module      : pylazybam/cli.py
+Description : The lazybam command line interface for streaming BAM filters.
+Copyright   : (c) Matthew Wakefield, 2018-2020
+License     : BSD-3-Clause
+Maintainer  : matthew.wakefield@unimelb.edu.au
+Portability : POSIX
+"""
+
+import argparse
+import gzip
+import os
+import re
+import sys
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from pylazybam import bam, fastq
+from pylazybam.decoders import FLAGS
+from pylazybam.tags import get_tags
+
+
+def _flag_value(text: str) -> int:
+    """Parse a flag mask given as an integer or comma separated flag names
+
+    Integers can be decimal or prefixed hexadecimal (eg 0x900), and names
+    are keys of pylazybam.decoders.FLAGS (eg secondary,supplementary).
+    """
+    try:
+        return int(text, 0)
+    except ValueError:
+        pass
+    mask = 0
+    for name in text.split(","):
+        if name not in FLAGS:
+            raise argparse.ArgumentTypeError(
+                f"{name!r} is not an integer or one of "
+                f"{', '.join(FLAGS)}"
+            )
+        mask |= FLAGS[name]
+    return mask
+
+
+def _tag_threshold(text: str) -> Tuple[bytes, float]:
+    """Parse a TAG:VALUE tag threshold eg AS:100"""
+    match = re.fullmatch(r"([A-Za-z][A-Za-z0-9]):(-?[0-9.]+)", text)
+    if not match:
+        raise argparse.ArgumentTypeError(
+            f"{text!r} is not a tag threshold of the form TAG:VALUE eg AS:100"
+        )
+    try:
+        value = float(match.group(2))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{text!r} has an invalid value")
+    return match.group(1).encode("ascii"), value
+
+
+def _tag_bytes(alignment: bytes) -> bytes:
+    """Return the raw tags of an alignment"""
+    return bam.get_tag_bytestring(alignment,
+                                  bam.get_len_read_name(alignment),
+                                  bam.get_number_cigar_operations(alignment),
+                                  bam.get_len_sequence(alignment))
+
+
+def make_filter(reader: bam.FileReader,
+                require: int = 0,
+                exclude: int = 0,
+                min_mapq: int = 0,
+                refs: Optional[List[str]] = None,
+                min_tags: Optional[List[Tuple[bytes, float]]] = None,
+                max_tags: Optional[List[Tuple[bytes, float]]] = None,
+                ) -> Callable[[bytes], bool]:
+    """Make a function selecting alignments by flag, MAPQ, reference and tags
+
+    Parameters
+    ----------
+    reader : bam.FileReader
+        The file the alignments are read from, used to look up references
+
+    require : int
+        Only keep alignments with all of these flag bits set (default 0)
+
+    exclude : int
+        Discard alignments with any of these flag bits set (default 0)
+
+    min_mapq : int
+        The minimum mapping quality (default 0)
+
+    refs : List[str]
+        Only keep alignments to these references, '*' for unplaced
+        alignments (default None, any reference)
+
+    min_tags : List[Tuple[bytes, float]]
+        Only keep alignments with each tag present and at least the value
+
+    max_tags : List[Tuple[bytes, float]]
+        Only keep alignments with each tag present and at most the value
+
+    Returns
+    -------
+    Callable[[bytes], bool]
+        A function returning True for the alignments to keep
+
+    Raises
+    ------
+    ValueError
+        If a reference is not in the header of the file
+    """
+    ref_indexes = None
+    if refs:
+        unknown = [ref for ref in refs if ref != "*"
+                   and ref not in reader.ref_to_index]
+        if unknown:
+            raise ValueError(f"References not in the header: "
+                             f"{', '.join(unknown)}")
+        ref_indexes = {-1 if ref == "*" else reader.ref_to_index[ref]
+                       for ref in refs}
+    thresholds = ([(tag, value, 1) for tag, value in min_tags or []]
+                  + [(tag, value, -1) for tag, value in max_tags or []])
+    tag_names = [tag for tag, value, sign in thresholds]
+
+    def keep(alignment: bytes) -> bool:
+        flag = bam.get_flag(alignment)
+        if flag & require != require or flag & exclude:
+            return False
+        if min_mapq and bam.get_mapq(alignment) < min_mapq:
+            return False
+        if (ref_indexes is not None
+                and bam.get_ref_index(alignment) not in ref_indexes):
+            return False
+        if thresholds:
+            values = get_tags(_tag_bytes(alignment), tag_names)
+            for (tag, threshold, sign), value in zip(thresholds, values):
+                if (not isinstance(value, (int, float))
+                        or (value - threshold) * sign < 0):
+                    return False
+        return True
+
+    return keep
+
+
+def _open_input(args: argparse.Namespace) -> bam.FileReader:
+    """Open the input BAM file, or stdin for '-', with the requested threads
+    """
+    return bam.FileReader(_input(args.input), threads=args.threads)
+
+
+def _keep(reader: bam.FileReader,
+          args: argparse.Namespace) -> Callable[[bytes], bool]:
+    """Make the filter function for the filter options
+
+    References missing from the header are reported as an
+    argparse.ArgumentError, as they can only be checked once the input is
+    open.
+    """
+    try:
+        return make_filter(reader,
+                           require=args.require,
+                           exclude=args.exclude,
+                           min_mapq=args.min_mapq,
+                           refs=args.ref,
+                           min_tags=args.min_tag,
+                           max_tags=args.max_tag)
+    except ValueError as error:
+        raise argparse.ArgumentError(None, str(error)) from error
+
+
+def _filtered(reader: bam.FileReader, args: argparse.Namespace):
+    """Return the alignments of reader that pass the filter options"""
+    return filter(_keep(reader, args), reader)
+
+
+def _input(path: str) -> Any:
+    """Return a path or stdin for an input argument of '-'
+
+    BgzfReader needs a seekable file, so BGZF compressed stdin is
+    decompressed as a gzip stream and read as an uncompressed bam.
+    """
+    if path != "-":
+        return path
+    stdin = sys.stdin.buffer
+    if stdin.peek(2)[:2] == b"\x1f\x8b":
+        return gzip.GzipFile(fileobj=stdin, mode="rb")
+    return stdin
+
+
+def _output(path: str) -> Any:
+    """Return a path or stdout for an output argument of '-'"""
+    return sys.stdout.buffer if path == "-" else path
+
+
+def view(args: argparse.Namespace) -> None:
+    """Write the alignments that pass the filters to a BAM file
+
+    Blocks in which every alignment passes are copied without being
+    recompressed (see pylazybam.bam.copy_alignments).
+    """
+    with _open_input(args) as reader:
+        keep = _keep(reader, args)
+        with bam.FileWriter(_output(args.output), reader.raw_header,
+                            reader.raw_refs, threads=args.threads,
+                            compresslevel=args.level) as writer:
+            writer.write_header()
+            bam.copy_alignments(reader, writer, keep)
+
+
+def count(args: argparse.Namespace) -> None:
+    """Print the number of alignments that pass the filters"""
+    with _open_input(args) as reader:
+        alignments = _filtered(reader, args)
+        if not args.by_ref:
+            print(sum(1 for alignment in alignments))
+            return
+        counts = Counter(bam.get_ref_index(alignment)
+                         for alignment in alignments)
+        # header order with unplaced alignments ('*') last
+        for ref_index, ref in sorted(reader.index_to_ref.items(),
+                                     key=lambda item: (item[0] < 0, item[0])):
+            if counts[ref_index] or not args.skip_zero:
+                print(f"{ref}\t{counts[ref_index]}")
+
+
+def split(args: argparse.Namespace) -> None:
+    """Write the alignments to a BAM file per reference or tag value
+
+    Every output stays open, with its own compression threads, until the
+    input is finished, so the number of outputs is limited to
+    args.max_outputs.
+    """
+    with _open_input(args) as reader:
+        writers: Dict[str, bam.FileWriter] = {}
+        try:
+            for alignment in _filtered(reader, args):
+                if args.tag:
+                    value = get_tags(_tag_bytes(alignment),
+                                     [args.tag.encode("ascii")])[0]
+                    key = "untagged" if value is None else str(value)
+                else:
+                    ref_index = bam.get_ref_index(alignment)
+                    key = ("unmapped" if ref_index == -1
+                           else reader.index_to_ref[ref_index])
+                if key not in writers:
+                    if len(writers) == args.max_outputs:
+                        raise ValueError(
+                            f"More than {args.max_outputs} output files are "
+                            f"needed. Use --max-outputs to allow more, or "
+                            f"filter the alignments eg with -r"
+                        )
+                    name = re.sub(r"[^\w.+-]", "_", key)
+                    writers[key] = bam.FileWriter(
+                        f"{args.prefix}.{name}.bam", reader.raw_header,
+                        reader.raw_refs, threads=args.threads,
+                        compresslevel=args.level)
+                    writers[key].write_header()
+                writers[key].write(alignment)
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+
+def to_fastq(args: argparse.Namespace) -> None:
+    """Write the alignments that pass the filters to FASTQ"""
+    with _open_input(args) as reader:
+        counts = fastq.write_fastq(_filtered(reader, args),
+                                   _output(args.read1),
+                                   read2=args.read2,
+                                   other=args.other,
+                                   exclude=args.fastq_exclude,
+                                   threads=args.threads,
+                                   compresslevel=args.level)
+    print("\t".join(f"{key}:{value}" for key, value in counts.items()),
+          file=sys.stderr)
+
+
+def _parser() -> argparse.ArgumentParser:
+    """Build the lazybam argument parser"""
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("input", help="a BAM file, or - for stdin")
+    common.add_argument("-@", "--threads", type=int,
+                        default=min(4, os.cpu_count() or 1),
+                        help="threads for BGZF compression and "
+                             "decompression (default: %(default)s)")
+    filters = common.add_argument_group("filters")
+    filters.add_argument("-f", "--require", type=_flag_value, default=0,
+                         metavar="FLAGS",
+                         help="keep alignments with all of these flags, as "
+                              "an integer or names eg paired,read1")
+    filters.add_argument("-F", "--exclude", type=_flag_value, default=0,
+                         metavar="FLAGS",
+                         help="discard alignments with any of these flags "
+                              "eg 0x900 or secondary,supplementary")
+    filters.add_argument("-q", "--min-mapq", type=int, default=0,
+                         metavar="MAPQ", help="minimum mapping quality")
+    filters.add_argument("-r", "--ref", action="append", metavar="REF",
+                         help="keep alignments to this reference, '*' for "
+                              "unplaced alignments. Can be repeated")
+    filters.add_argument("--min-tag", action="append", type=_tag_threshold,
+                         metavar="TAG:VALUE",
+                         help="keep alignments with the tag at least VALUE "
+                              "eg AS:100. Can be repeated")
+    filters.add_argument("--max-tag", action="append", type=_tag_threshold,
+                         metavar="TAG:VALUE",
+                         help="keep alignments with the tag at most VALUE "
+                              "eg NM:4. Can be repeated")
+    compressed = argparse.ArgumentParser(add_help=False)
+    compressed.add_argument("-l", "--level", type=int, default=6,
+                            help="compression level (default: %(default)s)")
+
+    parser = argparse.ArgumentParser(
+        prog="lazybam",
+        description="Streaming filters for BAM files using pylazybam")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+
+    view_parser = subparsers.add_parser(
+        "view", aliases=["filter"], parents=[common, compressed],
+        help="write the alignments that pass the filters to a BAM file")
+    view_parser.add_argument("-o", "--output", default="-",
+                             help="the output BAM file (default: stdout)")
+    view_parser.set_defaults(func=view)
+
+    count_parser = subparsers.add_parser(
+        "count", parents=[common],
+        help="count the alignments that pass the filters")
+    count_parser.add_argument("--by-ref", action="store_true",
+                              help="count the alignments to each reference")
+    count_parser.add_argument("--skip-zero", action="store_true",
+                              help="with --by-ref omit references without "
+                                   "alignments")
+    count_parser.set_defaults(func=count)
+
+    split_parser = subparsers.add_parser(
+        "split", parents=[common, compressed],
+        help="write a BAM file per reference or tag value")
+    split_parser.add_argument("prefix",
+                              help="output files are PREFIX.NAME.bam")
+    split_parser.add_argument("-t", "--tag",
+                              help="split by the value of this tag eg RG "
+                                   "(default: split by reference)")
+    split_parser.add_argument("--max-outputs", type=int, default=128,
+                              metavar="N",
+                              help="the most output files, each open with "
+                                   "its own compression threads, before "
+                                   "stopping with an error "
+                                   "(default: %(default)s)")
+    split_parser.set_defaults(func=split)
+
+    fastq_parser = subparsers.add_parser(
+        "fastq", parents=[common, compressed],
+        help="write the reads that pass the filters to FASTQ")
+    fastq_parser.add_argument("-1", "--read1", default="-",
+                              help="FASTQ for first reads, or all reads "
+                                   "interleaved (default: stdout). Paths "
+                                   "ending in .gz are compressed")
+    fastq_parser.add_argument("-2", "--read2",
+                              help="FASTQ for second reads")
+    fastq_parser.add_argument("-0", "--other",
+                              help="FASTQ for unpaired reads (default: "
+                                   "with -2 they are dropped, otherwise "
+                                   "written with the first reads)")
+    fastq_parser.add_argument("--fastq-exclude", type=_flag_value,
+                              default=FLAGS["secondary"]
+                              | FLAGS["supplementary"],
+                              metavar="FLAGS",
+                              help="flags of alignments that are not reads "
+                                   "(default: secondary,supplementary)")
+    fastq_parser.set_defaults(func=to_fastq)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Run the lazybam command line interface
+
+    Parameters
+    ----------
+    argv : List[str]
+        The command line arguments (default: sys.argv[1:])
+    """
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if args.threads < 1:
+        parser.error("-@/--threads must be at least 1")
+    if getattr(args, "max_outputs", 1) < 1:
+        parser.error("--max-outputs must be at least 1")
+    try:
+        args.func(args)
+    except argparse.ArgumentError as error:
+        parser.error(str(error))
+    except BrokenPipeError:  # pragma: no cover
+        # eg piped to head, silence the error on closing stdout
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+    except (ValueError, EOFError, OSError) as error:
+        # bad or truncated input, not a usage error
+        print(f"{parser.prog}: error: {error}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
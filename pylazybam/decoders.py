@@ -9,8 +9,9 @@ Maintainer  : matthew.wakefield@unimelb.edu.au
 Portability : POSIX
 """
 
-from array import array
-from typing import Dict
+import struct
+from functools import lru_cache
+from typing import Dict, Optional, Union
 from pylazybam import bam
 
 FLAGS: Dict[str,int] = {
@@ -18,8 +19,12 @@ FLAGS: Dict[str,int] = {
     "aligned": 0x2,
     "unmapped": 0x4,
     "pair_unmapped": 0x8,
+    "reverse_strand": 0x10,
+    "pair_reverse_strand": 0x20,
     "forward": 0x40,
     "reverse": 0x80,
+    "read1": 0x40,
+    "read2": 0x80,
     "secondary": 0x100,
     "qc_fail": 0x200,
     "duplicate": 0x400,
@@ -27,7 +32,12 @@ FLAGS: Dict[str,int] = {
 }
 
 
-def decode_sequence(raw_seq: bytes) -> str:
+# each hexadecimal digit of a packed sequence byte is one base
+_SEQUENCE_TABLE = str.maketrans("0123456789abcdef", "=ACMGRSVTWYHKDBN")
+
+
+def decode_sequence(raw_seq: bytes,
+                    len_sequence: Optional[int] = None) -> str:
     """Decode raw BAM sequence into ASCII values
 
     Parameters
@@ -36,17 +46,26 @@ def decode_sequence(raw_seq: bytes) -> str:
         The sequence section of a BAM alignment record as bytes
         eg the output of pybam.bam.get_raw_sequence()
 
+    len_sequence : int
+        The length of the sequence eg from pylazybam.bam.get_len_sequence
+        If given, the padding base of an odd length sequence is removed
+        (default: None, two bases are returned for every byte)
+
     Returns
     -------
     str
         The ASCII encoded SAM representation of the query sequence
 
+    Notes
+    -----
+    The two four bit bases packed in each byte are the two hexadecimal
+    digits of the byte, so the sequence is decoded by bytes.hex() and a
+    translation table without a Python loop over the bases.
+
     """
-    bam_bases = "=ACMGRSVTWYHKDBN"
-    result = ""
-    for x in array("B", raw_seq):
-        result += bam_bases[x >> 4]
-        result += bam_bases[x & 0b1111]
+    result = raw_seq.hex().translate(_SEQUENCE_TABLE)
+    if len_sequence is not None:
+        return result[:len_sequence]
     return result
 
 
@@ -66,12 +85,20 @@ def decode_cigar(raw_cigar: bytes) -> str:
 
     """
     codes = "MIDNSHP=X"
-    cigar = [str(x >> 4) + codes[x & 0b1111] for x in array("I", raw_cigar)]
+    cigar = [str(x >> 4) + codes[x & 0b1111]
+             for (x,) in struct.iter_unpack("<I", raw_cigar)]
     return "".join(cigar)
 
 
+@lru_cache(maxsize=None)
+def _quality_table(offset: int) -> bytes:
+    """A bytes.translate table adding offset to quality values up to 255"""
+    return bytes(min(q + offset, 255) for q in range(256))
+
+
 def decode_base_qual(raw_base_qual: bytes,
-                     offset: int = 33) -> str:
+                     offset: int = 33,
+                     as_bytes: bool = False) -> Union[str, bytes]:
     """Decode raw BAM base quality scores into ASCII values
 
     Parameters
@@ -83,13 +110,35 @@ def decode_base_qual(raw_base_qual: bytes,
     offset : int
         The offset to add to the quality values when converting to ASCII
 
+    as_bytes : bool
+        Return the encoded qualities as bytes, eg for writing directly to a
+        binary FASTQ file (default: False)
+
     Returns
     -------
-    str
+    str or bytes
         The ASCII encoded SAM representation of the quality scores
 
+    Raises
+    ------
+    ValueError
+        raises a ValueError if as_bytes is True and a quality value plus
+        the offset is more than 255 (eg the 0xff of missing qualities)
+
     """
-    return "".join([chr(q + offset) for q in list(raw_base_qual)])
+    if not isinstance(raw_base_qual, bytes):
+        raw_base_qual = bytes(raw_base_qual)
+    if raw_base_qual and max(raw_base_qual) + offset > 255:
+        if as_bytes:
+            raise ValueError(
+                f"Quality {max(raw_base_qual)} can not be encoded "
+                f"as a byte with offset {offset}"
+            )
+        return "".join([chr(q + offset) for q in raw_base_qual])
+    encoded = raw_base_qual.translate(_quality_table(offset))
+    if as_bytes:
+        return encoded
+    return encoded.decode("latin-1")
 
 
 def is_flag(alignment: bytes, flag: int) -> bool:
@@ -117,13 +166,21 @@ def is_flag(alignment: bytes, flag: int) -> bool:
     "aligned": 0x2,
     "unmapped": 0x4,
     "pair_unmapped": 0x8,
+    "reverse_strand": 0x10,
+    "pair_reverse_strand": 0x20,
     "forward": 0x40,
     "reverse": 0x80,
+    "read1": 0x40,
+    "read2": 0x80,
     "secondary": 0x100,
     "qc_fail": 0x200,
     "duplicate": 0x400,
     "supplementary": 0x800,}
 
+    The "forward" and "reverse" flags are the first and second read of a
+    pair (also available as "read1" and "read2"), not the strand of the
+    alignment, which is given by "reverse_strand".
+
     See https://samtools.github.io/hts-specs/SAMv1.pdf for details.
 
     """
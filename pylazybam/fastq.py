@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Module      : pylazybam/fastq.py
+Description : Streaming export of BAM alignments to FASTQ.
+Copyright   : (c) Matthew Wakefield, 2018-2020
+License     : BSD-3-Clause
+Maintainer  : matthew.wakefield@unimelb.edu.au
+Portability : POSIX
+"""
+
+import struct
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, Optional, Tuple, Union
+from pylazybam.bgzf import BgzfWriter
+from pylazybam.decoders import FLAGS, _quality_table
+
+# l_read_name, n_cigar_op, flag and l_seq from the fixed length section
+_fastq_fields = struct.Struct("<12xBxxxHHi")
+
+# each hexadecimal digit of a packed sequence byte is one base, mapped
+# directly to the base or to its complement
+_FORWARD = str.maketrans("0123456789abcdef", "=ACMGRSVTWYHKDBN")
+_COMPLEMENT = str.maketrans("0123456789abcdef", "=TGKCYSBAWRDMHVN")
+
+_PHRED33 = _quality_table(33)
+
+_EXCLUDE = FLAGS["secondary"] | FLAGS["supplementary"]
+_READ1 = FLAGS["paired"] | FLAGS["read1"]
+_READ2 = FLAGS["paired"] | FLAGS["read2"]
+
+
+def alignment_to_fastq(alignment: bytes,
+                       default_quality: int = 1) -> bytes:
+    """Convert a BAM alignment to a FASTQ record
+
+    Parameters
+    ----------
+    alignment : bytes
+        A byte string of a bam alignment entry in raw binary format
+
+    default_quality : int
+        The quality used for every base when the alignment has no base
+        qualities (default: 1)
+
+    Returns
+    -------
+    bytes
+        The four line FASTQ record, with the read name, sequence and
+        qualities in the orientation of the original read. Reads aligned to
+        the reverse strand are reverse complemented.
+
+    """
+    len_read_name, number_cigar_operations, flag, len_sequence = \
+        _fastq_fields.unpack_from(alignment)
+    name_end = 35 + len_read_name
+    sequence_start = name_end + 1 + 4 * number_cigar_operations
+    qual_start = sequence_start + (len_sequence + 1) // 2
+    qual = bytes(alignment[qual_start:qual_start + len_sequence])
+    if len_sequence and qual[0] == 0xff:
+        qual = bytes((default_quality + 33,)) * len_sequence
+    else:
+        qual = qual.translate(_PHRED33)
+    hex_sequence = alignment[sequence_start:qual_start].hex()
+    if flag & FLAGS["reverse_strand"]:
+        sequence = hex_sequence.translate(_COMPLEMENT)[:len_sequence][::-1]
+        qual = qual[::-1]
+    else:
+        sequence = hex_sequence.translate(_FORWARD)[:len_sequence]
+    return b"".join((b"@", alignment[36:name_end], b"\n",
+                     sequence.encode("ascii"), b"\n+\n", qual, b"\n"))
+
+
+def _open_fastq(target: Union[str, Path, BinaryIO],
+                threads: int,
+                compresslevel: int) -> Tuple[BinaryIO, bool]:
+    """Return a binary handle for a FASTQ target and if it should be closed
+
+    Paths ending in .gz or .bgz are written BGZF compressed, which can be
+    read by any gzip reader.
+    """
+    if isinstance(target, (str, Path)):
+        if Path(target).suffix in (".gz", ".bgz"):
+            return BgzfWriter(filename=str(target), mode="wb",
+                              compresslevel=compresslevel,
+                              threads=threads), True
+        return open(target, "wb"), True
+    return target, False
+
+
+def write_fastq(alignments: Iterable[bytes],
+                read1: Union[str, Path, BinaryIO],
+                read2: Optional[Union[str, Path, BinaryIO]] = None,
+                other: Optional[Union[str, Path, BinaryIO]] = None,
+                exclude: int = _EXCLUDE,
+                default_quality: int = 1,
+                threads: int = 1,
+                compresslevel: int = 6,
+                batch_size: int = 1000,
+                ) -> Dict[str, int]:
+    """Write alignments from a BAM file to FASTQ
+
+    Parameters
+    ----------
+    alignments : Iterable[bytes]
+        Raw BAM alignments, eg a pylazybam.bam.FileReader
+
+    read1 : str, Path or BinaryIO
+        A path or binary handle for the first read of each pair.
+        If read2 is None both reads of a pair are written here interleaved.
+
+    read2 : str, Path or BinaryIO
+        A path or binary handle for the second read of each pair
+        (default: None, interleave with read1)
+
+    other : str, Path or BinaryIO
+        A path or binary handle for unpaired reads, and paired reads that
+        are neither or both of read1 and read2 (default: None, write them
+        to read1 when interleaving, or drop them when read2 is given so
+        the paired files stay in step, as samtools fastq)
+
+    exclude : int
+        Alignments with any of these flag bits are not written
+        (default: secondary and supplementary alignments)
+
+    default_quality : int
+        The quality used when an alignment has no base qualities (default 1)
+
+    threads : int
+        The number of threads used to compress each output (default 1)
+
+    compresslevel : int
+        The compression level of gzip outputs (default 6)
+
+    batch_size : int
+        The number of records collected before each write (default 1000)
+
+    Returns
+    -------
+    Dict[str, int]
+        The number of records written to 'read1', 'read2' and 'other',
+        the number 'excluded' and the number of other reads 'dropped'
+
+    Notes
+    -----
+    Paths ending in .gz or .bgz are written with BGZF block compression,
+    which is valid gzip and can be compressed in parallel with threads.
+
+    Reads are written in input order, so the two reads of a pair are only
+    written at the same position in read1 and read2 (or next to each other
+    when interleaved) if the input is sorted or grouped by read name.
+
+    """
+    counts = {"read1": 0, "read2": 0, "other": 0, "excluded": 0,
+              "dropped": 0}
+    drop_other = read2 is not None and other is None
+    opened = []
+    try:
+        handle1, close1 = _open_fastq(read1, threads, compresslevel)
+        opened.append((handle1, close1))
+        if read2 is None:
+            handle2 = handle1
+        else:
+            handle2, close2 = _open_fastq(read2, threads, compresslevel)
+            opened.append((handle2, close2))
+        if other is None:
+            handle_other = handle1
+        else:
+            handle_other, close_other = _open_fastq(other, threads,
+                                                    compresslevel)
+            opened.append((handle_other, close_other))
+        # outputs sharing a handle share a batch to keep the input order
+        batches = {}
+        for handle in (handle1, handle2, handle_other):
+            batches.setdefault(id(handle), (handle, []))
+        outputs = {"read1": batches[id(handle1)][1],
+                   "read2": batches[id(handle2)][1],
+                   "other": batches[id(handle_other)][1]}
+        pending = 0
+        for alignment in alignments:
+            flag = _fastq_fields.unpack_from(alignment)[2]
+            if flag & exclude:
+                counts["excluded"] += 1
+                continue
+            pair_flag = flag & (_READ1 | _READ2)
+            if pair_flag == _READ1:
+                output = "read1"
+            elif pair_flag == _READ2:
+                output = "read2"
+            elif drop_other:
+                counts["dropped"] += 1
+                continue
+            else:
+                output = "other"
+            outputs[output].append(alignment_to_fastq(alignment,
+                                                      default_quality))
+            counts[output] += 1
+            pending += 1
+            if pending == batch_size:
+                _write_batches(batches.values())
+                pending = 0
+        _write_batches(batches.values())
+    finally:
+        for handle, close in opened:
+            if close:
+                handle.close()
+    return counts
+
+
+def _write_batches(batches: Iterable[Tuple[BinaryIO, list]]) -> None:
+    """Write and clear the records collected for each handle"""
+    for handle, records in batches:
+        if records:
+            handle.write(b"".join(records))
+            records.clear()
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Module      : pylazybam/index.py
+Description : BAM index (BAI and CSI) reading, writing and region queries.
+Copyright   : (c) Matthew Wakefield, 2018-2020
+License     : BSD-3-Clause
+Maintainer  : matthew.wakefield@unimelb.edu.au
+Portability : POSIX
+"""
+
+import struct
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+
+BAI_MAGIC: bytes = b"BAI\x01"
+CSI_MAGIC: bytes = b"CSI\x01"
+
+# The pseudo bin holding the virtual offset range and read counts of a
+# reference rather than alignment chunks
+PSEUDO_BIN: int = 37450
+
+
+def pseudo_bin(depth: int = 5) -> int:
+    """Calculate the pseudo bin number for an index of the given depth
+
+    Parameters
+    ----------
+    depth : int
+        The number of levels of bins (default 5, as used by BAI)
+
+    Returns
+    -------
+    int
+        One more than the largest bin number (37450 for BAI)
+    """
+    return ((1 << (depth + 1) * 3) - 1) // 7 + 1
+
+
+def reg2bin(beg: int, end: int,
+            min_shift: int = 14, depth: int = 5) -> int:
+    """Calculate the smallest bin containing a region
+
+    Parameters
+    ----------
+    beg : int
+        The zero based start of the region
+
+    end : int
+        The zero based, exclusive, end of the region
+
+    min_shift : int
+        The log2 of the smallest bin size (default 14, as used by BAI)
+
+    depth : int
+        The number of levels of bins (default 5, as used by BAI)
+
+    Returns
+    -------
+    int
+        The bin number as stored in the BAM alignment
+        eg from pylazybam.bam.get_bin()
+
+    Notes
+    -----
+    See section 5.3 of https://samtools.github.io/hts-specs/SAMv1.pdf
+    """
+    end -= 1
+    level = depth
+    shift = min_shift
+    offset = ((1 << depth * 3) - 1) // 7
+    while level > 0:
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+        level -= 1
+        shift += 3
+        offset -= 1 << level * 3
+    return 0
+
+
+def reg2bins(beg: int, end: int,
+             min_shift: int = 14, depth: int = 5) -> List[int]:
+    """Calculate all the bins that may overlap a region
+
+    Parameters
+    ----------
+    beg : int
+        The zero based start of the region
+
+    end : int
+        The zero based, exclusive, end of the region
+
+    min_shift : int
+        The log2 of the smallest bin size (default 14, as used by BAI)
+
+    depth : int
+        The number of levels of bins (default 5, as used by BAI)
+
+    Returns
+    -------
+    List[int]
+        The bin numbers from the largest to the smallest bin size
+    """
+    end -= 1
+    bins: List[int] = []
+    shift = min_shift + depth * 3
+    offset = 0
+    for level in range(depth + 1):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+        shift -= 3
+        offset += 1 << level * 3
+    return bins
+
+
+def bin_first_window(bin: int, min_shift: int = 14, depth: int = 5) -> int:
+    """Calculate the first linear index window of a bin
+
+    Parameters
+    ----------
+    bin : int
+        The bin number
+
+    min_shift : int
+        The log2 of the smallest bin size, and of the window size
+        (default 14, as used by BAI)
+
+    depth : int
+        The number of levels of bins (default 5, as used by BAI)
+
+    Returns
+    -------
+    int
+        The zero based number of the window holding the start of the bin
+    """
+    level = 0
+    first = 0
+    while first + (1 << level * 3) <= bin:
+        first += 1 << level * 3
+        level += 1
+    return (bin - first) << (depth - level) * 3
+
+
+class BaiIndex:
+    """A BAM index (BAI) file
+
+    Parameters
+    ----------
+        file : str, Path or BinaryIO
+            A path to, or a binary file object containing, a BAI index
+            CSI indexes are also accepted, although without a linear index
+            queries are less selective.
+
+    Attributes
+    ----------
+        bins : List[Dict[int, List[Tuple[int,int]]]]
+            For each reference, a dictionary of bin number to a list of
+            (start, end) BGZF virtual offset chunks
+
+        linear : List[List[int]]
+            For each reference, the lowest virtual offset of an alignment
+            overlapping each 16kb window
+
+        ref_stats : List[Optional[Tuple[int,int,int,int]]]
+            For each reference, the (start offset, end offset, mapped,
+            unmapped) values from the pseudo bin or None if absent
+
+        n_no_coor : Optional[int]
+            The number of unplaced unmapped reads, if recorded
+
+    Notes
+    -----
+    The detailed specification for the BAI format can be found in section 5.2
+    of https://samtools.github.io/hts-specs/SAMv1.pdf and the CSI format at
+    https://samtools.github.io/hts-specs/CSIv1.pdf
+    """
+
+    def __init__(self, file: Union[str, Path, BinaryIO]):
+        if isinstance(file, (str, Path)):
+            with open(file, 'rb') as handle:
+                data = handle.read()
+        else:
+            data = file.read()
+        if data[:4] == BAI_MAGIC:
+            csi = False
+            self.min_shift, self.depth = 14, 5
+            pos = 4
+        elif data[:4] == CSI_MAGIC:
+            csi = True
+            self.min_shift, self.depth, l_aux = struct.unpack_from("<iii",
+                                                                   data, 4)
+            pos = 16 + l_aux
+        else:
+            raise ValueError(f"Incorrect start to bai index: {data[:4]!r} "
+                             f"not {BAI_MAGIC!r} or {CSI_MAGIC!r}")
+        meta_bin = pseudo_bin(self.depth)
+        self.bins: List[Dict[int, List[Tuple[int, int]]]] = []
+        self.linear: List[List[int]] = []
+        self.ref_stats: List[Optional[Tuple[int, int, int, int]]] = []
+        n_ref = struct.unpack_from("<i", data, pos)[0]
+        pos += 4
+        for i in range(n_ref):
+            bins: Dict[int, List[Tuple[int, int]]] = {}
+            stats = None
+            n_bin = struct.unpack_from("<i", data, pos)[0]
+            pos += 4
+            for j in range(n_bin):
+                if csi:
+                    bin, loffset, n_chunk = struct.unpack_from("<IQi",
+                                                               data, pos)
+                    pos += 16
+                else:
+                    bin, n_chunk = struct.unpack_from("<Ii", data, pos)
+                    pos += 8
+                chunks = struct.unpack_from(f"<{2 * n_chunk}Q", data, pos)
+                pos += 16 * n_chunk
+                if bin == meta_bin:
+                    stats = chunks
+                else:
+                    bins[bin] = list(zip(chunks[::2], chunks[1::2]))
+            if csi:
+                self.linear.append([])
+            else:
+                n_intv = struct.unpack_from("<i", data, pos)[0]
+                pos += 4
+                self.linear.append(list(struct.unpack_from(f"<{n_intv}Q",
+                                                           data, pos)))
+                pos += 8 * n_intv
+            self.bins.append(bins)
+            self.ref_stats.append(stats)
+        if len(data) >= pos + 8:
+            self.n_no_coor: Optional[int] = struct.unpack_from("<Q",
+                                                               data, pos)[0]
+        else:
+            self.n_no_coor = None
+
+    def query(self, ref_index: int,
+              start: int, end: int) -> List[Tuple[int, int]]:
+        """Find the BGZF chunks that may contain alignments in a region
+
+        Parameters
+        ----------
+        ref_index : int
+            The zero based rank of the reference in the BAM header
+
+        start : int
+            The zero based start of the region
+
+        end : int
+            The zero based, exclusive, end of the region
+
+        Returns
+        -------
+        List[Tuple[int,int]]
+            Sorted, non overlapping (start, end) virtual offset chunks
+        """
+        if ref_index < 0 or ref_index >= len(self.bins):
+            return []
+        bins = self.bins[ref_index]
+        linear = self.linear[ref_index]
+        if linear:
+            min_offset = linear[min(start >> self.min_shift, len(linear) - 1)]
+        else:
+            min_offset = 0
+        chunks = sorted(chunk
+                        for bin in reg2bins(start, end,
+                                            self.min_shift, self.depth)
+                        for chunk in bins.get(bin, ())
+                        if chunk[1] > min_offset)
+        merged: List[Tuple[int, int]] = []
+        for chunk_start, chunk_end in chunks:
+            if merged and chunk_start <= merged[-1][1]:
+                if chunk_end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], chunk_end)
+            else:
+                merged.append((chunk_start, chunk_end))
+        return merged
+
+
+class IndexBuilder:
+    """Build a BAI or CSI index from alignments as they are written
+
+    Parameters
+    ----------
+        n_ref : int
+            The number of reference sequences in the BAM header
+
+        min_shift : int
+            The log2 of the smallest bin size (default 14, as used by BAI)
+
+        depth : int
+            The number of levels of bins (default 5, as used by BAI)
+
+    Notes
+    -----
+    Offsets passed to push can be BGZF virtual offsets, or any other
+    offsets that sort in the same order such as the block offsets from
+    pylazybam.bgzf.BgzfWriter.block_tell(). A function converting them to
+    virtual offsets can be passed to write_bai or write_csi.
+
+    See Also
+    --------
+    pylazybam.bam.FileWriter - which uses this class when index=True
+    """
+
+    def __init__(self, n_ref: int, min_shift: int = 14, depth: int = 5):
+        self.min_shift = min_shift
+        self.depth = depth
+        self.bins: List[Dict[int, List[List[int]]]] = [{} for i in range(n_ref)]
+        self.linear: List[List[Optional[int]]] = [[] for i in range(n_ref)]
+        self.ref_stats: List[Optional[List[int]]] = [None] * n_ref
+        self.n_no_coor = 0
+        self._last_ref = 0
+        self._last_pos = -1
+
+    def push(self,
+             ref_index: int,
+             beg: int,
+             end: int,
+             mapped: bool,
+             offset_beg: int,
+             offset_end: int):
+        """Add an alignment to the index
+
+        Parameters
+        ----------
+        ref_index : int
+            The zero based rank of the reference in the BAM header
+            or -1 for unplaced reads
+
+        beg : int
+            The zero based start of the alignment on the reference
+
+        end : int
+            The zero based, exclusive, end of the alignment on the reference
+
+        mapped : bool
+            False if the unmapped flag is set
+
+        offset_beg : int
+            The offset of the start of the alignment in the BAM file
+
+        offset_end : int
+            The offset of the end of the alignment in the BAM file
+
+        Raises
+        ------
+        ValueError
+            If the alignments are not in coordinate order
+        """
+        if ref_index < 0:
+            self.n_no_coor += 1
+            self._last_ref = len(self.bins)
+            return
+        if (ref_index < self._last_ref
+                or (ref_index == self._last_ref and beg < self._last_pos)):
+            raise ValueError("Alignments must be coordinate sorted to be "
+                             f"indexed but position {ref_index}:{beg} follows "
+                             f"{self._last_ref}:{self._last_pos}")
+        self._last_ref = ref_index
+        self._last_pos = beg
+
+        bin = reg2bin(beg, end, self.min_shift, self.depth)
+        chunks = self.bins[ref_index].setdefault(bin, [])
+        if chunks and chunks[-1][1] == offset_beg:
+            chunks[-1][1] = offset_end
+        else:
+            chunks.append([offset_beg, offset_end])
+
+        # placed unmapped reads are also in the linear index so that they
+        # are not skipped when they precede their mate in a window
+        linear = self.linear[ref_index]
+        last_window = (end - 1) >> self.min_shift
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> self.min_shift, last_window + 1):
+            if linear[window] is None:
+                linear[window] = offset_beg
+
+        stats = self.ref_stats[ref_index]
+        if stats is None:
+            stats = self.ref_stats[ref_index] = [offset_beg, offset_end, 0, 0]
+        stats[1] = offset_end
+        stats[2 if mapped else 3] += 1
+
+    def _finish_linear(self, ref_index: int) -> List[int]:
+        """Fill the empty windows of a linear index (PRIVATE)"""
+        linear = self.linear[ref_index]
+        stats = self.ref_stats[ref_index]
+        filled = []
+        previous = stats[0] if stats else 0
+        for offset in linear:
+            if offset is not None:
+                previous = offset
+            filled.append(previous)
+        return filled
+
+    def write_bai(self, file: BinaryIO, resolve=None):
+        """Write the index in BAI format
+
+        Parameters
+        ----------
+        file : BinaryIO
+            A writable binary file object
+
+        resolve : Callable[[int], int]
+            A function converting pushed offsets to virtual offsets
+        """
+        if self.min_shift != 14 or self.depth != 5:
+            raise ValueError("BAI indexes require min_shift 14 and depth 5")
+        resolve = resolve or (lambda offset: offset)
+        data = [BAI_MAGIC, struct.pack("<i", len(self.bins))]
+        for ref_index, bins in enumerate(self.bins):
+            stats = self.ref_stats[ref_index]
+            data.append(struct.pack("<i", len(bins) + (stats is not None)))
+            for bin, chunks in bins.items():
+                data.append(struct.pack("<Ii", bin, len(chunks)))
+                data.extend(struct.pack("<QQ", resolve(beg), resolve(end))
+                            for beg, end in chunks)
+            if stats is not None:
+                data.append(struct.pack("<IiQQQQ", PSEUDO_BIN, 2,
+                                        resolve(stats[0]), resolve(stats[1]),
+                                        stats[2], stats[3]))
+            linear = self._finish_linear(ref_index)
+            data.append(struct.pack("<i", len(linear)))
+            data.extend(struct.pack("<Q", resolve(offset))
+                        for offset in linear)
+        data.append(struct.pack("<Q", self.n_no_coor))
+        file.write(b"".join(data))
+
+    def write_csi(self, file: BinaryIO, resolve=None):
+        """Write the index in CSI format
+
+        Parameters
+        ----------
+        file : BinaryIO
+            A writable binary file object
+
+        resolve : Callable[[int], int]
+            A function converting pushed offsets to virtual offsets
+        """
+        resolve = resolve or (lambda offset: offset)
+        meta_bin = pseudo_bin(self.depth)
+        data = [CSI_MAGIC, struct.pack("<iiii", self.min_shift, self.depth,
+                                       0, len(self.bins))]
+        for ref_index, bins in enumerate(self.bins):
+            stats = self.ref_stats[ref_index]
+            linear = self._finish_linear(ref_index)
+            data.append(struct.pack("<i", len(bins) + (stats is not None)))
+            for bin, chunks in bins.items():
+                # loffset is the linear index offset of the first window of
+                # the bin, as htslib, so it includes alignments from larger
+                # bins overlapping the window
+                window = bin_first_window(bin, self.min_shift, self.depth)
+                if window < len(linear):
+                    loffset = resolve(linear[window])
+                else:
+                    loffset = 0
+                data.append(struct.pack("<IQi", bin, loffset, len(chunks)))
+                data.extend(struct.pack("<QQ", resolve(beg), resolve(end))
+                            for beg, end in chunks)
+            if stats is not None:
+                data.append(struct.pack("<IQiQQQQ", meta_bin, 0, 2,
+                                        resolve(stats[0]), resolve(stats[1]),
+                                        stats[2], stats[3]))
+        data.append(struct.pack("<Q", self.n_no_coor))
+        file.write(b"".join(data))
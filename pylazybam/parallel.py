@@ -0,0 +1,567 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Module      : pylazybam/parallel.py
+Description : Process parallel iteration over the alignments of a BAM file.
+Copyright   : (c) Matthew Wakefield, 2018-2020
+License     : BSD-3-Clause
+Maintainer  : matthew.wakefield@unimelb.edu.au
+Portability : POSIX
+"""
+
+import mmap
+import os
+import shutil
+import struct
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import (Any, BinaryIO, Callable, Generator, List, Optional, Tuple,
+                    Union)
+from pylazybam.bam import FileReader
+from pylazybam.bgzf import (BgzfWriter, _bgzf_eof, _load_bgzf_block,
+                            _parse_bgzf_block)
+
+# block_size, ref_index, pos, l_read_name, mapq, bin, n_cigar_op, flag,
+# l_seq, next_ref_index, next_pos, tlen
+_record_core = struct.Struct("<iiiBBHHHiiii")
+_int32 = struct.Struct("<i")
+
+# the number of consecutive plausible records required to resynchronise
+# to a record boundary at the start of a shard
+_RESYNC_RECORDS = 8
+
+
+def _block_starts(path: Union[str, Path]) -> List[int]:
+    """Return the raw start offset of every BGZF block in a file (PRIVATE)
+
+    Only the block headers are parsed, from a memory map of the file, so no
+    block is decompressed.
+    """
+    starts = []
+    with open(path, "rb") as handle:
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                offset = 0
+                while True:
+                    try:
+                        block_size = _parse_bgzf_block(view, offset)[0]
+                    except StopIteration:
+                        break
+                    starts.append(offset)
+                    offset += block_size
+            finally:
+                view.release()
+    return starts
+
+
+def _plan_shards(path: Union[str, Path],
+                 start: int,
+                 n_shards: int) -> List[Tuple[int, int]]:
+    """Split the alignments of a file into shards of whole BGZF blocks (PRIVATE)
+
+    Returns a list of (first block, end block) raw offsets. The first shard
+    starts with the block containing the virtual offset start, and the last
+    ends at the end of the file. Shards have similar compressed sizes.
+    """
+    starts = [offset for offset in _block_starts(path)
+              if offset >= start >> 16]
+    file_size = os.path.getsize(path)
+    if not starts:
+        return [(start >> 16, file_size)]
+    n_shards = max(1, min(n_shards, len(starts)))
+    total = file_size - starts[0]
+    boundaries = [starts[0]]
+    for i in range(1, n_shards):
+        target = starts[0] + total * i // n_shards
+        boundary = starts[min(bisect_right(starts, target), len(starts) - 1)]
+        if boundary > boundaries[-1]:
+            boundaries.append(boundary)
+    return list(zip(boundaries, boundaries[1:] + [file_size]))
+
+
+class _ShardWalker:
+    """Decompressed data of consecutive BGZF blocks of one shard (PRIVATE)
+
+    Blocks are decompressed into buffer as they are needed. The buffer
+    position of the first block at or after end_block is stored in boundary
+    once that block is loaded, and positions in the buffer can be converted
+    to virtual offsets.
+    """
+
+    def __init__(self, handle: BinaryIO, start_block: int, end_block: int):
+        handle.seek(start_block)
+        self._handle = handle
+        self._next_block = start_block
+        self._end_block = end_block
+        self.buffer = b""
+        self._positions: List[int] = []
+        self._raw_starts: List[int] = []
+        self.boundary: Optional[int] = None
+
+    def load(self) -> bool:
+        """Append the next block to the buffer, or return False at EOF"""
+        raw_start = self._next_block
+        try:
+            block_size, data = _load_bgzf_block(self._handle)
+        except StopIteration:
+            return False
+        self._next_block += block_size
+        if self.boundary is None and raw_start >= self._end_block:
+            self.boundary = len(self.buffer)
+        self._positions.append(len(self.buffer))
+        self._raw_starts.append(raw_start)
+        self.buffer += data
+        return True
+
+    def ensure(self, end: int) -> bool:
+        """Load blocks until the buffer is at least end bytes long"""
+        while len(self.buffer) < end:
+            if not self.load():
+                return False
+        return True
+
+    def virtual_offset(self, position: int) -> int:
+        """Return the virtual offset of a position in the buffer"""
+        i = bisect_right(self._positions, position) - 1
+        return (self._raw_starts[i] << 16) | (position - self._positions[i])
+
+    def trim(self, position: int) -> int:
+        """Discard the data before the block holding position
+
+        Returns the new buffer position of the same data.
+        """
+        i = bisect_right(self._positions, position) - 1
+        if i <= 0:
+            return position
+        shift = self._positions[i]
+        self.buffer = self.buffer[shift:]
+        self._positions = [p - shift for p in self._positions[i:]]
+        self._raw_starts = self._raw_starts[i:]
+        if self.boundary is not None:
+            self.boundary -= shift
+        return position - shift
+
+
+def _plausible_record(walker: _ShardWalker,
+                      position: int,
+                      n_ref: int) -> Optional[int]:
+    """Return the end of a plausible BAM record at position, or None (PRIVATE)
+
+    Checks the fixed length fields are consistent with the BAM
+    specification and the read name is NUL terminated.
+    """
+    if not walker.ensure(position + 36):
+        return None
+    buffer = walker.buffer
+    (block_size, ref_index, pos, len_read_name, mapq, bin,
+     number_cigar_operations, flag, len_sequence, pair_ref_index,
+     pair_pos, template_len) = _record_core.unpack_from(buffer, position)
+    if not (-1 <= ref_index < n_ref and -1 <= pair_ref_index < n_ref
+            and pos >= -1 and pair_pos >= -1
+            and (ref_index >= 0 or pos == -1)
+            and len_read_name > 0 and len_sequence >= 0
+            and 32 + len_read_name + 4 * number_cigar_operations
+            + (len_sequence + 1) // 2 + len_sequence <= block_size):
+        return None
+    name_end = position + 35 + len_read_name
+    if not walker.ensure(name_end + 1):
+        return None
+    buffer = walker.buffer
+    if buffer[name_end] != 0 or buffer.find(b"\x00", position + 36,
+                                            name_end) != -1:
+        return None
+    return position + 4 + block_size
+
+
+def _resync(walker: _ShardWalker, n_ref: int) -> Optional[int]:
+    """Find the first record start in the shard (PRIVATE)
+
+    A position is accepted if it and the following records (up to
+    _RESYNC_RECORDS or the end of the file) are plausible BAM records.
+    Returns None if no record starts before the end of the shard.
+    """
+    position = 0
+    while walker.boundary is None or position < walker.boundary:
+        if not walker.ensure(position + 1):
+            return None
+        end = position
+        for i in range(_RESYNC_RECORDS):
+            end = _plausible_record(walker, end, n_ref)
+            if end is None or not walker.ensure(end + 1):
+                break
+        if end is not None and (i == _RESYNC_RECORDS - 1
+                                or end == len(walker.buffer)):
+            return position
+        position += 1
+    return None
+
+
+def _record_end(walker: _ShardWalker, position: int) -> Optional[int]:
+    """Return the end of the record at position, or None at EOF (PRIVATE)"""
+    if not walker.ensure(position + 4):
+        if position < len(walker.buffer):
+            raise ValueError("Truncated alignment at the end of the file")
+        return None
+    end = position + 4 + _int32.unpack_from(walker.buffer, position)[0]
+    if not walker.ensure(end):
+        raise ValueError("Truncated alignment at the end of the file")
+    return end
+
+
+def _record_name(record: bytes, position: int = 0) -> bytes:
+    """Return the NUL terminated read name of a record (PRIVATE)"""
+    return record[position + 36:position + 36 + record[position + 12]]
+
+
+def _walk_shard(path: Union[str, Path],
+                start_block: int,
+                end_block: int,
+                n_ref: int,
+                start: Optional[int] = None,
+                by_name: bool = False,
+                ) -> Generator[bytes, None, Tuple[Optional[int],
+                                                  Optional[int]]]:
+    """Yield the records that start in a shard of whole BGZF blocks (PRIVATE)
+
+    The shard starts at start (a virtual offset) if given, or otherwise at
+    the first record found in start_block or later by resynchronising.
+    The generator returns a tuple of the virtual offset of the first record
+    yielded (None if there were none), and of the first record after the
+    shard (None at the end of the file).
+
+    If by_name is True shards hold whole groups of records with the same
+    read name. A shard found by resynchronising skips the records with the
+    name of the first record found, and every shard continues past its end
+    through the records with the name of the first record after the end,
+    so a group is always in the shard where it ends.
+    """
+    with open(path, "rb") as handle:
+        if start is None:
+            walker = _ShardWalker(handle, start_block, end_block)
+            position = _resync(walker, n_ref)
+            if position is None:
+                return None, None
+            if by_name:
+                # the group at the resynchronised record is finished by the
+                # previous shard
+                walker.ensure(position + 36)
+                name = _record_name(walker.buffer, position)
+                while True:
+                    end = _record_end(walker, position)
+                    if end is None:
+                        return None, None
+                    if _record_name(walker.buffer, position) != name:
+                        break
+                    position = walker.trim(end)
+                if walker.boundary is not None and position >= walker.boundary:
+                    return None, walker.virtual_offset(position)
+        else:
+            walker = _ShardWalker(handle, start >> 16, end_block)
+            position = start & 0xffff
+        walker.ensure(position)
+        first = None
+        last_name = None
+        while True:
+            end = _record_end(walker, position)
+            if end is None:
+                return first, None
+            if walker.boundary is not None and position >= walker.boundary:
+                if not by_name:
+                    return first, walker.virtual_offset(position)
+                name = _record_name(walker.buffer, position)
+                if last_name is None:
+                    last_name = name
+                elif name != last_name:
+                    return first, walker.virtual_offset(position)
+            if first is None:
+                first = walker.virtual_offset(position)
+            yield walker.buffer[position:end]
+            position = walker.trim(end)
+
+
+def _group_by_name(walk: Generator) -> Generator[List[bytes], None, Any]:
+    """Collect the records from a shard into read name groups (PRIVATE)
+
+    Returns the return value of walk.
+    """
+    group: List[bytes] = []
+    name = b""
+    while True:
+        try:
+            record = next(walk)
+        except StopIteration as stop:
+            if group:
+                yield group
+            return stop.value
+        record_name = _record_name(record)
+        if group and record_name != name:
+            yield group
+            group = []
+        name = record_name
+        group.append(record)
+
+
+def _map_shard(path: Union[str, Path],
+               func: Callable[[Any], Any],
+               by_name: bool,
+               start_block: int,
+               end_block: int,
+               n_ref: int,
+               start: Optional[int] = None,
+               ) -> Tuple[Optional[int], Optional[int], list]:
+    """Apply func to each record or group of a shard in a worker (PRIVATE)"""
+    walk = _walk_shard(path, start_block, end_block, n_ref, start, by_name)
+    if by_name:
+        walk = _group_by_name(walk)
+    results = []
+    while True:
+        try:
+            item = next(walk)
+        except StopIteration as stop:
+            first, next_start = stop.value
+            break
+        results.append(func(item))
+    return first, next_start, results
+
+
+def _filter_shard(path: Union[str, Path],
+                  func: Callable[[Any], Any],
+                  by_name: bool,
+                  start_block: int,
+                  end_block: int,
+                  n_ref: int,
+                  start: Optional[int],
+                  part: str,
+                  ) -> Tuple[Optional[int], Optional[int], int]:
+    """Write the records of a shard that func accepts to a part file (PRIVATE)
+    """
+    walk = _walk_shard(path, start_block, end_block, n_ref, start, by_name)
+    if by_name:
+        walk = _group_by_name(walk)
+    written = 0
+    writer = BgzfWriter(filename=part, mode="wb")
+    try:
+        while True:
+            try:
+                item = next(walk)
+            except StopIteration as stop:
+                first, next_start = stop.value
+                break
+            if func(item):
+                if by_name:
+                    writer.write(b"".join(item))
+                    written += len(item)
+                else:
+                    writer.write(item)
+                    written += 1
+    finally:
+        writer.close()
+    return first, next_start, written
+
+
+def _run_shards(path: Union[str, Path],
+                worker: Callable,
+                args: Tuple,
+                processes: Optional[int],
+                shards_per_process: int,
+                part_names: Optional[Callable[[int], str]] = None,
+                ) -> Generator[Tuple[int, Any], None, None]:
+    """Run a worker over the shards of a file in file order (PRIVATE)
+
+    Yields (shard number, result). The first record of each shard found by
+    resynchronising is checked against the first record after the previous
+    shard, and the shard is rerun from the correct record if they differ.
+    """
+    with FileReader(path) as reader:
+        start = reader._start_of_alignments
+        n_ref = reader.n_ref
+    if processes is None:
+        processes = os.cpu_count() or 1
+    plan = _plan_shards(path, start, processes * shards_per_process)
+
+    def shard_args(i: int, shard_start: Optional[int]) -> Tuple:
+        extra = (part_names(i),) if part_names else ()
+        return (path,) + args + (plan[i][0], plan[i][1], n_ref,
+                                 shard_start) + extra
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(worker,
+                                   *shard_args(i, start if i == 0 else None))
+                   for i in range(len(plan))]
+        try:
+            expected: Optional[int] = start
+            for i, future in enumerate(futures):
+                first, next_start, result = future.result()
+                if expected is not None and expected >> 16 < plan[i][1]:
+                    correct = first == expected
+                else:
+                    correct = first is None
+                if not correct:
+                    first, next_start, result = worker(*shard_args(i,
+                                                                   expected))
+                if first is not None:
+                    expected = next_start
+                yield i, result
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def parallel_map(path: Union[str, Path],
+                 func: Callable[[Any], Any],
+                 processes: Optional[int] = None,
+                 shards_per_process: int = 4,
+                 by_name: bool = False,
+                 check_sort: bool = True,
+                 ) -> Generator[Any, None, None]:
+    """Apply a function to every alignment of a BAM file on several processes
+
+    Parameters
+    ----------
+    path : str or Path
+        The path to a BGZF compressed BAM file
+
+    func : Callable[[Any], Any]
+        A function called with each raw alignment, or with each list of
+        alignments sharing a read name if by_name is True. It must be
+        picklable, eg defined at the top level of a module
+
+    processes : int
+        The number of worker processes (default: the number of CPUs)
+
+    shards_per_process : int
+        The file is split into this many shards per process, so that
+        processes finishing early can take another shard (default 4)
+
+    by_name : bool
+        Call func with the groups of consecutive alignments sharing a read
+        name, as FileReader.iter_name_groups, instead of single alignments.
+        A group is never split between workers (default False)
+
+    check_sort : bool
+        If by_name is True raise a ValueError unless the header declares
+        the file sorted or grouped by read name (default True)
+
+    Yields
+    ------
+    Any
+        The result of func for each alignment or group, in file order
+
+    Notes
+    -----
+    The file is split at BGZF block boundaries found by parsing the block
+    headers, and each worker resynchronises to the first alignment in its
+    shard by checking for a run of consistent alignment records. The first
+    alignment found is checked against the end of the previous shard, and
+    a shard is processed again from the correct alignment if they differ,
+    so the results are always exactly those of a single process.
+
+    With by_name the start of each shard is moved forward past the
+    alignments with the read name of its first alignment, and each shard
+    continues past its end to finish the group it ends in, so every group
+    is processed by exactly one worker.
+
+    The results of each shard are returned from the worker together, so
+    func should return small values (eg a count or a boolean) rather than
+    the alignments themselves. See parallel_filter for writing alignments.
+    """
+    if by_name and check_sort:
+        with FileReader(path) as reader:
+            reader._check_name_grouped()
+    for i, results in _run_shards(path, _map_shard, (func, by_name),
+                                  processes, shards_per_process):
+        yield from results
+
+
+def parallel_filter(path: Union[str, Path],
+                    func: Callable[[Any], Any],
+                    output: Union[str, Path],
+                    processes: Optional[int] = None,
+                    shards_per_process: int = 4,
+                    by_name: bool = False,
+                    check_sort: bool = True,
+                    ) -> int:
+    """Write the alignments of a BAM file accepted by a function in parallel
+
+    Parameters
+    ----------
+    path : str or Path
+        The path to a BGZF compressed BAM file
+
+    func : Callable[[Any], Any]
+        A function called with each raw alignment, or each list of
+        alignments sharing a read name if by_name is True, returning True
+        for the alignments to write. It must be picklable
+
+    output : str or Path
+        The path of the BAM file to write, with the header of the input
+
+    processes : int
+        The number of worker processes (default: the number of CPUs)
+
+    shards_per_process : int
+        The number of shards per process (default 4)
+
+    by_name : bool
+        Call func with the groups of alignments sharing a read name and
+        write every alignment of the accepted groups, eg to keep both
+        reads of a pair if either maps to a region (default False)
+
+    check_sort : bool
+        If by_name is True raise a ValueError unless the header declares
+        the file sorted or grouped by read name (default True)
+
+    Returns
+    -------
+    int
+        The number of alignments written
+
+    Notes
+    -----
+    Each worker compresses its alignments to a part file beside output, and
+    the parts are joined in file order once all the workers finish.
+    """
+    output = str(output)
+    # every part file this call may create, so that only these are removed
+    created: List[str] = []
+
+    def part_name(i: int) -> str:
+        name = f"{output}.part{i:05d}"
+        if name not in created:
+            created.append(name)
+        return name
+
+    with FileReader(path) as reader:
+        if by_name and check_sort:
+            reader._check_name_grouped()
+        header = reader.magic + reader.raw_header + reader.raw_refs
+    parts = [part_name(-1)]
+    written = 0
+    try:
+        writer = BgzfWriter(filename=part_name(-1), mode="wb")
+        writer.write(header)
+        writer.close()
+        for i, count in _run_shards(path, _filter_shard, (func, by_name),
+                                    processes, shards_per_process,
+                                    part_name):
+            parts.append(part_name(i))
+            written += count
+        with open(output, "wb") as out:
+            for part in parts:
+                with open(part, "r+b") as handle:
+                    # leave off the EOF block closing each part
+                    size = handle.seek(0, os.SEEK_END)
+                    if size >= len(_bgzf_eof):
+                        handle.seek(size - len(_bgzf_eof))
+                        if handle.read() == _bgzf_eof:
+                            handle.truncate(size - len(_bgzf_eof))
+                    handle.seek(0)
+                    shutil.copyfileobj(handle, out)
+            out.write(_bgzf_eof)
+    finally:
+        for part in created:
+            if os.path.exists(part):
+                os.remove(part)
+    return written
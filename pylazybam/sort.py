@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Module      : pylazybam/sort.py
+Description : External memory sorting of BAM files by coordinate or read name.
+Copyright   : (c) Matthew Wakefield, 2018-2020
+License     : BSD-3-Clause
+Maintainer  : matthew.wakefield@unimelb.edu.au
+Portability : POSIX
+"""
+
+import heapq
+import os
+import re
+import struct
+from contextlib import ExitStack
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Iterable, List, Optional, Union
+from pylazybam.bam import FileReader, FileWriter, queryname_key
+
+# ref_index, pos and flag from the fixed length section
+_coordinate_fields = struct.Struct("<4xii6xH")
+
+# estimated memory used by each alignment in a run beyond its length,
+# for the bytes object, its sort key and the run list
+_RECORD_OVERHEAD = 120
+
+# decompressed bytes read at a time from each run while merging, and the
+# estimated memory of each open run reader: its chunk, one cached BGZF
+# block and the block being decompressed
+_MERGE_CHUNK_SIZE = 64 * 1024
+_MERGE_READER_MEMORY = _MERGE_CHUNK_SIZE + 2 * 65536
+
+
+def coordinate_key(alignment: bytes) -> int:
+    """Sort key for alignments in samtools coordinate order
+
+    Parameters
+    ----------
+    alignment : bytes
+        A byte string of a bam alignment entry in raw binary format
+
+    Returns
+    -------
+    int
+        The reference index, position and strand packed into a single
+        integer. Alignments without a reference sort last.
+
+    """
+    ref_index, pos, flag = _coordinate_fields.unpack_from(alignment)
+    return ((ref_index & 0xffffffff) << 33) | ((pos + 1) << 1) | \
+        ((flag >> 4) & 1)
+
+
+def natural_name_key(alignment: bytes) -> Any:
+    """Sort key for alignments in samtools queryname order
+
+    Read names are compared with pylazybam.bam.queryname_key, and the
+    alignments of a name are ordered by their read1 and read2 flags, so
+    the first read of a pair sorts before the second.
+    """
+    return (queryname_key(alignment[36:35 + alignment[12]]),
+            alignment[18] & 0xc0)
+
+
+def name_key(alignment: bytes) -> Any:
+    """Sort key for alignments by the byte order of their read names
+
+    This is the order used by Picard SortSam. The alignments of a name are
+    ordered by their read1 and read2 flags.
+    """
+    return alignment[36:35 + alignment[12]], alignment[18] & 0xc0
+
+
+def set_sort_order(raw_header: bytes, sort_order: str) -> bytes:
+    """Set the SO field of the @HD line of a raw header
+
+    Parameters
+    ----------
+    raw_header : bytes
+        A raw BAM header, as FileReader.raw_header
+
+    sort_order : str
+        The new sort order eg 'coordinate' or 'queryname'
+
+    Returns
+    -------
+    bytes
+        The raw header with the length corrected. A @HD line is added if
+        there is none, and the SO field if the @HD line has none.
+    """
+    text = raw_header[4:]
+    field = b"SO:" + sort_order.encode("ascii")
+    hd_line = re.match(rb"@HD\t[^\n]*", text)
+    if hd_line is None:
+        text = b"@HD\tVN:1.6\t" + field + b"\n" + text
+    elif re.search(rb"\tSO:[^\t\n]*", hd_line[0]):
+        text = (re.sub(rb"\tSO:[^\t\n]*", b"\t" + field, hd_line[0], count=1)
+                + text[hd_line.end():])
+    else:
+        text = hd_line[0] + b"\t" + field + text[hd_line.end():]
+    return struct.pack("<i", len(text)) + text
+
+
+def _write_run(path: str,
+               alignments: Iterable[bytes],
+               raw_header: bytes,
+               raw_refs: bytes,
+               threads: int) -> None:
+    """Write a sorted run to a temporary BAM file at low compression"""
+    with FileWriter(path, raw_header=raw_header, raw_refs=raw_refs,
+                    compresslevel=1, threads=threads) as writer:
+        writer.write_header()
+        for alignment in alignments:
+            writer.write(alignment)
+
+
+def _open_run(path: str) -> FileReader:
+    """Open a sorted run for merging with small read buffers (PRIVATE)"""
+    return FileReader(path, chunk_size=_MERGE_CHUNK_SIZE, max_cache=1)
+
+
+def sort_bam(in_path: Union[str, Path],
+             out_path: Union[str, Path],
+             order: str = "coordinate",
+             natural: bool = True,
+             max_memory: int = 768 * 1024 * 1024,
+             max_runs: int = 256,
+             threads: int = 1,
+             compresslevel: int = 6,
+             index: Union[bool, str] = False,
+             tmpdir: Optional[Union[str, Path]] = None,
+             ) -> int:
+    """Sort a BAM file by coordinate or read name
+
+    Parameters
+    ----------
+    in_path : str or Path
+        The path to the BAM file to sort
+
+    out_path : str or Path
+        The path to write the sorted BAM file to
+
+    order : str
+        'coordinate' or 'queryname' (default 'coordinate')
+
+    natural : bool
+        For queryname order compare read names as samtools sort -n, with
+        runs of digits compared by value (default True). If False names
+        are compared byte by byte as Picard SortSam.
+
+    max_memory : int
+        The approximate memory in bytes used to hold alignments before
+        sorting them and writing them to a temporary run (default 768MB)
+
+    max_runs : int
+        The maximum number of runs merged at once. More runs are first
+        merged into fewer, larger runs (default 256). It is reduced if
+        needed so the open runs fit in a quarter of max_memory.
+
+    threads : int
+        The number of threads used for BGZF compression and decompression
+        (default 1)
+
+    compresslevel : int
+        The compression level of the sorted file (default 6)
+
+    index : bool or str
+        Write a 'bai' (or True) or 'csi' index of a coordinate sorted
+        file (default False)
+
+    tmpdir : str or Path
+        The directory for temporary runs (default: the system default)
+
+    Returns
+    -------
+    int
+        The number of alignments sorted
+
+    Raises
+    ------
+    ValueError
+        If order is not 'coordinate' or 'queryname', an index is requested
+        for queryname order, or max_runs is less than 2
+
+    Notes
+    -----
+    Alignments are read into memory until max_memory is reached, sorted
+    with a packed integer key (reference index, position and strand) or a
+    read name key, and written to a temporary BAM file at compression
+    level 1. The runs are then merged with a heap, reading each run in
+    small chunks with a single cached block, and at most a quarter of
+    max_memory is used for the open runs. Files that fit in max_memory are
+    sorted without temporary files. The sort is stable, so alignments with
+    equal keys keep their input order.
+
+    The SO field of the @HD header line is set to the new order.
+    """
+    if max_runs < 2:
+        raise ValueError("Use max_runs with a minimum of 2")
+    max_runs = max(2, min(max_runs,
+                          max_memory // 4 // _MERGE_READER_MEMORY))
+    if order == "coordinate":
+        key: Callable[[bytes], Any] = coordinate_key
+    elif order == "queryname":
+        if index:
+            raise ValueError("An index requires coordinate order")
+        key = natural_name_key if natural else name_key
+    else:
+        raise ValueError(f"order must be 'coordinate' or 'queryname' "
+                         f"not {order!r}")
+    with ExitStack() as stack:
+        reader = stack.enter_context(FileReader(in_path, threads=threads))
+        raw_header = set_sort_order(reader.raw_header, order)
+        raw_refs = reader.raw_refs
+        runs: List[str] = []
+        run: List[bytes] = []
+        run_memory = 0
+        count = 0
+        temp = None
+        for alignment in reader:
+            run.append(alignment)
+            run_memory += len(alignment) + _RECORD_OVERHEAD
+            if run_memory >= max_memory:
+                if temp is None:
+                    temp = stack.enter_context(TemporaryDirectory(dir=tmpdir))
+                run.sort(key=key)
+                runs.append(os.path.join(temp, f"run{len(runs):06d}.bam"))
+                _write_run(runs[-1], run, raw_header, raw_refs, threads)
+                count += len(run)
+                run = []
+                run_memory = 0
+        count += len(run)
+        run.sort(key=key)
+        # merge down to max_runs, keeping the last run in memory
+        while len(runs) + 1 > max_runs:
+            merged = []
+            for i in range(0, len(runs), max_runs):
+                if len(runs) - i == 1:
+                    merged.append(runs[i])
+                    continue
+                merged.append(os.path.join(temp, f"merged{len(merged):06d}"
+                                                 f"_{len(runs):06d}.bam"))
+                with ExitStack() as inputs:
+                    readers = [inputs.enter_context(_open_run(path))
+                               for path in runs[i:i + max_runs]]
+                    _write_run(merged[-1], heapq.merge(*readers, key=key),
+                               raw_header, raw_refs, threads)
+                for path in runs[i:i + max_runs]:
+                    os.remove(path)
+            runs = merged
+        readers = [stack.enter_context(_open_run(path)) for path in runs]
+        with FileWriter(out_path, raw_header=raw_header, raw_refs=raw_refs,
+                        compresslevel=compresslevel, threads=threads,
+                        index=index) as writer:
+            writer.write_header()
+            for alignment in heapq.merge(*readers, run, key=key):
+                writer.write(alignment)
+    return count
@@ -9,12 +9,227 @@ Maintainer  : matthew.wakefield@unimelb.edu.au
 Portability : POSIX
 """
 
-import struct, re
-from typing import Any
+import struct, re, sys
+from array import array
+from typing import Any, Dict, Iterable, Optional, Tuple
 
 # define a very negative int to avoid using MIN32INT and type conversion
 MIN32INT: int = -2147483648
 
+# fixed width value types keyed by the ordinal of the BAM type code
+_VALUE_STRUCTS = {ord(code): struct.Struct('<' + fmt) for code, fmt in
+                  (('c', 'b'), ('C', 'B'), ('s', 'h'), ('S', 'H'),
+                   ('i', 'i'), ('I', 'I'), ('f', 'f'))}
+_INT_TYPES = frozenset(b'cCsSiI')
+# B array subtypes as (array typecode, bytes per element)
+_ARRAY_TYPES = {ord('c'): ('b', 1), ord('C'): ('B', 1),
+                ord('s'): ('h', 2), ord('S'): ('H', 2),
+                ord('i'): ('i', 4), ord('I'): ('I', 4),
+                ord('f'): ('f', 4)}
+_int32 = struct.Struct('<i')
+_A, _Z, _H, _B = b'AZHB'
+
+
+def _walk_tags(tag_bytes: bytes,
+               wanted: Optional[Iterable[bytes]] = None,
+               ) -> Optional[Dict[bytes, Tuple[int, Any]]]:
+    """Walk the aux fields in a tag bytestring by type code in one pass
+
+    Returns a dictionary of tag: (type code, value) for the wanted tags
+    (or all tags if wanted is None), or None if the bytestring is not a
+    well formed series of tags (eg it is a whole alignment). Values of
+    tags that are not wanted are skipped without being decoded.
+    Raises ValueError if a wanted tag occurs more than once.
+    """
+    if not isinstance(tag_bytes, bytes):
+        tag_bytes = bytes(tag_bytes)
+    if wanted is not None:
+        wanted = frozenset(wanted)
+    fields = {}
+    duplicated = None
+    position = 0
+    end = len(tag_bytes)
+    try:
+        while position < end:
+            tag = tag_bytes[position:position + 2]
+            type_code = tag_bytes[position + 2]
+            position += 3
+            decode = wanted is None or tag in wanted
+            value = None
+            if type_code in _VALUE_STRUCTS:
+                value_struct = _VALUE_STRUCTS[type_code]
+                if decode:
+                    value = value_struct.unpack_from(tag_bytes, position)[0]
+                position += value_struct.size
+            elif type_code == _Z or type_code == _H:
+                stop = tag_bytes.index(b'\x00', position)
+                if decode:
+                    value = tag_bytes[position:stop].decode('ascii')
+                position = stop + 1
+            elif type_code == _A:
+                if decode:
+                    value = chr(tag_bytes[position])
+                position += 1
+            elif type_code == _B:
+                typecode, size = _ARRAY_TYPES[tag_bytes[position]]
+                count = _int32.unpack_from(tag_bytes, position + 1)[0]
+                start = position + 5
+                position = start + count * size
+                if count < 0 or position > end:
+                    return None
+                if decode:
+                    value = array(typecode, tag_bytes[start:position])
+                    if sys.byteorder == 'big':
+                        value.byteswap()
+            else:
+                return None
+            if position > end:
+                return None
+            if decode:
+                if tag in fields:
+                    duplicated = tag
+                fields[tag] = (type_code, value)
+    except (IndexError, KeyError, ValueError, struct.error):
+        # ValueError includes a missing NUL and UnicodeDecodeError
+        return None
+    if duplicated is not None:
+        raise ValueError(
+            (f"More than one {duplicated.decode()!r} tag was found in "
+             f"{tag_bytes!r}")
+        )
+    return fields
+
+
+def parse_tags(tag_bytes: bytes,
+               tags: Optional[Iterable[bytes]] = None) -> Dict[bytes, Any]:
+    """Parse the tags in a BAM tag bytestring into typed values
+
+    Parameters
+    ----------
+        tag_bytes : bytes
+            a bytestring containing bam formatted tag elements
+            (see bam.get_tag_bytestring)
+
+        tags : Iterable[bytes]
+            the two byte tags to decode eg [b'AS', b'NM']
+            (default: None, decode all tags)
+
+    Returns
+    -------
+        Dict[bytes, Any]
+            a dictionary of tag: value for the requested tags that are present.
+            Integer (c, C, s, S, i, I) tags are returned as int, f as float,
+            A as a one character str, Z and H as str and B as an array.array
+
+    Raises
+    ------
+        ValueError
+            raises a ValueError if the bytestring is not a valid series of
+            tags or a requested tag is present more than once
+
+    Notes
+    -----
+    The aux fields are walked by their type codes in a single pass, so values
+    of other tags (such as long SA or XA strings) can never be mistaken for a
+    requested tag. Unrequested values are skipped without being decoded.
+    """
+    fields = _walk_tags(tag_bytes, tags)
+    if fields is None:
+        raise ValueError(f"Malformed BAM tags {bytes(tag_bytes)!r}")
+    return {tag: value for tag, (type_code, value) in fields.items()}
+
+
+def get_tags(tag_bytes: bytes,
+             tags: Iterable[bytes],
+             defaults: Optional[Iterable[Any]] = None) -> Tuple[Any, ...]:
+    """Extract several tags from a BAM tag bytestring in a single pass
+
+    Parameters
+    ----------
+        tag_bytes : bytes
+            a bytestring containing bam formatted tag elements
+            (see bam.get_tag_bytestring)
+
+        tags : Iterable[bytes]
+            the two byte tags to be returned eg [b'AS', b'XS', b'NM']
+
+        defaults : Iterable[Any]
+            the value returned for each tag when it is absent, in the same
+            order as tags (default: None for every tag)
+
+    Returns
+    -------
+        Tuple[Any, ...]
+            the typed value of each tag in the order requested
+            (see parse_tags for the types returned)
+
+    Raises
+    ------
+        ValueError
+            raises a ValueError if the bytestring is not a valid series of
+            tags, a requested tag is present more than once, or the number of
+            defaults does not match the number of tags
+
+    Examples
+    --------
+    >>> get_tags(b'ASC\\xc6NMC\\x00', [b'AS', b'XS', b'NM'], [MIN32INT] * 3)
+    (198, -2147483648, 0)
+    """
+    tags = tuple(tags)
+    if defaults is None:
+        defaults = (None,) * len(tags)
+    else:
+        defaults = tuple(defaults)
+        if len(defaults) != len(tags):
+            raise ValueError(
+                f"{len(defaults)} defaults were given for {len(tags)} tags"
+            )
+    fields = parse_tags(tag_bytes, tags)
+    return tuple(fields.get(tag, default)
+                 for tag, default in zip(tags, defaults))
+
+
+def _search_tag(tag_bytes: bytes,
+                pattern: bytes,
+                no_tag: Any) -> Any:
+    """Regular expression search for a single tag value
+
+    Used as a fall back when tag_bytes is not just the tag bytestring
+    (eg a whole alignment). Returns the single match or no_tag, and raises
+    ValueError if more than one match is found.
+    """
+    match = re.findall(pattern, bytes(tag_bytes), re.DOTALL)
+    if not match:
+        return no_tag
+    elif len(match) != 1:
+        raise ValueError(
+            (
+                f"More than one match to {pattern} was found in {tag_bytes} "
+                "meaning that more than one value of the tag is present "
+                "or that another tag contains a match as part of its value"
+            )
+        )
+    return match[0]
+
+
+def _get_typed_tag(tag_bytes: bytes,
+                   tag: bytes,
+                   types: Iterable[int]) -> Tuple[bool, Any]:
+    """Return (parsed, value) for a tag with one of the given type codes
+
+    parsed is False if tag_bytes could not be walked as tags, and value is
+    None if the tag is absent or has a different type.
+    """
+    fields = _walk_tags(tag_bytes, (tag,))
+    if fields is None:
+        return False, None
+    if tag not in fields:
+        return True, None
+    type_code, value = fields[tag]
+    if type_code not in types:
+        return True, None
+    return True, value
+
 def get_AS(tag_bytes: bytes,
            no_tag: Any = MIN32INT) -> int:
     """Extract the high scoring alignment score from an AS tag in a raw BAM
@@ -44,23 +259,12 @@ def get_AS(tag_bytes: bytes,
     Recommended try accept for use on raw alignment with fall back
     to calling on only the tag byte string.
 
-    Please test carefully on your BAM output as in complicated output the
-    regular expression based extraction of the tag can be error prone
+    The tags are parsed by type code when tag_bytes is a tag bytestring.
+    A regular expression search is used as a fall back for a whole raw
+    alignment, and in complicated output this can be error prone.
 
     """
-    match = re.findall(b"ASC.", tag_bytes)
-    if not match:
-        return no_tag
-    elif len(match) != 1:
-        raise ValueError(
-            (
-                f"More than one match to b'ASC.' was found in {tag_bytes}"
-                "meaning that more than one value of the tag is present"
-                "or that another tag contains a match as part of its value"
-            )
-        )
-    else:
-        return struct.unpack("<xxxB", match[0])[-1]  # type: int
+    return get_int_tag(tag_bytes, b'AS', no_tag)
 
 
 def get_XS(tag_bytes: bytes,
@@ -97,23 +301,12 @@ def get_XS(tag_bytes: bytes,
     Recommended try accept for use on raw alignment with fall back
     to calling on only the tag byte string.
 
-    Please test carefully on your BAM output as in complicated output the
-    regular expression based extraction of the tag can be error prone
+    The tags are parsed by type code when tag_bytes is a tag bytestring.
+    A regular expression search is used as a fall back for a whole raw
+    alignment, and in complicated output this can be error prone.
 
     """
-    match = re.findall(b"XSC.", tag_bytes)
-    if not match:
-        return no_tag
-    elif len(match) != 1:
-        raise ValueError(
-            (
-                f"More than one match to b'XSC.' was found in {tag_bytes}"
-                "meaning that more than one value of the tag is present"
-                "or that another tag contains a match as part of its value"
-            )
-        )
-    else:
-        return struct.unpack("<xxxB", match[0])[-1]
+    return get_int_tag(tag_bytes, b'XS', no_tag)
 
 
 def get_ZS(tag_bytes: bytes,
@@ -148,23 +341,12 @@ def get_ZS(tag_bytes: bytes,
     Recommended try accept for use on raw alignment with fall back
     to calling on only the tag byte string.
 
-    Please test carefully on your BAM output as in complicated output the
-    regular expression based extraction of the tag can be error prone
+    The tags are parsed by type code when tag_bytes is a tag bytestring.
+    A regular expression search is used as a fall back for a whole raw
+    alignment, and in complicated output this can be error prone.
 
     """
-    match = re.findall(b"ZSC.", tag_bytes)
-    if not match:
-        return no_tag
-    elif len(match) != 1:
-        raise ValueError(
-            (
-                f"More than one match to b'ZSC.' was found in {tag_bytes}"
-                "meaning that more than one value of the tag is present"
-                "or that another tag contains a match as part of its value"
-            )
-        )
-    else:
-        return struct.unpack("<xxxB", match[0])[-1]
+    return get_int_tag(tag_bytes, b'ZS', no_tag)
 
 
 def get_MD(tag_bytes: bytes,
@@ -200,22 +382,18 @@ def get_MD(tag_bytes: bytes,
     Recommended try accept for use on raw alignment with fall back
     to calling on only the tag byte string.
 
-    Please test carefully on your BAM output as in complicated output the
-    regular expression based extraction of the tag can be error prone
+    The tags are parsed by type code when tag_bytes is a tag bytestring.
+    A regular expression search is used as a fall back for a whole raw
+    alignment, and in complicated output this can be error prone.
 
     """
-    match = re.findall(b"MDZ[0-9ACGTN^]+\x00", tag_bytes)
-    if not match:
+    parsed, value = _get_typed_tag(tag_bytes, b'MD', (_Z,))
+    if parsed:
+        return no_tag if value is None else value
+    match = _search_tag(tag_bytes, b"MDZ[0-9ACGTN^]+\x00", None)
+    if match is None:
         return no_tag
-    elif len(match) != 1:
-        raise ValueError(
-            (f"More than one match to b'MDZ[0-9ACGTN^]+\x00' was found in "
-             f"{tag_bytes} "
-             "meaning that more than one value of the tag is present"
-             "or that another tag contains a match as part of its value")
-        )
-    else:
-        return match[0][3:-1].decode()
+    return match[3:-1].decode()
 
 def get_int_tag(tag_bytes: bytes,
                 tag: bytes,
@@ -248,6 +426,10 @@ def get_int_tag(tag_bytes: bytes,
 
     Notes:
     ------
+    Aligners store integer tags with the smallest of the BAM types
+    c, C, s, S, i and I that holds the value, and all of these are decoded,
+    including negative values.
+
     Potential values for the tag parameter include:
 
         AM:i:score  The smallest template-independent mapping quality of any
@@ -298,19 +480,16 @@ def get_int_tag(tag_bytes: bytes,
     """
     if len(tag) != 2 or type(tag) != bytes:
         raise ValueError(f"Tags must be two bytes not {tag}")
-    match = re.findall(tag + b"C.", tag_bytes)
-    if not match:
+    parsed, value = _get_typed_tag(tag_bytes, tag, _INT_TYPES)
+    if parsed:
+        return no_tag if value is None else value
+    # one pattern for every integer width, so the type code gives the width
+    match = _search_tag(tag_bytes,
+                        re.escape(tag) + b"(?:[cC].|[sS]..|[iI]....)",
+                        None)
+    if match is None:
         return no_tag
-    elif len(match) != 1:
-        raise ValueError(
-            (
-                f"More than one match to {tag+b'C.'} was found in {tag_bytes}"
-                "meaning that more than one value of the tag is present"
-                "or that another tag contains a match as part of its value"
-            )
-        )
-    else:
-        return struct.unpack("<xxxB", match[0])[-1]
+    return _VALUE_STRUCTS[match[2]].unpack_from(match, 3)[0]
 
 def get_str_tag(tag_bytes: bytes,
                 tag: bytes,
@@ -436,22 +615,17 @@ def get_str_tag(tag_bytes: bytes,
     Recommended try accept for use on raw alignment with fall back
     to calling on only the tag byte string.
 
-    Please test carefully on your BAM output as in complicated output the
-    regular expression based extraction of the tag can be error prone
+    The tags are parsed by type code when tag_bytes is a tag bytestring.
+    A regular expression search is used as a fall back for a whole raw
+    alignment, and in complicated output this can be error prone.
 
     """
     if len(tag) != 2 or type(tag) != bytes:
         raise ValueError(f"Tags must be two bytes not {tag}")
-    match = re.findall(tag+b"Z[^\x00]+\x00", tag_bytes)
-    if not match:
+    parsed, value = _get_typed_tag(tag_bytes, tag, (_Z,))
+    if parsed:
+        return no_tag if value is None else value
+    match = _search_tag(tag_bytes, re.escape(tag) + b"Z[^\x00]+\x00", None)
+    if match is None:
         return no_tag
-    elif len(match) != 1:
-        restring = tag+b'Z[+\\x00]+\\x00'
-        raise ValueError(
-            (f"More than one match to {restring} was found in "
-             f"{tag_bytes} "
-             "meaning that more than one value of the tag is present"
-             "or that another tag contains a match as part of its value")
-        )
-    else:
-        return match[0][3:-1].decode()
+    return match[3:-1].decode()
@@ -8,6 +8,11 @@ Copyright (c) 2018-2020 Matthew Wakefield, The Walter and Eliza Hall Institute a
 
 import unittest
 from pylazybam.tests.test_bam import *
+from pylazybam.tests.test_bgzf import *
+from pylazybam.tests.test_cli import *
+from pylazybam.tests.test_fastq import *
+from pylazybam.tests.test_parallel import *
+from pylazybam.tests.test_sort import *
 
 __author__ = "Matthew Wakefield"
 __copyright__ = "Copyright 2018-2020 Matthew Wakefield, The Walter and Eliza Hall Institute and The University of Melbourne"
@@ -8,11 +8,15 @@ Copyright (c) 2018-2020 Matthew Wakefield, The Walter and Eliza Hall Institute a
 
 import gzip, struct
 import unittest
+from array import array
+from unittest import mock
 
-from pkg_resources import resource_stream
+from io import BytesIO
+from pathlib import Path
+from pkg_resources import resource_stream, resource_filename
 from tempfile import NamedTemporaryFile
 
-from pylazybam import bam
+from pylazybam import bam, bgzf, index
 
 __author__ = "Matthew Wakefield"
 __copyright__ = "Copyright 2018-2020 Matthew Wakefield, The Walter and Eliza Hall Institute and The University of Melbourne"
@@ -74,6 +78,575 @@ class test_main(unittest.TestCase):
         self.assertRaises(ValueError, bam.FileReader, test_bam)
 
 
+    def test_FileReader_bgzf(self):
+        test_bam = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+        with bam.FileReader(gzip.open(test_bam)) as ubam:
+            expected = list(ubam)
+        for source in (test_bam, Path(test_bam), open(test_bam, 'rb'),
+                       BytesIO(open(test_bam, 'rb').read())):
+            with bam.FileReader(source, threads=2) as the_bam:
+                self.assertIsNotNone(the_bam._bgzf)
+                self.assertEqual(the_bam.raw_header, RAW_HEADER)
+                self.assertEqual(the_bam.raw_refs, RAW_REFS)
+                self.assertEqual(list(the_bam), expected)
+                the_bam.reset_alignments()
+                self.assertEqual(next(the_bam), ALIGN0)
+        with bam.FileReader(BytesIO(gzip.open(test_bam).read())) as the_bam:
+            self.assertIsNone(the_bam._bgzf)
+            self.assertEqual(next(the_bam), ALIGN0)
+        with bam.FileReader(test_bam, use_mmap=True) as the_bam:
+            self.assertEqual(list(the_bam), expected)
+
+    def test_FileReader_chunk_size(self):
+        test_bam = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+        with bam.FileReader(test_bam) as the_bam:
+            expected = list(the_bam)
+        for chunk_size in (1, 7, 300, 65536):
+            with bam.FileReader(test_bam, chunk_size=chunk_size) as the_bam:
+                self.assertEqual(list(the_bam), expected)
+        content = gzip.open(test_bam).read()
+        with bam.FileReader(BytesIO(content[:-10])) as the_bam:
+            self.assertRaises(ValueError, list, the_bam)
+
+    def test_FileReader_zero_copy(self):
+        test_bam = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+        with bam.FileReader(test_bam) as the_bam:
+            expected = list(the_bam)
+        with bam.FileReader(test_bam, zero_copy=True, chunk_size=1000) as the_bam:
+            aligns = list(the_bam)
+        self.assertTrue(all(isinstance(a, memoryview) for a in aligns))
+        self.assertEqual(aligns, expected)
+        out = BytesIO()
+        out.close = lambda: None  # keep the contents for comparison
+        with bam.FileWriter(out) as out_bam:
+            for align in aligns:
+                out_bam.write(align)
+        self.assertEqual(gzip.decompress(out.getvalue()), b''.join(expected))
+
+    def test_accessors_memoryview(self):
+        align = memoryview(ALIGN0)
+        self.assertEqual(bam.get_ref_index(align), 12)
+        self.assertEqual(bam.get_pos(align), 133186149)
+        self.assertEqual(bam.get_flag(align), 83)
+        self.assertEqual(bam.get_read_name(align, 40),
+                         'HWI-ST960:96:COTO3ACXX:3:1101:1220:2089')
+        self.assertEqual(bam.decode_cigar(bam.get_raw_cigar(align, 40, 2)),
+                         '99M1S')
+        self.assertEqual(bam.decode_sequence(
+                            bam.get_raw_sequence(align, 40, 2, 100)),
+                         bam.decode_sequence(
+                            bam.get_raw_sequence(ALIGN0, 40, 2, 100)))
+        self.assertEqual(bam.decode_base_qual(
+                            bam.get_raw_base_qual(align, 40, 2, 100)),
+                         bam.decode_base_qual(
+                            bam.get_raw_base_qual(ALIGN0, 40, 2, 100)))
+        tags = bam.get_tag_bytestring(align, 40, 2, 100)
+        self.assertEqual(bam.get_AS(tags), 198)
+        self.assertEqual(bam.get_int_tag(tags, b'XS'), 126)
+        self.assertEqual(bam.get_MD(tags), '99')
+        self.assertEqual(bam.get_str_tag(tags, b'YT'), 'CP')
+        self.assertTrue(bam.is_flag(align, bam.FLAGS['forward']))
+
+    def test_FileReader_iter_batches(self):
+        test_bam = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+        with bam.FileReader(test_bam) as the_bam:
+            expected = list(the_bam)
+        with bam.FileReader(test_bam, zero_copy=True) as the_bam:
+            self.assertEqual(next(the_bam), ALIGN0)
+            batches = list(the_bam.iter_batches(100))
+        self.assertEqual([len(batch) for batch in batches],
+                         [100] * (len(expected) // 100) + [75])
+        aligns = [align for batch in batches for align in batch]
+        self.assertEqual(aligns, expected[1:])
+        batch = batches[0]
+        self.assertEqual(batch[0], expected[1])
+        self.assertEqual(batch.offsets[-1], len(batch.buffer))
+        for i, align in enumerate(expected[1:101]):
+            self.assertEqual(batch.ref_index[i], bam.get_ref_index(align))
+            self.assertEqual(batch.pos[i], bam.get_pos(align))
+            self.assertEqual(batch.len_read_name[i], bam.get_len_read_name(align))
+            self.assertEqual(batch.mapq[i], bam.get_mapq(align))
+            self.assertEqual(batch.bin[i], bam.get_bin(align))
+            self.assertEqual(batch.number_cigar_operations[i],
+                             bam.get_number_cigar_operations(align))
+            self.assertEqual(batch.flag[i], bam.get_flag(align))
+            self.assertEqual(batch.len_sequence[i], bam.get_len_sequence(align))
+            self.assertEqual(batch.pair_ref_index[i],
+                             bam.get_pair_ref_index(align))
+            self.assertEqual(batch.pair_pos[i], bam.get_pair_pos(align))
+            self.assertEqual(batch.template_len[i], bam.get_template_len(align))
+        empty = bam.AlignmentBatch([])
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(len(empty.flag), 0)
+
+    def test_AlignmentBatch_columns(self):
+        test_bam = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+        with bam.FileReader(test_bam) as the_bam:
+            aligns = list(the_bam)
+        batch = bam.AlignmentBatch(aligns)
+        with mock.patch.object(bam, '_numpy', None):
+            fallback = bam.AlignmentBatch(aligns)
+        self.assertIsInstance(fallback.flag, array)
+        for name, typecode in bam.AlignmentBatch._columns:
+            expected = [getattr(bam, 'get_' + name)(a) for a in aligns]
+            self.assertEqual(list(getattr(batch, name)), expected)
+            self.assertEqual(list(getattr(fallback, name)), expected)
+        with mock.patch.object(bam, '_numpy', None):
+            scores, = fallback.get_tags([b'AS'], [0])
+        self.assertIsInstance(scores, array)
+        self.assertEqual(list(batch.get_tags([b'AS'], [0])[0]), list(scores))
+
+    @unittest.skipIf(bam._numpy is None, 'NumPy is not installed')
+    def test_AlignmentBatch_numpy(self):
+        numpy = bam._numpy
+        batch = bam.AlignmentBatch([ALIGN0, ALIGN42, ALIGN0])
+        self.assertIsInstance(batch.pos, numpy.ndarray)
+        self.assertEqual(batch.pos.dtype, numpy.int32)
+        self.assertEqual(batch.mapq.dtype, numpy.uint8)
+        self.assertEqual(batch.flag.dtype, numpy.uint16)
+        self.assertEqual(batch.pos.tolist(), [133186149, -1, 133186149])
+        scores, pair_types = batch.get_tags([b'AS', b'YT'], [MIN32INT, None],
+                                            ['i', None])
+        self.assertIsInstance(scores, numpy.ndarray)
+        self.assertEqual(scores.dtype, numpy.int32)
+        self.assertEqual(scores.tolist(), [198, MIN32INT, 198])
+        self.assertEqual(pair_types, ['CP', 'UP', 'CP'])
+        empty = bam.AlignmentBatch([])
+        self.assertEqual(empty.flag.dtype, numpy.uint16)
+        self.assertEqual(len(empty.get_tags([b'AS'], [0])[0]), 0)
+
+    def test_iter_name_groups(self):
+        test_bam = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+        with bam.FileReader(test_bam) as the_bam:
+            alignments = list(the_bam)
+        for zero_copy in (False, True):
+            with bam.FileReader(test_bam, zero_copy=zero_copy) as the_bam:
+                self.assertRaises(ValueError, next, the_bam.iter_name_groups())
+                groups = list(the_bam.iter_name_groups(check_sort=False))
+            self.assertEqual(len(groups), 238)
+            self.assertEqual([bytes(a) for group in groups for a in group],
+                             alignments)
+            for group in groups:
+                self.assertEqual(len(group), 2)
+                self.assertEqual(len({bam.get_read_name(a, a[12])
+                                      for a in group}), 1)
+        # names that are prefixes of each other are different groups
+        renamed = ALIGN0[:74] + b'\x00' + ALIGN0[75:]
+        header = RAW_HEADER.replace(b'SO:unsorted', b'SO:queryname')
+        ubam = BytesIO()
+        ubam.close = lambda: None
+        writer = bam.FileWriter(ubam, header, RAW_REFS)
+        writer.write_header()
+        for alignment in (ALIGN0, renamed, renamed, ALIGN42):
+            writer.write(alignment)
+        writer.close()
+        ubam.seek(0)
+        with bam.FileReader(ubam) as the_bam:
+            self.assertEqual(the_bam.sort_order, 'queryname')
+            self.assertEqual(list(the_bam.iter_name_groups()),
+                             [[ALIGN0], [renamed, renamed], [ALIGN42]])
+
+    def test_zip_name_groups(self):
+        groups = {}
+        for genome in ('human', 'mouse'):
+            test_bam = resource_filename(
+                __name__, f'data/paired_end_testdata_{genome}.bam')
+            with bam.FileReader(test_bam) as the_bam:
+                raw_header = the_bam.raw_header.replace(b'SO:unsorted',
+                                                        b'SO:queryname')
+                raw_refs = the_bam.raw_refs
+                groups[genome] = [[bytes(a) for a in group] for group in
+                                  the_bam.iter_name_groups(check_sort=False)]
+            with bam.FileReader(test_bam) as the_bam:
+                self.assertRaises(ValueError, list,
+                                  bam.zip_name_groups([the_bam]))
+        # lockstep iteration of unsorted files with the same reads
+        readers = [bam.FileReader(resource_filename(
+            __name__, f'data/paired_end_testdata_{genome}.bam'))
+            for genome in ('human', 'mouse')]
+        zipped = list(bam.zip_name_groups(readers, check_sort=False))
+        self.assertEqual(zipped, list(zip(groups['human'], groups['mouse'])))
+
+        def name(group):
+            return bam.get_raw_read_name(group[0], group[0][12])[:-1]
+
+        def sorted_bam(genome_groups, key):
+            ubam = BytesIO()
+            ubam.close = lambda: None
+            writer = bam.FileWriter(ubam, raw_header, raw_refs)
+            writer.write_header()
+            for group in sorted(genome_groups, key=lambda g: key(name(g))):
+                for alignment in group:
+                    writer.write(alignment)
+            writer.close()
+            ubam.seek(0)
+            return bam.FileReader(ubam)
+
+        human = groups['human'][::2] + groups['human'][1:50:2]
+        mouse = groups['mouse'][1::2] + groups['mouse'][:50:2]
+        for key in (None, bam.queryname_key):
+            sort_key = key or (lambda n: n)
+            zipped = list(bam.zip_name_groups(
+                [sorted_bam(human, sort_key), sorted_bam(mouse, sort_key)],
+                key=key, read_ahead=3))
+            self.assertEqual(len(zipped), 238)
+            names = [name(h or m) for h, m in zipped]
+            self.assertEqual(names, sorted(names, key=sort_key))
+            both = [(h, m) for h, m in zipped if h and m]
+            self.assertEqual(len(both), 50)
+            for h, m in both:
+                self.assertEqual(name(h), name(m))
+            self.assertEqual(sum(1 for h, m in zipped if not m), 119 - 25)
+        # files sorted in a different order to the key
+        zipped = bam.zip_name_groups([sorted_bam(human, lambda n: n[::-1]),
+                                      sorted_bam(mouse, lambda n: n[::-1])])
+        self.assertRaises(ValueError, list, zipped)
+
+    def test_queryname_key(self):
+        self.assertEqual(sorted([b'r:10', b'r:9', b'r:09a', b'r-1', b'r:9b',
+                                 b'r'], key=bam.queryname_key),
+                         [b'r', b'r-1', b'r:9', b'r:09a', b'r:9b', b'r:10'])
+        # a digit is compared with the byte at the same place in the other
+        # name, as samtools strnum_cmp
+        self.assertLess(bam.queryname_key(b'r-1'), bam.queryname_key(b'r1'))
+        self.assertLess(bam.queryname_key(b'ab-'), bam.queryname_key(b'ab1'))
+        self.assertLess(bam.queryname_key(b'ab1'), bam.queryname_key(b'abc'))
+        self.assertLess(bam.queryname_key(b'r.2'), bam.queryname_key(b'r10'))
+
+    def test_get_reference_end(self):
+        self.assertEqual(bam.get_reference_end(ALIGN0), 133186149 + 99)
+        self.assertEqual(bam.get_reference_end(ALIGN42), 0)
+
+    def test_fetch(self):
+        test_bam = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+        with bam.FileReader(test_bam) as the_bam:
+            aligns = sorted(the_bam,
+                            key=lambda a: (bam.get_ref_index(a) & 0xffffffff,
+                                           bam.get_pos(a)))
+            raw_header, raw_refs = the_bam.raw_header, the_bam.raw_refs
+        out_file = NamedTemporaryFile(delete=False, suffix='.bam')
+        out_file.close()
+        # a minimal index with one chunk per reference in bin 0
+        chunks = {}
+        with bam.FileWriter(out_file.name) as out_bam:
+            out_bam.raw_header = raw_header
+            out_bam.raw_refs = raw_refs
+            out_bam.write_header()
+            for align in aligns:
+                start = out_bam.tell()
+                out_bam.write(align)
+                ref_index = bam.get_ref_index(align)
+                if ref_index >= 0:
+                    first = chunks.get(ref_index, (start,))[0]
+                    chunks[ref_index] = (first, out_bam.tell())
+        bai = b'BAI\x01' + struct.pack('<i', len(REFS))
+        for ref_index in range(len(REFS)):
+            if ref_index in chunks:
+                bai += struct.pack('<iIiQQi', 1, 0, 1, *chunks[ref_index], 0)
+            else:
+                bai += struct.pack('<ii', 0, 0)
+        with open(out_file.name + '.bai', 'wb') as bai_file:
+            bai_file.write(bai)
+
+        def overlaps(align, ref_index, start, end):
+            return (bam.get_ref_index(align) == ref_index
+                    and bam.get_pos(align) < end
+                    and bam.get_reference_end(align) > start)
+
+        with bam.FileReader(out_file.name) as the_bam:
+            self.assertEqual(list(the_bam.fetch('MT')), [])
+            self.assertEqual(list(the_bam.fetch('12', 133186149, 133186150)),
+                             [a for a in aligns
+                              if overlaps(a, 12, 133186149, 133186150)])
+            self.assertIn(ALIGN0, list(the_bam.fetch(12, 133186149,
+                                                     133186150)))
+            for ref_index in chunks:
+                self.assertEqual(list(the_bam.fetch(ref_index)),
+                                 [a for a in aligns
+                                  if bam.get_ref_index(a) == ref_index])
+            the_bam.reset_alignments()
+            self.assertEqual(list(the_bam), aligns)
+        with bam.FileReader(open(out_file.name, 'rb')) as the_bam:
+            the_bam.load_index(out_file.name + '.bai')
+            self.assertEqual(len(list(the_bam.fetch('12'))),
+                             len([a for a in aligns
+                                  if bam.get_ref_index(a) == 12]))
+        with bam.FileReader(BytesIO(open(out_file.name, 'rb').read())) as the_bam:
+            self.assertRaises(ValueError, the_bam.load_index)
+        with bam.FileReader(gzip.open(out_file.name)) as the_bam:
+            self.assertRaises(NotImplementedError, list, the_bam.fetch('12'))
+
+    def test_FileWriter_index(self):
+        test_bam = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+        with bam.FileReader(test_bam) as the_bam:
+            aligns = sorted(the_bam,
+                            key=lambda a: (bam.get_ref_index(a) & 0xffffffff,
+                                           bam.get_pos(a)))
+            raw_header, raw_refs = the_bam.raw_header, the_bam.raw_refs
+        regions = [(12, 133186149, 133186150), (12, 0, 1 << 29),
+                   (0, 0, 16569), (1, 1000000, 50000000)]
+        for index_format, threads in (('bai', 1), (True, 2), ('csi', 1)):
+            out_file = NamedTemporaryFile(delete=False, suffix='.bam')
+            out_file.close()
+            with bam.FileWriter(out_file.name, raw_header=raw_header,
+                                raw_refs=raw_refs, threads=threads,
+                                index=index_format) as out_bam:
+                out_bam.write_header()
+                for align in aligns:
+                    out_bam.write(align)
+            with bam.FileReader(out_file.name) as the_bam:
+                the_bam.load_index(out_bam.index_path)
+                self.assertEqual(the_bam.index.n_no_coor,
+                                 len([a for a in aligns
+                                      if bam.get_ref_index(a) < 0]))
+                for ref_index, start, end in regions:
+                    self.assertEqual(
+                        list(the_bam.fetch(ref_index, start, end)),
+                        [a for a in aligns
+                         if bam.get_ref_index(a) == ref_index
+                         and bam.get_pos(a) < end
+                         and bam.get_reference_end(a) > start])
+        out_bam = bam.FileWriter(BytesIO(), raw_header=raw_header,
+                                 raw_refs=raw_refs, index=True,
+                                 index_path=out_file.name + '.bai')
+        out_bam.write_header()
+        out_bam.write(ALIGN0)
+        self.assertRaises(ValueError, out_bam.write, ALIGN0[:8] + b'\x00' * 4
+                          + ALIGN0[12:])
+        self.assertRaises(ValueError, bam.FileWriter, BytesIO(), index=True)
+        self.assertRaises(ValueError, bam.FileWriter, out_file.name,
+                          index='tbi')
+
+    def test_iter_blocks(self):
+        test_bam = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+        with bam.FileReader(test_bam) as the_bam:
+            aligns = list(the_bam)
+            raw_header, raw_refs = the_bam.raw_header, the_bam.raw_refs
+            # written by samtools, which does not split alignments
+            blocks = list(the_bam.iter_blocks())
+            self.assertTrue(all(raw is not None for raw, block in blocks))
+            self.assertEqual([a for raw, block in blocks for a in block],
+                             aligns)
+        # pylazybam splits alignments across blocks
+        out_file = NamedTemporaryFile(delete=False, suffix='.bam')
+        out_file.close()
+        with bam.FileWriter(out_file.name, raw_header=raw_header,
+                            raw_refs=raw_refs) as out_bam:
+            out_bam.write_header()
+            for align in aligns * 3:
+                out_bam.write(align)
+        with bam.FileReader(out_file.name, zero_copy=True) as the_bam:
+            blocks = list(the_bam.iter_blocks())
+            self.assertIsNone(blocks[0][0])
+            self.assertIn(None, [raw for raw, block in blocks[1:]])
+            self.assertEqual([bytes(a) for raw, block in blocks
+                              for a in block], aligns * 3)
+        with bam.FileReader(gzip.open(test_bam)) as the_bam:
+            self.assertRaises(NotImplementedError, next,
+                              the_bam.iter_blocks())
+
+    def test_copy_alignments(self):
+        test_bam = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+        with bam.FileReader(test_bam) as the_bam:
+            aligns = sorted(the_bam,
+                            key=lambda a: (bam.get_ref_index(a) & 0xffffffff,
+                                           bam.get_pos(a)))
+            raw_header, raw_refs = the_bam.raw_header, the_bam.raw_refs
+        # a sorted file with a block per 40 alignments like samtools writes
+        sorted_file = NamedTemporaryFile(delete=False, suffix='.bam')
+        sorted_file.close()
+        with bam.FileWriter(sorted_file.name, raw_header=raw_header,
+                            raw_refs=raw_refs) as out_bam:
+            out_bam.write_header()
+            for i, align in enumerate(aligns, 1):
+                out_bam.write(align)
+                if i % 40 == 0:
+                    out_bam.bgzf_file.flush()
+        with bam.FileReader(sorted_file.name) as the_bam:
+            blocks = list(the_bam.iter_blocks())
+        self.assertEqual(len(blocks), 12)
+        # the header shares the first block
+        self.assertIsNone(blocks[0][0])
+
+        def not_mt_or_1(align):
+            return bam.get_ref_index(align) > 1
+
+        for keep, threads in ((None, 1), (not_mt_or_1, 2)):
+            kept = [a for a in aligns if keep is None or keep(a)]
+            out_file = NamedTemporaryFile(delete=False, suffix='.bam')
+            out_file.close()
+            with bam.FileReader(sorted_file.name) as the_bam:
+                next(the_bam)
+                with bam.FileWriter(out_file.name, raw_header=raw_header,
+                                    raw_refs=raw_refs, threads=threads,
+                                    index=True) as out_bam:
+                    out_bam.write_header()
+                    self.assertEqual(bam.copy_alignments(the_bam, out_bam,
+                                                         keep),
+                                     len(kept))
+            with open(out_file.name, 'rb') as handle:
+                written = handle.read()
+            self.assertEqual([raw for raw, block in blocks[1:]
+                              if raw in written],
+                             [raw for raw, block in blocks[1:]
+                              if keep is None or all(map(keep, block))])
+            with bam.FileReader(out_file.name) as the_bam:
+                self.assertEqual(list(the_bam), kept)
+                for ref_index, start, end in ((12, 133186149, 133186150),
+                                              (12, 0, 1 << 29),
+                                              (7, 0, 1 << 29)):
+                    self.assertEqual(
+                        list(the_bam.fetch(ref_index, start, end)),
+                        [a for a in kept
+                         if bam.get_ref_index(a) == ref_index
+                         and bam.get_pos(a) < end
+                         and bam.get_reference_end(a) > start])
+        out = BytesIO()
+        out.close = lambda: None  # keep the contents for comparison
+        with bam.FileReader(gzip.open(sorted_file.name)) as the_bam:
+            with bam.FileWriter(out, raw_header=raw_header,
+                                raw_refs=raw_refs) as out_bam:
+                out_bam.write_header()
+                self.assertEqual(bam.copy_alignments(the_bam, out_bam,
+                                                     not_mt_or_1),
+                                 len([a for a in aligns if not_mt_or_1(a)]))
+        with bam.FileReader(BytesIO(out.getvalue())) as the_bam:
+            self.assertEqual(list(the_bam),
+                             [a for a in aligns if not_mt_or_1(a)])
+
+    def test_reheader(self):
+        test_bam = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+        with bam.FileReader(test_bam) as the_bam:
+            aligns = list(the_bam)
+            raw_refs = the_bam.raw_refs
+            raw_header = the_bam.get_updated_header('test', 'pylazybam',
+                                                    '0.1.0',
+                                                    command='test_reheader')
+            blocks = [raw for raw, block in the_bam.iter_blocks()]
+        # pylazybam shares the first block between the header and alignments
+        shared_file = NamedTemporaryFile(delete=False, suffix='.bam')
+        shared_file.close()
+        with bam.FileWriter(shared_file.name, raw_header=raw_header,
+                            raw_refs=raw_refs) as out_bam:
+            out_bam.write_header()
+            for align in aligns * 2:
+                out_bam.write(align)
+        with open(shared_file.name, 'rb') as handle:
+            shared_blocks = [raw for raw, *rest in
+                             bgzf._iter_raw_bgzf_blocks(handle)][1:-1]
+        # the length is corrected for the edited text
+        edited = raw_header.replace(b'SO:unsorted', b'SO:unknown')
+        for source, new_header, copied in ((test_bam, raw_header, blocks),
+                                           (shared_file.name, edited,
+                                            shared_blocks)):
+            out_file = NamedTemporaryFile(delete=False, suffix='.bam')
+            out_file.close()
+            bam.reheader(source, out_file.name, new_header)
+            with bam.FileReader(out_file.name) as the_bam:
+                self.assertEqual(the_bam.header, new_header[4:].decode())
+                self.assertEqual(the_bam.raw_refs, raw_refs)
+                self.assertEqual(list(the_bam),
+                                 aligns * (1 if source == test_bam else 2))
+            with open(out_file.name, 'rb') as handle:
+                written = handle.read()
+            self.assertTrue(copied)
+            self.assertIn(b''.join(copied), written)
+            self.assertTrue(written.endswith(bgzf._bgzf_eof))
+            self.assertEqual(written.count(bgzf._bgzf_eof), 1)
+        with bam.FileReader(out_file.name) as the_bam:
+            self.assertEqual(the_bam.sort_order, 'unknown')
+        self.assertRaises(ValueError, bam.reheader, out_file.name,
+                          out_file.name, raw_header)
+        with open(out_file.name, 'wb') as handle:
+            handle.write(gzip.decompress(open(test_bam, 'rb').read()))
+        self.assertRaises(NotImplementedError, bam.reheader, out_file.name,
+                          shared_file.name, raw_header)
+
+    def test_concat(self):
+        test_bam = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+        mouse_bam = resource_filename(__name__, 'data/paired_end_testdata_mouse.bam')
+        with bam.FileReader(test_bam) as the_bam:
+            aligns = list(the_bam)
+            raw_header, raw_refs = the_bam.raw_header, the_bam.raw_refs
+            blocks = [raw for raw, block in the_bam.iter_blocks()]
+        part_file = NamedTemporaryFile(delete=False, suffix='.bam')
+        part_file.close()
+        with bam.FileWriter(part_file.name, raw_header=raw_header,
+                            raw_refs=raw_refs) as out_bam:
+            out_bam.write_header()
+            for align in aligns[:300]:
+                out_bam.write(align)
+        out_file = NamedTemporaryFile(delete=False, suffix='.bam')
+        out_file.close()
+        bam.concat(out_file.name, [test_bam, part_file.name, test_bam])
+        with bam.FileReader(out_file.name) as the_bam:
+            self.assertEqual(the_bam.raw_header, raw_header)
+            self.assertEqual(list(the_bam), aligns + aligns[:300] + aligns)
+        with open(out_file.name, 'rb') as handle:
+            written = handle.read()
+        self.assertEqual(written.count(b''.join(blocks)), 2)
+        self.assertEqual(written.count(bgzf._bgzf_eof), 1)
+
+        pg_file = NamedTemporaryFile(delete=False, suffix='.bam')
+        pg_file.close()
+        bam.reheader(test_bam, pg_file.name,
+                     bam.FileReader(test_bam).get_updated_header('a', 'b',
+                                                                 'c'))
+        self.assertRaises(ValueError, bam.concat, out_file.name,
+                          [test_bam, pg_file.name])
+        bam.concat(out_file.name, [test_bam, pg_file.name],
+                   check_header=False)
+        with bam.FileReader(out_file.name) as the_bam:
+            self.assertEqual(the_bam.raw_header, raw_header)
+            self.assertEqual(list(the_bam), aligns * 2)
+        self.assertRaises(ValueError, bam.concat, out_file.name,
+                          [test_bam, mouse_bam], check_header=False)
+        self.assertRaises(ValueError, bam.concat, out_file.name, [])
+        self.assertRaises(ValueError, bam.concat, out_file.name,
+                          [test_bam, out_file.name])
+        with open(pg_file.name, 'wb') as handle:
+            handle.write(gzip.decompress(open(test_bam, 'rb').read()))
+        self.assertRaises(NotImplementedError, bam.concat, out_file.name,
+                          [test_bam, pg_file.name])
+
+    def test_reg2bin(self):
+        self.assertEqual(index.reg2bin(133186149, 133186248), 12810)
+        self.assertEqual(index.reg2bin(0, 1), 4681)
+        self.assertEqual(index.reg2bin(0, 1 << 29), 0)
+        self.assertEqual(index.reg2bins(0, 1), [0, 1, 9, 73, 585, 4681])
+        self.assertIn(12810, index.reg2bins(133186149, 133186248))
+        self.assertRaises(ValueError, index.BaiIndex, BytesIO(b'BAM\x01'))
+
+    def test_bin_first_window(self):
+        self.assertEqual(index.bin_first_window(0), 0)
+        self.assertEqual(index.bin_first_window(4681), 0)
+        self.assertEqual(index.bin_first_window(4682), 1)
+        self.assertEqual(index.bin_first_window(586), 8)
+        self.assertEqual(index.bin_first_window(2), 4096)
+        self.assertEqual(index.bin_first_window(37449 + 5, 14, 6), 5)
+
+    def test_IndexBuilder_csi_loffset(self):
+        builder = index.IndexBuilder(1)
+        builder.push(0, 100, 200, True, 0, 10)
+        # a long read in bin 585 spanning windows 0 and 1
+        builder.push(0, 16000, 20000, True, 10, 20)
+        builder.push(0, 17000, 17100, True, 20, 30)
+        csi = BytesIO()
+        builder.write_csi(csi)
+        data = csi.getvalue()
+        self.assertEqual(data[:4], index.CSI_MAGIC)
+        n_bin = struct.unpack_from('<i', data, 20)[0]
+        pos = 24
+        loffsets = {}
+        for i in range(n_bin):
+            bin, loffset, n_chunk = struct.unpack_from('<IQi', data, pos)
+            loffsets[bin] = loffset
+            pos += 16 + 16 * n_chunk
+        self.assertEqual(loffsets[4681], 0)
+        self.assertEqual(loffsets[585], 0)
+        # the long read overlaps the first window of bin 4682
+        self.assertEqual(loffsets[4682], 10)
+
     def test_update_header_length(self):
         test_bam = resource_stream(__name__, 'data/paired_end_testdata_human.bam')
         the_bam = bam.FileReader(gzip.open(test_bam))
@@ -171,10 +744,28 @@ class test_main(unittest.TestCase):
             b'#"##!\x1f####""!!\x1e##$$$##$"#"%%\'\'\'\'\')((&\')))))))(\'(()((\'#!))))))))((()))(&\'\'))))())()(&))(\'\'%%\'%####\x1c\x10\x02'),
                          'DCDDB@DDDDCCBB?DDEEEDDECDCFFHHHHHJIIGHJJJJJJJIHIIJIIHDBJJJJJJJJIIIJJJIGHHJJJJIJJIJIGJJIHHFFHFDDDD=1#')
 
+    def test_decode_base_qual_bytes(self):
+        raw = bam.get_raw_base_qual(ALIGN0, 40, 2, 100)
+        decoded = bam.decode_base_qual(raw)
+        self.assertEqual(bam.decode_base_qual(raw, as_bytes=True),
+                         decoded.encode())
+        self.assertEqual(bam.decode_base_qual(memoryview(raw)), decoded)
+        self.assertEqual(bam.decode_base_qual(b'\x00\x28', offset=64), '@h')
+        self.assertEqual(bam.decode_base_qual(b'', as_bytes=True), b'')
+        self.assertEqual(bam.decode_base_qual(b'\xff\xff'), '\u0120\u0120')
+        self.assertRaises(ValueError, bam.decode_base_qual, b'\xff',
+                          as_bytes=True)
+
     def test_decode_sequence(self):
         self.assertEqual(bam.decode_sequence(
             b'HB\x18"$H\x14\x82"\x14(\x12\x88\x14AD(AD!D\x14\x11\x82B\x88A\x12"\x84AD!\x11D\x88B\x14\x84\x14"AA\x82\x12\x12!(\x12\x1f'),
                          'GTGCATCCCGGTAGTCCCAGCTACTTAGGAGGCTGAGGCAGGAGAATCGCTTGAACCCTGGAGGCAAAGGTTGCAGTGAGCCGAGATCACACCACTACAN')
+        self.assertEqual(bam.decode_sequence(bytes(range(0, 256, 17))),
+                         '==AACCMMGGRRSSVVTTWWYYHHKKDDBBNN')
+        self.assertEqual(bam.decode_sequence(b'\x12\x40', 3), 'ACG')
+        self.assertEqual(bam.decode_sequence(memoryview(b'\x12\x48'), 4),
+                         'ACGT')
+        self.assertEqual(bam.decode_sequence(b''), '')
 
     def test_decode_cigar(self):
         self.assertEqual(bam.decode_cigar(b'0\x06\x00\x00\x14\x00\x00\x00'),
@@ -214,6 +805,19 @@ class test_main(unittest.TestCase):
         self.assertRaises(ValueError, bam.get_int_tag,
                           *(b'ASC\xc6ASC\xc6', b"AS"))
         self.assertRaises(ValueError,bam.get_int_tag, *(b'',b''))
+        self.assertEqual(bam.get_int_tag(TAGS, b"NM"), 1)
+        self.assertEqual(bam.get_int_tag(TAGS, b"MD"), MIN32INT)
+        for raw, value in ((b'c\xfe', -2), (b'C\n', 10),
+                           (b's\x00\xff', -256), (b'S\x00\x01', 256),
+                           (b'i\x9c\xff\xff\xff', -100),
+                           (b'I\x00\x00\x00\x80', 2147483648)):
+            self.assertEqual(bam.get_int_tag(b'AS' + raw + TAGS[-44:], b"AS"),
+                             value)
+            # a whole alignment falls back to a regular expression search
+            self.assertEqual(bam.get_int_tag(ALIGN42 + b'AS' + raw, b"AS"),
+                             value)
+            self.assertEqual(bam.get_AS(ALIGN42 + b'AS' + raw), value)
+        self.assertEqual(bam.get_int_tag(ALIGN0[:-40] + TAGS, b"NM"), 1)
 
     def test_get_str_tag(self):
         self.assertEqual(bam.get_str_tag(b'',b'MD'), None)
@@ -232,6 +836,61 @@ class test_main(unittest.TestCase):
         self.assertEqual(bam.get_str_tag(TAGS,b'PG'),
                          'MarkDuplicates')
 
+    def test_parse_tags(self):
+        tags = bam.get_tag_bytestring(ALIGN0, 40, 2, 100)
+        self.assertEqual(bam.parse_tags(tags),
+                         {b'AS': 198, b'XS': 126, b'XN': 0, b'XM': 0,
+                          b'XO': 0, b'XG': 0, b'NM': 0, b'MD': '99',
+                          b'YS': 189, b'YT': 'CP'})
+        self.assertEqual(bam.parse_tags(TAGS, [b'AS', b'NM', b'SA', b'ZZ']),
+                         {b'AS': 30, b'NM': 1,
+                          b'SA': 'chr12,82544431,+,102M48S,60,3;'})
+        self.assertEqual(bam.parse_tags(memoryview(TAGS), [b'XS']),
+                         {b'XS': 28})
+        typed = (b'XAAx' + b'Xcc\xfe' + b'XsS\x00\x01' + b'Xii\xff\xff\xff\xff'
+                 + b'Xff\x00\x00\xc0\x3f' + b'XHH1AE3\x00'
+                 + b'XBBs\x02\x00\x00\x00\xff\xff\x02\x00')
+        parsed = bam.parse_tags(typed)
+        self.assertEqual(parsed[b'XA'], 'x')
+        self.assertEqual(parsed[b'Xc'], -2)
+        self.assertEqual(parsed[b'Xs'], 256)
+        self.assertEqual(parsed[b'Xi'], -1)
+        self.assertEqual(parsed[b'Xf'], 1.5)
+        self.assertEqual(parsed[b'XH'], '1AE3')
+        self.assertEqual(list(parsed[b'XB']), [-1, 2])
+        self.assertEqual(bam.parse_tags(b''), {})
+        self.assertRaises(ValueError, bam.parse_tags, ALIGN0)
+        self.assertRaises(ValueError, bam.parse_tags, b'ASi\x01\x00')
+        self.assertRaises(ValueError, bam.parse_tags, b'MDZ99')
+        self.assertRaises(ValueError, bam.parse_tags, b'ASC\xc6ASC\xc6')
+        self.assertEqual(bam.parse_tags(b'ASC\xc6ASC\xc6', [b'XS']), {})
+        # a value that looks like a tag is not mistaken for one
+        self.assertEqual(bam.get_AS(b'XAZASC\x01\x00ASC\x02'), 2)
+        self.assertEqual(bam.get_XS(b'XSA+'), MIN32INT)
+
+    def test_get_tags(self):
+        tags = bam.get_tag_bytestring(ALIGN0, 40, 2, 100)
+        self.assertEqual(bam.get_tags(tags, [b'AS', b'XS', b'ZS', b'NM']),
+                         (198, 126, None, 0))
+        self.assertEqual(bam.get_tags(TAGS, [b'NM', b'ZS', b'MD'],
+                                      [-1, MIN32INT, '']),
+                         (1, MIN32INT, '0G30'))
+        self.assertEqual(bam.get_tags(TAGS, []), ())
+        self.assertRaises(ValueError, bam.get_tags, TAGS, [b'AS'], [0, 1])
+        self.assertRaises(ValueError, bam.get_tags, ALIGN0, [b'AS'])
+
+    def test_AlignmentBatch_get_tags(self):
+        batch = bam.AlignmentBatch([ALIGN0, ALIGN42, ALIGN0])
+        scores, suboptimal, pair_types = batch.get_tags(
+            [b'AS', b'XS', b'YT'], [MIN32INT, MIN32INT, None], ['i', 'l', None])
+        self.assertEqual(list(scores), [198, MIN32INT, 198])
+        self.assertEqual(list(suboptimal), [126, MIN32INT, 126])
+        self.assertEqual(pair_types, ['CP', 'UP', 'CP'])
+        self.assertRaises(ValueError, batch.get_tags, [b'AS'], [0, 0])
+        empty = bam.AlignmentBatch([]).get_tags([b'AS'], [0])
+        self.assertEqual(len(empty), 1)
+        self.assertEqual(len(empty[0]), 0)
+
     def test_is_flag(self):
         self.assertTrue(bam.is_flag(ALIGN0,bam.FLAGS['forward']))
 
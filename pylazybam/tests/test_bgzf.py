@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+pylazybam/tests/test_bgzf.py
+
+Copyright (c) 2018-2020 Matthew Wakefield, The Walter and Eliza Hall Institute and The University of Melbourne. All rights reserved.
+"""
+
+import gzip
+import unittest
+from io import BytesIO
+
+from pkg_resources import resource_filename
+
+from pylazybam import bgzf
+
+__author__ = "Matthew Wakefield"
+__copyright__ = "Copyright 2018-2020 Matthew Wakefield, The Walter and Eliza Hall Institute and The University of Melbourne"
+__credits__ = ["Matthew Wakefield", ]
+__license__ = "BSD-3-Clause"
+__version__ = "0.1.0"
+__maintainer__ = "Matthew Wakefield"
+__email__ = "wakefield@wehi.edu.au"
+__status__ = "Development/Beta"
+
+HUMAN_BAM = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+
+
+class test_bgzf(unittest.TestCase):
+    def setUp(self):
+        with gzip.open(HUMAN_BAM) as ubam:
+            self.content = ubam.read()
+
+    def test_BgzfReader_threads(self):
+        self.assertRaises(ValueError, bgzf.BgzfReader, HUMAN_BAM, threads=0)
+        with bgzf.BgzfReader(HUMAN_BAM, 'rb', threads=3) as handle:
+            data = b''
+            while True:
+                chunk = handle.read(1000)
+                if not chunk:
+                    break
+                data += chunk
+        self.assertEqual(data, self.content)
+
+    def test_BgzfReader_threads_seek_tell(self):
+        single = bgzf.BgzfReader(HUMAN_BAM, 'rb')
+        threaded = bgzf.BgzfReader(HUMAN_BAM, 'rb', threads=2)
+        offsets = []
+        for size in (4, 900, 70000, 12):
+            self.assertEqual(single.tell(), threaded.tell())
+            offsets.append(threaded.tell())
+            self.assertEqual(single.read(size), threaded.read(size))
+        for offset in reversed(offsets):
+            self.assertEqual(threaded.seek(offset), offset)
+            single.seek(offset)
+            self.assertEqual(single.read(100), threaded.read(100))
+        self.assertEqual(single.read(200000), threaded.read(200000))
+        self.assertEqual(threaded.read(10), b'')
+        single.close()
+        threaded.close()
+
+    def test_BgzfReader_mmap(self):
+        self.assertRaises(ValueError, bgzf.BgzfReader,
+                          fileobj=BytesIO(b'\x1f\x8b'), use_mmap=True)
+        for threads in (1, 2):
+            single = bgzf.BgzfReader(HUMAN_BAM, 'rb')
+            mapped = bgzf.BgzfReader(HUMAN_BAM, 'rb', threads=threads,
+                                     use_mmap=True)
+            offsets = []
+            for size in (4, 900, 70000, 12):
+                self.assertEqual(single.tell(), mapped.tell())
+                offsets.append(mapped.tell())
+                self.assertEqual(single.read(size), mapped.read(size))
+            for offset in reversed(offsets):
+                self.assertEqual(mapped.seek(offset), offset)
+                single.seek(offset)
+                self.assertEqual(single.read(100), mapped.read(100))
+            mapped.seek(0)
+            self.assertEqual(mapped.read(len(self.content) + 1), self.content)
+            self.assertEqual(mapped.read(10), b'')
+            single.close()
+            mapped.close()
+            self.assertIsNone(mapped._map)
+
+    def test_parse_bgzf_block(self):
+        with open(HUMAN_BAM, 'rb') as handle:
+            raw = handle.read()
+        self.assertRaises(StopIteration, bgzf._parse_bgzf_block,
+                          raw, len(raw))
+        self.assertRaises(ValueError, bgzf._parse_bgzf_block, raw, 1)
+        self.assertRaises(ValueError, bgzf._parse_bgzf_block, raw[:100], 0)
+        view = memoryview(raw)
+        with open(HUMAN_BAM, 'rb') as handle:
+            offset = 0
+            while True:
+                try:
+                    expected = bgzf._read_bgzf_block(handle)
+                except StopIteration:
+                    break
+                parsed = bgzf._parse_bgzf_block(view, offset)
+                self.assertIsInstance(parsed[1], memoryview)
+                self.assertEqual(parsed, expected)
+                offset += parsed[0]
+        self.assertEqual(offset, len(raw))
+
+    def test_BgzfWriter_threads(self):
+        self.assertRaises(ValueError, bgzf.BgzfWriter,
+                          fileobj=BytesIO(), threads=0)
+        self.assertRaises(ValueError, bgzf.BgzfWriter,
+                          fileobj=BytesIO(), threads=2, max_queue=0)
+        outputs = []
+        for threads in (1, 3):
+            out = BytesIO()
+            out.close = lambda: None  # keep the contents for comparison
+            writer = bgzf.BgzfWriter(fileobj=out, threads=threads, max_queue=2)
+            offsets = []
+            for i in range(0, len(self.content), 7001):
+                writer.write(self.content[i:i + 7001] * 3)
+                offsets.append(writer.tell())
+            writer.close()
+            outputs.append((out.getvalue(), offsets))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(gzip.decompress(outputs[1][0]),
+                         b''.join(self.content[i:i + 7001] * 3
+                                  for i in range(0, len(self.content), 7001)))
+
+    def test_raw_blocks(self):
+        with open(HUMAN_BAM, 'rb') as handle:
+            raw = handle.read()
+        for threads, use_mmap in ((1, False), (2, False), (1, True),
+                                  (3, True)):
+            with bgzf.BgzfReader(HUMAN_BAM, 'rb', threads=threads,
+                                 use_mmap=use_mmap) as handle:
+                blocks = list(handle.raw_blocks(0))
+                self.assertEqual(b''.join(block for block, data in blocks),
+                                 raw)
+                self.assertEqual(b''.join(data for block, data in blocks),
+                                 self.content)
+                first = len(blocks[0][0])
+                self.assertEqual(list(handle.raw_blocks(first)), blocks[1:])
+                # reading is independent of raw_blocks
+                self.assertEqual(handle.read(100), self.content[:100])
+
+    def test_BgzfWriter_write_compressed_block(self):
+        with bgzf.BgzfReader(HUMAN_BAM, 'rb') as handle:
+            blocks = [block for block, data in handle.raw_blocks(0)]
+        outputs = []
+        for threads in (1, 3):
+            out = BytesIO()
+            out.close = lambda: None  # keep the contents for comparison
+            writer = bgzf.BgzfWriter(fileobj=out, threads=threads,
+                                     max_queue=1, track_blocks=True)
+            writer.write(b'start')
+            for block in blocks[:-1]:
+                writer.write_compressed_block(block)
+            self.assertEqual(writer.block_tell(), len(blocks) << 16)
+            writer.write(b'end')
+            writer.close()
+            outputs.append(out.getvalue())
+            self.assertEqual(writer.block_to_virtual_offset(1 << 16),
+                             outputs[-1].index(blocks[0]) << 16)
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn(b''.join(blocks[:-1]), outputs[0])
+        self.assertEqual(gzip.decompress(outputs[0]),
+                         b'start' + self.content + b'end')
+
+    def test_BgzfBlockCache(self):
+        self.assertRaises(ValueError, bgzf.BgzfBlockCache, max_blocks=0)
+        cache = bgzf.BgzfBlockCache(max_blocks=3)
+        for offset in (0, 10, 20):
+            cache.put(offset, b'x' * 5, 10)
+        self.assertEqual(cache.get(0), (b'xxxxx', 10))
+        cache.put(30, b'y' * 5, 10)
+        self.assertNotIn(10, cache)
+        self.assertIn(0, cache)
+        self.assertIsNone(cache.get(10))
+        self.assertEqual((len(cache), cache.hits, cache.misses), (3, 1, 1))
+        sized = bgzf.BgzfBlockCache(max_blocks=100, max_bytes=12)
+        for offset in (0, 10, 20):
+            sized.put(offset, b'z' * 5, 10)
+        self.assertEqual((len(sized), sized.size), (2, 10))
+        self.assertNotIn(0, sized)
+        sized.clear()
+        self.assertEqual((len(sized), sized.size, sized.hits), (0, 0, 0))
+
+    def test_BgzfReader_shared_cache(self):
+        cache = bgzf.BgzfBlockCache(max_blocks=2)
+        first = bgzf.BgzfReader(HUMAN_BAM, 'rb', cache=cache)
+        second = bgzf.BgzfReader(HUMAN_BAM, 'rb', cache=cache)
+        self.assertIs(first.cache, second.cache)
+        data = first.read(100)
+        misses = cache.misses
+        self.assertEqual(second.read(100), data)
+        self.assertEqual(cache.misses, misses)
+        self.assertGreater(cache.hits, 0)
+        first.close()
+        self.assertIsNone(first.cache)
+        second.seek(0)
+        self.assertEqual(second.read(100), data)
+        second.close()
+        self.assertEqual(len(cache), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+pylazybam/tests/test_cli.py
+
+Copyright (c) 2018-2020 Matthew Wakefield, The Walter and Eliza Hall Institute and The University of Melbourne. All rights reserved.
+"""
+
+import os
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from io import (BufferedReader, BytesIO, StringIO, TextIOWrapper,
+                UnsupportedOperation)
+from unittest import mock
+from tempfile import TemporaryDirectory
+
+from pkg_resources import resource_filename
+
+from pylazybam import bam, cli
+from pylazybam.tags import get_AS
+
+__author__ = "Matthew Wakefield"
+__copyright__ = "Copyright 2018-2020 Matthew Wakefield, The Walter and Eliza Hall Institute and The University of Melbourne"
+__credits__ = ["Matthew Wakefield", ]
+__license__ = "BSD-3-Clause"
+__version__ = "0.1.0"
+__maintainer__ = "Matthew Wakefield"
+__email__ = "wakefield@wehi.edu.au"
+__status__ = "Development/Beta"
+
+HUMAN_BAM = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+
+
+def run(*argv):
+    """Run the command line returning stdout"""
+    out = StringIO()
+    with redirect_stdout(out), redirect_stderr(StringIO()):
+        cli.main([str(arg) for arg in argv])
+    return out.getvalue()
+
+
+class Unseekable(BytesIO):
+    """A stream that can not seek, like a pipe"""
+    def seekable(self):
+        return False
+
+    def seek(self, *args):
+        raise UnsupportedOperation('seek')
+
+    def tell(self):
+        raise UnsupportedOperation('tell')
+
+
+def stdin_of(data):
+    """A text stdin whose buffer is an unseekable stream of data"""
+    return TextIOWrapper(BufferedReader(Unseekable(data)))
+
+
+class test_cli(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with bam.FileReader(HUMAN_BAM) as the_bam:
+            cls.alignments = list(the_bam)
+            cls.ref_to_index = the_bam.ref_to_index
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_flag_value(self):
+        self.assertEqual(cli._flag_value('0x900'), 0x900)
+        self.assertEqual(cli._flag_value('4'), 4)
+        self.assertEqual(cli._flag_value('secondary,supplementary'), 0x900)
+        with self.assertRaises(SystemExit), redirect_stderr(StringIO()):
+            cli.main(['count', '-F', 'secondry', HUMAN_BAM])
+
+    def test_tag_threshold(self):
+        self.assertEqual(cli._tag_threshold('AS:100'), (b'AS', 100))
+        self.assertEqual(cli._tag_threshold('XS:-1.5'), (b'XS', -1.5))
+        for text in ('AS', 'AS:high', 'ASX:1', 'AS:1.2.3'):
+            with self.assertRaises(SystemExit), redirect_stderr(StringIO()):
+                cli.main(['count', '--min-tag', text, HUMAN_BAM])
+
+    def test_count(self):
+        self.assertEqual(run('count', HUMAN_BAM), '476\n')
+        read1 = sum(1 for a in self.alignments
+                    if bam.is_flag(a, bam.FLAGS['read1']))
+        self.assertEqual(run('count', '-f', 'read1', '-@', 1, HUMAN_BAM),
+                         f'{read1}\n')
+        mapq = [a for a in self.alignments if bam.get_mapq(a) >= 30
+                and not bam.get_flag(a) & 0x4]
+        self.assertEqual(run('count', '-q', 30, '-F', 'unmapped', HUMAN_BAM),
+                         f'{len(mapq)}\n')
+        scored = [a for a in self.alignments
+                  if 150 <= get_AS(cli._tag_bytes(a)) <= 195]
+        self.assertTrue(0 < len(scored) < len(self.alignments))
+        self.assertEqual(run('count', '--min-tag', 'AS:150',
+                             '--max-tag', 'AS:195', HUMAN_BAM),
+                         f'{len(scored)}\n')
+
+    def test_count_by_ref(self):
+        lines = run('count', '--by-ref', HUMAN_BAM).splitlines()
+        self.assertEqual(len(lines), len(self.ref_to_index) + 1)
+        self.assertEqual(lines[0], 'MT\t0')
+        self.assertEqual(lines[-1].split('\t')[0], '*')
+        self.assertEqual(sum(int(line.split('\t')[1]) for line in lines),
+                         len(self.alignments))
+        nonzero = run('count', '--by-ref', '--skip-zero', HUMAN_BAM)
+        self.assertEqual(nonzero.splitlines(),
+                         [line for line in lines
+                          if not line.endswith('\t0')])
+
+    def test_view(self):
+        output = os.path.join(self.tmpdir.name, 'chr7.bam')
+        for command in ('view', 'filter'):
+            run(command, '-r', '7', '-r', '*', '-o', output, HUMAN_BAM)
+            with bam.FileReader(output) as the_bam:
+                with bam.FileReader(HUMAN_BAM) as source:
+                    self.assertEqual(the_bam.raw_header, source.raw_header)
+                self.assertEqual(list(the_bam),
+                                 [a for a in self.alignments
+                                  if bam.get_ref_index(a)
+                                  in (-1, self.ref_to_index['7'])])
+        stderr = StringIO()
+        with self.assertRaises(SystemExit) as context, redirect_stderr(stderr):
+            cli.main(['view', '-r', 'chr7', '-o', output, HUMAN_BAM])
+        self.assertEqual(context.exception.code, 2)
+        self.assertIn('usage:', stderr.getvalue())
+        with self.assertRaises(SystemExit), redirect_stderr(StringIO()):
+            cli.main(['view', '-@', '0', '-o', output, HUMAN_BAM])
+
+    def test_stdin(self):
+        with open(HUMAN_BAM, 'rb') as handle:
+            data = handle.read()
+        with mock.patch('sys.stdin', stdin_of(data)):
+            self.assertEqual(run('count', '-'), '476\n')
+        output = os.path.join(self.tmpdir.name, 'chr7.bam')
+        with mock.patch('sys.stdin', stdin_of(data)):
+            run('view', '-r', '7', '-o', output, '-')
+        chr7 = [a for a in self.alignments
+                if bam.get_ref_index(a) == self.ref_to_index['7']]
+        with bam.FileReader(output) as the_bam:
+            self.assertEqual(list(the_bam), chr7)
+        # lazybam view ... | lazybam count -
+        with open(output, 'rb') as handle:
+            with mock.patch('sys.stdin', stdin_of(handle.read())):
+                self.assertEqual(run('count', '--by-ref', '--skip-zero',
+                                     '-'), f'7\t{len(chr7)}\n')
+        # bad input is an error without the usage message
+        for bad in (b'', data[:1000]):
+            with mock.patch('sys.stdin', stdin_of(bad)):
+                stderr = StringIO()
+                with self.assertRaises(SystemExit) as context, \
+                        redirect_stderr(stderr):
+                    cli.main(['count', '-'])
+                self.assertEqual(context.exception.code, 1)
+                self.assertTrue(stderr.getvalue().startswith(
+                    'lazybam: error: '))
+                self.assertNotIn('usage:', stderr.getvalue())
+
+    def test_split(self):
+        prefix = os.path.join(self.tmpdir.name, 'split')
+        run('split', '-F', 0x900, HUMAN_BAM, prefix)
+        names = sorted(os.listdir(self.tmpdir.name))
+        self.assertIn('split.unmapped.bam', names)
+        self.assertIn('split.7.bam', names)
+        with bam.FileReader(f'{prefix}.7.bam') as the_bam:
+            self.assertEqual(list(the_bam),
+                             [a for a in self.alignments
+                              if bam.get_ref_index(a) == self.ref_to_index['7']
+                              and not bam.get_flag(a) & 0x900])
+        tagged = os.path.join(self.tmpdir.name, 'tagged')
+        run('split', '--tag', 'NM', HUMAN_BAM, tagged)
+        total = 0
+        for name in os.listdir(self.tmpdir.name):
+            if name.startswith('tagged.'):
+                with bam.FileReader(os.path.join(self.tmpdir.name,
+                                                 name)) as the_bam:
+                    total += sum(1 for alignment in the_bam)
+        self.assertEqual(total, len(self.alignments))
+        self.assertTrue(os.path.exists(f'{tagged}.0.bam'))
+        self.assertTrue(os.path.exists(f'{tagged}.untagged.bam'))
+        # the number of open outputs is limited
+        limited = os.path.join(self.tmpdir.name, 'limited')
+        with self.assertRaises(SystemExit), redirect_stderr(StringIO()):
+            cli.main(['split', '--max-outputs', '3', HUMAN_BAM, limited])
+        self.assertEqual(len([name for name in os.listdir(self.tmpdir.name)
+                              if name.startswith('limited.')]), 3)
+        run('split', '--max-outputs', '3', '-r', '7', '-r', '*', HUMAN_BAM,
+            limited)
+
+    def test_fastq(self):
+        read1 = os.path.join(self.tmpdir.name, 'R1.fastq')
+        read2 = os.path.join(self.tmpdir.name, 'R2.fastq.gz')
+        run('fastq', '-1', read1, '-2', read2, HUMAN_BAM)
+        with open(read1, 'rb') as handle:
+            lines = handle.read().splitlines()
+        self.assertEqual(len(lines), 4 * 238)
+        self.assertTrue(os.path.getsize(read2) > 0)
+        interleaved = os.path.join(self.tmpdir.name, 'mapped.fastq')
+        run('fastq', '-F', 'unmapped', '-1', interleaved, HUMAN_BAM)
+        with open(interleaved, 'rb') as handle:
+            self.assertEqual(len(handle.read().splitlines()),
+                             4 * sum(1 for a in self.alignments
+                                     if not bam.get_flag(a) & 0x904))
+
+
+if __name__ == "__main__":
+    unittest.main()
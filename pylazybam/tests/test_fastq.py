@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+pylazybam/tests/test_fastq.py
+
+Copyright (c) 2018-2020 Matthew Wakefield, The Walter and Eliza Hall Institute and The University of Melbourne. All rights reserved.
+"""
+
+import gzip
+import struct
+import unittest
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from pathlib import Path
+
+from pkg_resources import resource_filename
+
+from pylazybam import bam, fastq
+from pylazybam.tests.test_bam import ALIGN0, ALIGN42
+
+__author__ = "Matthew Wakefield"
+__copyright__ = "Copyright 2018-2020 Matthew Wakefield, The Walter and Eliza Hall Institute and The University of Melbourne"
+__credits__ = ["Matthew Wakefield", ]
+__license__ = "BSD-3-Clause"
+__version__ = "0.1.0"
+__maintainer__ = "Matthew Wakefield"
+__email__ = "wakefield@wehi.edu.au"
+__status__ = "Development/Beta"
+
+HUMAN_BAM = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+
+SEQUENCE0 = 'GTGCATCCCGGTAGTCCCAGCTACTTAGGAGGCTGAGGCAGGAGAATCGCTTGAACCCTGGAGGCAAAGGTTGCAGTGAGCCGAGATCACACCACTACAN'
+QUAL0 = 'DCDDB@DDDDCCBB?DDEEEDDECDCFFHHHHHJIIGHJJJJJJJIHIIJIIHDBJJJJJJJJIIIJJJIGHHJJJJIJJIJIGJJIHHFFHFDDDD=1#'
+
+
+def set_flag(alignment, flag):
+    return alignment[:18] + struct.pack('<H', flag) + alignment[20:]
+
+
+def reverse_complement(sequence):
+    return sequence.translate(str.maketrans('ACGTN', 'TGCAN'))[::-1]
+
+
+class test_fastq(unittest.TestCase):
+    def test_alignment_to_fastq(self):
+        # ALIGN0 is the first read of a pair aligned to the reverse strand
+        self.assertTrue(bam.is_flag(ALIGN0, bam.FLAGS['reverse_strand']))
+        self.assertEqual(fastq.alignment_to_fastq(ALIGN0),
+                         ('@HWI-ST960:96:COTO3ACXX:3:1101:1220:2089\n'
+                          f'{reverse_complement(SEQUENCE0)}\n+\n'
+                          f'{QUAL0[::-1]}\n').encode())
+        forward = set_flag(ALIGN0, 0x43)
+        self.assertEqual(fastq.alignment_to_fastq(forward).split(b'\n')[1:4],
+                         [SEQUENCE0.encode(), b'+', QUAL0.encode()])
+        self.assertEqual(fastq.alignment_to_fastq(memoryview(forward)),
+                         fastq.alignment_to_fastq(forward))
+        # odd length sequence with missing base qualities
+        odd = (ALIGN42[:20] + struct.pack('<i', 3) + ALIGN42[24:76]
+               + b'\x12\x40' + b'\xff\xff\xff')
+        self.assertEqual(fastq.alignment_to_fastq(odd).split(b'\n')[1:4],
+                         [b'ACG', b'+', b'"""'])
+        odd = set_flag(odd, 0x10)
+        self.assertEqual(fastq.alignment_to_fastq(odd, default_quality=40)
+                         .split(b'\n')[1:4], [b'CGT', b'+', b'III'])
+
+    def test_write_fastq(self):
+        with bam.FileReader(HUMAN_BAM) as the_bam:
+            alignments = list(the_bam)
+        read1 = [fastq.alignment_to_fastq(a) for a in alignments
+                 if bam.is_flag(a, bam.FLAGS['read1'])]
+        read2 = [fastq.alignment_to_fastq(a) for a in alignments
+                 if bam.is_flag(a, bam.FLAGS['read2'])]
+        self.assertEqual(len(read1), 238)
+        interleaved = BytesIO()
+        counts = fastq.write_fastq(alignments, interleaved, batch_size=7)
+        self.assertEqual(counts, {'read1': 238, 'read2': 238,
+                                  'other': 0, 'excluded': 0, 'dropped': 0})
+        self.assertEqual(interleaved.getvalue(),
+                         b''.join(map(fastq.alignment_to_fastq, alignments)))
+        with TemporaryDirectory() as tmpdir:
+            r1 = Path(tmpdir) / 'test_R1.fastq.gz'
+            r2 = Path(tmpdir) / 'test_R2.fastq'
+            fastq.write_fastq(bam.FileReader(HUMAN_BAM), r1, str(r2),
+                              threads=2)
+            with gzip.open(r1) as handle:
+                self.assertEqual(handle.read(), b''.join(read1))
+            self.assertEqual(r2.read_bytes(), b''.join(read2))
+        secondary = set_flag(ALIGN0, 0x153)
+        unpaired = set_flag(ALIGN0, 0x10)
+        first, other = BytesIO(), BytesIO()
+        counts = fastq.write_fastq([ALIGN0, secondary, unpaired, ALIGN42],
+                                   first, other=other)
+        self.assertEqual(counts, {'read1': 2, 'read2': 0,
+                                  'other': 1, 'excluded': 1, 'dropped': 0})
+        self.assertEqual(first.getvalue(),
+                         fastq.alignment_to_fastq(ALIGN0)
+                         + fastq.alignment_to_fastq(ALIGN42))
+        self.assertEqual(other.getvalue(), fastq.alignment_to_fastq(unpaired))
+        counts = fastq.write_fastq([secondary], BytesIO(), exclude=0)
+        self.assertEqual(counts['read1'], 1)
+        # without other, reads that are not read1 or read2 are dropped
+        # rather than put out of step in paired files
+        read2_of_pair = set_flag(ALIGN0, 0x93)
+        both = set_flag(ALIGN0, 0xd3)
+        first, second = BytesIO(), BytesIO()
+        counts = fastq.write_fastq([ALIGN0, unpaired, both, read2_of_pair],
+                                   first, second)
+        self.assertEqual(counts, {'read1': 1, 'read2': 1,
+                                  'other': 0, 'excluded': 0, 'dropped': 2})
+        self.assertEqual(first.getvalue(), fastq.alignment_to_fastq(ALIGN0))
+        self.assertEqual(second.getvalue(),
+                         fastq.alignment_to_fastq(read2_of_pair))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+pylazybam/tests/test_parallel.py
+
+Copyright (c) 2018-2020 Matthew Wakefield, The Walter and Eliza Hall Institute and The University of Melbourne. All rights reserved.
+"""
+
+import os
+import struct
+import unittest
+from tempfile import TemporaryDirectory
+
+from pkg_resources import resource_filename
+
+from pylazybam import bam, parallel
+
+__author__ = "Matthew Wakefield"
+__copyright__ = "Copyright 2018-2020 Matthew Wakefield, The Walter and Eliza Hall Institute and The University of Melbourne"
+__credits__ = ["Matthew Wakefield", ]
+__license__ = "BSD-3-Clause"
+__version__ = "0.1.0"
+__maintainer__ = "Matthew Wakefield"
+__email__ = "wakefield@wehi.edu.au"
+__status__ = "Development/Beta"
+
+HUMAN_BAM = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+
+
+def name_and_pos(alignment):
+    return bam.get_read_name(alignment, alignment[12]), bam.get_pos(alignment)
+
+
+def is_read1(alignment):
+    return bam.is_flag(alignment, bam.FLAGS['read1'])
+
+
+def name_and_size(group):
+    return bam.get_read_name(group[0], group[0][12]), len(group)
+
+
+def any_reverse(group):
+    return any(bam.is_flag(alignment, bam.FLAGS['reverse_strand'])
+               for alignment in group)
+
+
+def misaligned_worker(path, func, by_name, start_block, end_block, n_ref,
+                      start):
+    """A worker that resynchronises to the wrong record in every shard"""
+    first, next_start, results = parallel._map_shard(path, func, by_name,
+                                                     start_block, end_block,
+                                                     n_ref, start)
+    if start is None:
+        return (first or 0) + 1, 0, results[1:]
+    return first, next_start, results
+
+
+class test_parallel(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = TemporaryDirectory()
+        cls.path = os.path.join(cls.tmpdir.name, 'large.bam')
+        with bam.FileReader(HUMAN_BAM) as the_bam:
+            cls.alignments = list(the_bam)
+            with bam.FileWriter(cls.path, the_bam.raw_header,
+                                the_bam.raw_refs) as writer:
+                writer.write_header()
+                for i in range(30):
+                    for alignment in cls.alignments:
+                        writer.write(alignment)
+        cls.expected = [name_and_pos(alignment)
+                        for alignment in cls.alignments] * 30
+        # name sorted file with groups of varying size, some larger than
+        # a BGZF block so that they span shard boundaries
+        cls.grouped_path = os.path.join(cls.tmpdir.name, 'grouped.bam')
+        with bam.FileReader(HUMAN_BAM) as the_bam:
+            groups = list(the_bam.iter_name_groups(check_sort=False))
+            text = the_bam.raw_header[4:].replace(b'SO:unsorted',
+                                                  b'SO:queryname')
+            raw_header = struct.pack('<i', len(text)) + text
+            cls.groups = []
+            for i in range(20):
+                for j, group in enumerate(groups):
+                    copies = 300 if j == 7 * i else 1 + (i + j) % 4
+                    cls.groups.append(group * copies)
+            with bam.FileWriter(cls.grouped_path, raw_header,
+                                the_bam.raw_refs) as writer:
+                writer.write_header()
+                for group in cls.groups:
+                    for alignment in group:
+                        writer.write(alignment)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_plan_shards(self):
+        with bam.FileReader(self.path) as the_bam:
+            start = the_bam._start_of_alignments
+        blocks = parallel._block_starts(self.path)
+        self.assertGreater(len(blocks), 40)
+        plan = parallel._plan_shards(self.path, start, 10)
+        self.assertEqual(len(plan), 10)
+        self.assertEqual(plan[0][0], start >> 16)
+        self.assertEqual(plan[-1][1], os.path.getsize(self.path))
+        for (start_block, end_block), (next_block, _) in zip(plan, plan[1:]):
+            self.assertEqual(end_block, next_block)
+            self.assertIn(end_block, blocks)
+        self.assertLessEqual(len(parallel._plan_shards(self.path, start, 1000)),
+                             len(blocks) - blocks.index(start >> 16))
+
+    def test_resync(self):
+        with bam.FileReader(self.path) as the_bam:
+            start = the_bam._start_of_alignments
+            n_ref = the_bam.n_ref
+        plan = parallel._plan_shards(self.path, start, 25)
+        results = []
+        expected = start
+        for i, (start_block, end_block) in enumerate(plan):
+            found = parallel._map_shard(self.path, name_and_pos, False,
+                                        start_block, end_block, n_ref,
+                                        start if i == 0 else None)
+            exact = parallel._map_shard(self.path, name_and_pos, False,
+                                        start_block, end_block, n_ref,
+                                        expected)
+            self.assertEqual(found, exact)
+            expected = exact[1]
+            results.extend(exact[2])
+        self.assertIsNone(expected)
+        self.assertEqual(results, self.expected)
+
+    def test_parallel_map(self):
+        self.assertEqual(list(parallel.parallel_map(self.path, name_and_pos,
+                                                    processes=2,
+                                                    shards_per_process=6)),
+                         self.expected)
+        self.assertEqual(list(parallel.parallel_map(HUMAN_BAM, name_and_pos,
+                                                    processes=3)),
+                         self.expected[:len(self.alignments)])
+
+    def test_resync_mismatch(self):
+        results = [result for i, shard in
+                   parallel._run_shards(self.path, misaligned_worker,
+                                        (name_and_pos, False), 2, 4)
+                   for result in shard]
+        self.assertEqual(results, self.expected)
+
+    def test_resync_by_name(self):
+        with bam.FileReader(self.grouped_path) as the_bam:
+            start = the_bam._start_of_alignments
+            n_ref = the_bam.n_ref
+        # one shard per block, so the largest groups span whole shards
+        plan = parallel._plan_shards(self.grouped_path, start, 1000)
+        results = []
+        empty = 0
+        expected = start
+        for i, (start_block, end_block) in enumerate(plan):
+            found = parallel._map_shard(self.grouped_path, name_and_size,
+                                        True, start_block, end_block, n_ref,
+                                        start if i == 0 else None)
+            if expected is not None and expected >> 16 < end_block:
+                self.assertEqual(found[0], expected)
+            else:
+                self.assertIsNone(found[0])
+                self.assertEqual(found[2], [])
+                empty += 1
+            if found[0] is not None:
+                expected = found[1]
+            results.extend(found[2])
+        self.assertIsNone(expected)
+        self.assertGreater(empty, 0)
+        self.assertEqual(results, [name_and_size(group)
+                                   for group in self.groups])
+
+    def test_parallel_map_by_name(self):
+        self.assertEqual(list(parallel.parallel_map(self.grouped_path,
+                                                    name_and_size,
+                                                    processes=2,
+                                                    shards_per_process=15,
+                                                    by_name=True)),
+                         [name_and_size(group) for group in self.groups])
+        with self.assertRaises(ValueError):
+            list(parallel.parallel_map(self.path, name_and_size,
+                                       processes=2, by_name=True))
+        self.assertEqual(len(list(parallel.parallel_map(self.path,
+                                                        name_and_size,
+                                                        processes=2,
+                                                        by_name=True,
+                                                        check_sort=False))),
+                         238 * 30)
+
+    def test_parallel_filter_by_name(self):
+        output = os.path.join(self.tmpdir.name, 'reverse.bam')
+        kept = [alignment for group in self.groups if any_reverse(group)
+                for alignment in group]
+        written = parallel.parallel_filter(self.grouped_path, any_reverse,
+                                           output, processes=2,
+                                           shards_per_process=15,
+                                           by_name=True)
+        self.assertEqual(written, len(kept))
+        self.assertLess(written, sum(len(group) for group in self.groups))
+        with bam.FileReader(output) as the_bam:
+            self.assertEqual(the_bam.sort_order, 'queryname')
+            self.assertEqual(list(the_bam), kept)
+
+    def test_parallel_filter(self):
+        output = os.path.join(self.tmpdir.name, 'read1.bam')
+        # an unrelated file that must survive the removal of the parts
+        with open(output + '.partial', 'wb') as partial:
+            partial.write(b'keep')
+        written = parallel.parallel_filter(self.path, is_read1, output,
+                                           processes=2, shards_per_process=5)
+        self.assertEqual(written, 238 * 30)
+        with bam.FileReader(output) as the_bam:
+            with bam.FileReader(HUMAN_BAM) as source:
+                self.assertEqual(the_bam.raw_header, source.raw_header)
+                self.assertEqual(the_bam.raw_refs, source.raw_refs)
+            self.assertEqual(list(the_bam),
+                             [a for a in self.alignments if is_read1(a)] * 30)
+        self.assertEqual(os.listdir(self.tmpdir.name).count('read1.bam'), 1)
+        self.assertEqual([name for name in os.listdir(self.tmpdir.name)
+                          if '.part' in name], ['read1.bam.partial'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+pylazybam/tests/test_sort.py
+
+Copyright (c) 2018-2020 Matthew Wakefield, The Walter and Eliza Hall Institute and The University of Melbourne. All rights reserved.
+"""
+
+import os
+import struct
+import unittest
+from tempfile import TemporaryDirectory
+
+from pkg_resources import resource_filename
+
+from pylazybam import bam, sort
+from pylazybam.tests.test_bam import ALIGN0, ALIGN42
+
+__author__ = "Matthew Wakefield"
+__copyright__ = "Copyright 2018-2020 Matthew Wakefield, The Walter and Eliza Hall Institute and The University of Melbourne"
+__credits__ = ["Matthew Wakefield", ]
+__license__ = "BSD-3-Clause"
+__version__ = "0.1.0"
+__maintainer__ = "Matthew Wakefield"
+__email__ = "wakefield@wehi.edu.au"
+__status__ = "Development/Beta"
+
+HUMAN_BAM = resource_filename(__name__, 'data/paired_end_testdata_human.bam')
+
+
+def raw_header(text):
+    return struct.pack('<i', len(text)) + text
+
+
+def renamed(alignment, name):
+    """A copy of a raw alignment with a new read name"""
+    body = (alignment[4:12] + bytes([len(name) + 1]) + alignment[13:36]
+            + name + b'\x00' + alignment[36 + alignment[12]:])
+    return struct.pack('<i', len(body)) + body
+
+
+class test_sort(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with bam.FileReader(HUMAN_BAM) as the_bam:
+            cls.alignments = list(the_bam)
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.output = os.path.join(self.tmpdir.name, 'sorted.bam')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_coordinate_key(self):
+        # ALIGN42 is unmapped without a reference
+        self.assertGreater(sort.coordinate_key(ALIGN42),
+                           sort.coordinate_key(ALIGN0))
+        forward = ALIGN0[:18] + struct.pack('<H', 0x43) + ALIGN0[20:]
+        self.assertEqual(sort.coordinate_key(ALIGN0),
+                         sort.coordinate_key(forward) + 1)
+        before = ALIGN0[:8] + struct.pack('<i', 133186148) + ALIGN0[12:]
+        self.assertLess(sort.coordinate_key(before),
+                        sort.coordinate_key(forward))
+
+    def test_name_keys(self):
+        read1 = ALIGN0[:18] + struct.pack('<H', 0x43) + ALIGN0[20:]
+        read2 = ALIGN0[:18] + struct.pack('<H', 0x83) + ALIGN0[20:]
+        self.assertLess(sort.name_key(read1), sort.name_key(read2))
+        self.assertLess(sort.natural_name_key(read1),
+                        sort.natural_name_key(read2))
+        self.assertEqual(sort.name_key(ALIGN0)[0],
+                         b'HWI-ST960:96:COTO3ACXX:3:1101:1220:2089')
+
+    def test_set_sort_order(self):
+        self.assertEqual(sort.set_sort_order(
+            raw_header(b'@HD\tVN:1.0\tSO:unsorted\n@SQ\tSN:1\tLN:9\n'),
+            'coordinate'),
+            raw_header(b'@HD\tVN:1.0\tSO:coordinate\n@SQ\tSN:1\tLN:9\n'))
+        self.assertEqual(sort.set_sort_order(
+            raw_header(b'@HD\tVN:1.0\tGO:query\n@CO\tSO:x\n'), 'queryname'),
+            raw_header(b'@HD\tVN:1.0\tGO:query\tSO:queryname\n@CO\tSO:x\n'))
+        self.assertEqual(sort.set_sort_order(
+            raw_header(b'@SQ\tSN:1\tLN:9\n'), 'queryname'),
+            raw_header(b'@HD\tVN:1.6\tSO:queryname\n@SQ\tSN:1\tLN:9\n'))
+
+    def test_sort_coordinate(self):
+        expected = sorted(self.alignments, key=sort.coordinate_key)
+        self.assertNotEqual(expected, self.alignments)
+        for max_memory, max_runs in ((1 << 30, 256), (20000, 256),
+                                     (20000, 2)):
+            self.assertEqual(sort.sort_bam(HUMAN_BAM, self.output,
+                                           max_memory=max_memory,
+                                           max_runs=max_runs,
+                                           tmpdir=self.tmpdir.name,
+                                           index=True), 476)
+            self.assertEqual(sorted(os.listdir(self.tmpdir.name)),
+                             ['sorted.bam', 'sorted.bam.bai'])
+            with bam.FileReader(self.output) as the_bam:
+                self.assertEqual(the_bam.sort_order, 'coordinate')
+                self.assertEqual(list(the_bam), expected)
+                self.assertEqual(list(the_bam.fetch('12')),
+                                 [a for a in expected
+                                  if bam.get_ref_index(a) == 12])
+
+    def test_sort_index_placed_unmapped(self):
+        expected = sorted(self.alignments, key=sort.coordinate_key)
+        placed_unmapped = [a for a in expected
+                           if bam.get_ref_index(a) >= 0
+                           and bam.is_flag(a, bam.FLAGS['unmapped'])]
+        self.assertTrue(placed_unmapped)
+        regions = [(1, 92094235, 92109322)] + \
+                  [(bam.get_ref_index(a), bam.get_pos(a),
+                    bam.get_pos(a) + 1) for a in placed_unmapped]
+        for index_format in ('bai', 'csi'):
+            sort.sort_bam(HUMAN_BAM, self.output, index=index_format)
+            with bam.FileReader(self.output) as the_bam:
+                the_bam.load_index(f"{self.output}.{index_format}")
+                for ref_index, start, end in regions:
+                    self.assertEqual(
+                        list(the_bam.fetch(ref_index, start, end)),
+                        [a for a in expected
+                         if bam.get_ref_index(a) == ref_index
+                         and bam.get_pos(a) < end
+                         and bam.get_reference_end(a) > start])
+
+    def test_sort_queryname(self):
+        for natural, key, threads in ((True, sort.natural_name_key, 2),
+                                      (False, sort.name_key, 1)):
+            expected = sorted(self.alignments, key=key)
+            sort.sort_bam(HUMAN_BAM, self.output, order='queryname',
+                          natural=natural, max_memory=30000, threads=threads)
+            with bam.FileReader(self.output) as the_bam:
+                self.assertEqual(the_bam.sort_order, 'queryname')
+                groups = list(the_bam.iter_name_groups())
+            self.assertEqual([a for group in groups for a in group],
+                             expected)
+            self.assertEqual(len(groups), 238)
+            for group in groups:
+                self.assertTrue(bam.is_flag(group[0], bam.FLAGS['read1']))
+                self.assertTrue(bam.is_flag(group[1], bam.FLAGS['read2']))
+
+    def test_sort_queryname_punctuation(self):
+        # samtools sort -n order, where names differ at a digit and a
+        # punctuation character the byte values are compared
+        expected = [b'ab', b'ab-', b'ab1', b'r-1', b'r-1-5', b'r-1.5',
+                    b'r-10', b'r.2', b'r.10', b'r1', b'r10']
+        unsorted = os.path.join(self.tmpdir.name, 'unsorted.bam')
+        with bam.FileReader(HUMAN_BAM) as the_bam:
+            with bam.FileWriter(unsorted, raw_header=the_bam.raw_header,
+                                raw_refs=the_bam.raw_refs) as writer:
+                writer.write_header()
+                for name in reversed(expected):
+                    writer.write(renamed(ALIGN42, name))
+        sort.sort_bam(unsorted, self.output, order='queryname')
+        with bam.FileReader(self.output) as the_bam:
+            self.assertEqual([bam.get_raw_read_name(a,
+                                                    bam.get_len_read_name(a))
+                              for a in the_bam],
+                             [name + b'\x00' for name in expected])
+
+    def test_open_run(self):
+        with sort._open_run(HUMAN_BAM) as the_bam:
+            self.assertEqual(the_bam.chunk_size, sort._MERGE_CHUNK_SIZE)
+            self.assertEqual(the_bam._bgzf.max_cache, 1)
+            self.assertEqual(list(the_bam), self.alignments)
+
+    def test_sort_errors(self):
+        self.assertRaises(ValueError, sort.sort_bam, HUMAN_BAM, self.output,
+                          order='position')
+        self.assertRaises(ValueError, sort.sort_bam, HUMAN_BAM, self.output,
+                          order='queryname', index=True)
+        self.assertRaises(ValueError, sort.sort_bam, HUMAN_BAM, self.output,
+                          max_runs=1)
+
+
+if __name__ == "__main__":
+    unittest.main()